@@ -1,4 +1,5 @@
 import kivy
+import time
 
 from kivy.clock import Clock
 from kociemba.pykociemba.color import color_keys
@@ -8,7 +9,8 @@ from kociemba import solve
 from threading import Thread, Event
 from random import randint
 
-from bluetoothcube.cubestate import CubieCube, MOVES_GIIKER_TO_KOCIEMBA
+from bluetoothcube.cubestate import CubieCube
+from bluetoothcube.latency import tracer
 
 from typing import List
 
@@ -63,6 +65,9 @@ class BluetoothCube(kivy.event.EventDispatcher):
 
     def __init__(self):
         self.register_event_type('on_state_changed')
+        # Like on_state_changed, but at most once per frame, with the latest
+        # state. Meant for displays.
+        self.register_event_type('on_display_state_changed')
         self.register_event_type('on_move_raw')
         self.register_event_type('on_move_merged')
         super(BluetoothCube, self).__init__()
@@ -70,31 +75,52 @@ class BluetoothCube(kivy.event.EventDispatcher):
         self.move_history_raw: List[Move] = []
         self.move_history_merged: List[Move] = []
         self.connection = None
+        # time.perf_counter_ns() of the arrival of the current state.
+        self.state_timestamp = time.perf_counter_ns()
 
     def set_connection(self, connection):
         self.connection = connection
         self.cube_state = CubieCube()
-        self.connection.bind(on_state_updated=self.process_state_update)
+        self.connection.bind(
+            on_state_updated=self.process_state_update,
+            on_states_processed=lambda c: self.dispatch(
+                'on_display_state_changed', self.cube_state))
 
     def disable_connection(self):
         self.cube_state = CubieCube()
         self.connection = None
+        self.state_timestamp = time.perf_counter_ns()
         self.solved = self.cube_state.is_solved()
-        self.dispatch('on_state_changed', self.cube_state)
-
-    def process_state_update(self, connection, state):
-        self.cube_state = CubieCube(giiker_state=state)
+        self.dispatch('on_state_changed', self.cube_state,
+                      self.state_timestamp)
+        self.dispatch('on_display_state_changed', self.cube_state)
+
+    # `message` is a protocols.Message, `timestamp` the time.perf_counter_ns()
+    # of the notification arrival.
+    def process_state_update(self, connection, message, timestamp):
+        start = time.perf_counter_ns()
+        code, state = message
+        if state is not None:
+            self.cube_state = connection.transport.protocol.cube_state(state)
+        elif code is not None:
+            self.cube_state = self.cube_state.moved(code)
+        tracer.record('decode', time.perf_counter_ns() - start)
+        # Set before `solved`, so that its observers can use it too.
+        self.state_timestamp = timestamp
         self.solved = self.cube_state.is_solved()
 
-        face = color_keys[MOVES_GIIKER_TO_KOCIEMBA[(state[16] >> 4) & 0x0F]]
-        dir = ("" if (state[16] & 0x0F) == 1 else "'")
-        move = Move(face, dir)
+        self.dispatch('on_state_changed', self.cube_state, timestamp)
+        if code is None:
+            return
+
+        face = color_keys[code >> 2]
+        turns = code & 3
+        move = Move(face, "'") if turns == 3 else Move(face, "", turns)
         self.move_history_raw.append(move)
 
         # s = '  '.join(self.cube_state.get_representation_strings())
         # print(f"{s}  {move}")
 
-        self.dispatch('on_state_changed', self.cube_state)
         self.dispatch('on_move_raw', move)
 
         self.add_move_to_rich_history(move)
@@ -120,6 +146,9 @@ class BluetoothCube(kivy.event.EventDispatcher):
     def on_state_changed(self, *args):
         pass
 
+    def on_display_state_changed(self, *args):
+        pass
+
     def on_move_raw(self, *args):
         pass
 
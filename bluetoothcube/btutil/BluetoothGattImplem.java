@@ -3,6 +3,7 @@ package org.cielak.bluetoothcube;
 import android.bluetooth.BluetoothGatt;
 import android.bluetooth.BluetoothGattCallback;
 import android.bluetooth.BluetoothGattCharacteristic;
+import android.bluetooth.BluetoothGattDescriptor;
 import android.bluetooth.BluetoothProfile;
 import android.bluetooth.BluetoothGattService;
 
@@ -16,6 +17,8 @@ public class BluetoothGattImplem extends BluetoothGattCallback {
          void onServicesDiscovered(BluetoothGatt gatt, int status);
 
          void onCharacteristicRead(BluetoothGatt gatt,BluetoothGattCharacteristic characteristic, int status);
+
+         void onDescriptorWrite(BluetoothGatt gatt, BluetoothGattDescriptor descriptor, int status);
       
     }
     private OnBluetoothGattCallback callback = null;
@@ -39,4 +42,8 @@ public class BluetoothGattImplem extends BluetoothGattCallback {
         if (this.callback != null)
             this.callback.onCharacteristicRead(gatt,characteristic,status); 
     }
+    public void onDescriptorWrite(BluetoothGatt gatt, BluetoothGattDescriptor descriptor, int status) {
+        if (this.callback != null)
+            this.callback.onDescriptorWrite(gatt, descriptor, status);
+    }
 }
@@ -0,0 +1,28 @@
+package org.cielak.bluetoothcube;
+
+import android.bluetooth.le.ScanCallback;
+import android.bluetooth.le.ScanResult;
+
+// ScanCallback is an abstract class, which pyjnius cannot implement, so scan
+// results are forwarded to a Python implementation of this interface.
+public class BluetoothScanImplem extends ScanCallback {
+
+    public interface OnBluetoothScanCallback {
+        void onScanResult(int callbackType, ScanResult result);
+
+        void onScanFailed(int errorCode);
+    }
+    private OnBluetoothScanCallback callback = null;
+
+    public void setCallback(OnBluetoothScanCallback callback) {
+        this.callback = callback;
+    }
+    public void onScanResult(int callbackType, ScanResult result) {
+        if (this.callback != null)
+            this.callback.onScanResult(callbackType, result);
+    }
+    public void onScanFailed(int errorCode) {
+        if (this.callback != null)
+            this.callback.onScanFailed(errorCode);
+    }
+}
@@ -1,21 +1,28 @@
 import kivy
+import time
 from jnius import autoclass, PythonJavaClass, java_method, cast
+from kivy.clock import mainthread
 from android.permissions import request_permissions, check_permission, Permission
 
-from bluetoothcube.btutil.const import (
-    CUBE_STATE_SERVICE, CUBE_STATE_RESPONSE,
-    CUBE_INFO_SERVICE, CUBE_INFO_REQUEST, CUBE_INFO_RESPONSE,
-    CLIENT_CHARACTERISTIC_UUID, CUBE_INFO_REQUEST_COMMANDS)
+from bluetoothcube import protocols
+from bluetoothcube.btutil.const import CLIENT_CHARACTERISTIC_UUID
+from bluetoothcube.btutil.devicetable import DeviceTable
+from bluetoothcube.transport import CubeTransport, TransportError, settle
 
 GATT_STATE_CONNECTED = 0x02
 GATT_STATE_DISCONNECTED = 0x00
 GATT_SUCCESS = 0x00
 
 UUID = autoclass('java.util.UUID')
+ParcelUuid = autoclass('android.os.ParcelUuid')
+ArrayList = autoclass('java.util.ArrayList')
 
 BluetoothAdapter = autoclass('android.bluetooth.BluetoothAdapter')
 BluetoothGattDescriptor = autoclass(
     'android.bluetooth.BluetoothGattDescriptor')
+ScanFilterBuilder = autoclass('android.bluetooth.le.ScanFilter$Builder')
+ScanSettings = autoclass('android.bluetooth.le.ScanSettings')
+ScanSettingsBuilder = autoclass('android.bluetooth.le.ScanSettings$Builder')
 
 
 def get_app_context():
@@ -26,34 +33,46 @@ def get_app_context():
 
 
 class DeviceInfo:
-    def __init__(self, address, name, device):
+    def __init__(self, address, name, device, protocol):
         self.address = address
         self.name = name
         self.device = device
+        self.protocol = protocol
 
 
-# Searches for a bluetooth cube.
+# Searches for a bluetooth cube. The scan is filtered by the cube state
+# service in the Bluetooth stack, and names are read from the scan records
+# once per device.
 class BluetoothCubeScanner(kivy.event.EventDispatcher):
     def __init__(self):
         self.register_event_type('on_cube_found')
         self.register_event_type('on_paired_cube_found')
         super().__init__()
         self.default_adapter = BluetoothAdapter.getDefaultAdapter()
-        self.gatt_callback = None
+        self.le_scanner = None
+        self.scan_callback = None
+        # Scan results all arrive on the Android main thread.
+        self.devices_found = DeviceTable()
         if not check_permission('android.permission.ACCESS_COARSE_LOCATION'):
             request_permissions([Permission.ACCESS_COARSE_LOCATION])
 
     class scanCallback(PythonJavaClass):
         __javainterfaces__ = [
-            'android/bluetooth/BluetoothAdapter$LeScanCallback']
+            'org/cielak/bluetoothcube/'
+            'BluetoothScanImplem$OnBluetoothScanCallback']
+        __javacontext__ = 'app'
 
-        def __init__(self, onLeScan_callback):
+        def __init__(self, onScanResult_callback):
             super(BluetoothCubeScanner.scanCallback, self).__init__()
-            self.onLeScan_callback = onLeScan_callback
+            self.onScanResult_callback = onScanResult_callback
 
-        @java_method("(Landroid/bluetooth/BluetoothDevice;I[B)V")
-        def onLeScan(self, device, rssi, scanrecord):
-            self.onLeScan_callback(device)
+        @java_method('(ILandroid/bluetooth/le/ScanResult;)V')
+        def onScanResult(self, callbackType, result):
+            self.onScanResult_callback(result)
+
+        @java_method('(I)V')
+        def onScanFailed(self, errorCode):
+            print(f"Scan failed with error {errorCode}.")
 
     class gattCallback(PythonJavaClass):
         __javainterfaces__ = [
@@ -95,26 +114,50 @@ class BluetoothCubeScanner(kivy.event.EventDispatcher):
             self.onCharacteristicChanged_callback(gatt, characteristic)
 
     def scan(self):
-        self.devices_found = set()
-        self.gatt_callback = BluetoothCubeScanner.scanCallback(
-            self.on_scan_device_found)
-        self.default_adapter.startLeScan(self.gatt_callback)
+        self.devices_found.clear_reported()
 
-    def stop_scan(self):
-        if self.gatt_callback:
-            self.default_adapter.stopLeScan(self.gatt_callback)
-        self.gatt_callback = None
+        # Store pycallback in self to make sure it does not get
+        # garbage-collected while it's in use by Java.
+        self.pycallback = BluetoothCubeScanner.scanCallback(
+            self.on_scan_result)
+        self.scan_callback = autoclass(
+            'org/cielak/bluetoothcube/BluetoothScanImplem')()
+        self.scan_callback.setCallback(self.pycallback)
+
+        filters = ArrayList()
+        for uuid in protocols.advertised_services():
+            filters.add(ScanFilterBuilder().setServiceUuid(
+                ParcelUuid.fromString(uuid)).build())
+        settings = ScanSettingsBuilder().setScanMode(
+            ScanSettings.SCAN_MODE_LOW_LATENCY).build()
+        self.le_scanner = self.default_adapter.getBluetoothLeScanner()
+        self.le_scanner.startScan(filters, settings, self.scan_callback)
 
-    def on_scan_device_found(self, device):
-        addr = device.getAddress()
-        if addr in self.devices_found:
+    def stop_scan(self):
+        if self.scan_callback:
+            self.le_scanner.stopScan(self.scan_callback)
+        self.scan_callback = None
+
+    def on_scan_result(self, result):
+        device = result.getDevice()
+        address = device.getAddress()
+        entry = self.devices_found.get(address)
+        if entry is None:
+            record = result.getScanRecord()
+            name = record and record.getDeviceName()
+            uuids = record and record.getServiceUuids()
+            entry = self.devices_found.add(address, name or device.getName())
+            entry.protocol = protocols.match(entry.name, [
+                u.toString() for u in uuids.toArray()] if uuids else ())
+        if entry.reported or not entry.protocol:
             return
-        self.devices_found.add(addr)
+        entry.reported = True
+        self.cube_found(
+            DeviceInfo(address, entry.name, device, entry.protocol))
 
-        name = device.getName()
-        if name and (name.startswith("Gi")):
-            self.dispatch('on_cube_found', DeviceInfo(
-                device.getAddress(), device.getName(), device))
+    @mainthread
+    def cube_found(self, deviceinfo):
+        self.dispatch('on_cube_found', deviceinfo)
 
     def on_cube_found(self, deviceinfo):
         pass
@@ -123,186 +166,153 @@ class BluetoothCubeScanner(kivy.event.EventDispatcher):
         pass
 
 
-class BluetoothCubeConnection(kivy.event.EventDispatcher):
+# Transport to a cube through the Android BluetoothGatt API. GATT callbacks
+# arrive on a Java thread and are handed over to the event loop. Android runs
+# one GATT operation at a time, so every step waits for its callback.
+class BluetoothCubeConnection(CubeTransport):
     def __init__(self, deviceinfo):
-        self.register_event_type('on_cube_connecting')
-        self.register_event_type('on_cube_connecting_failed')
-        self.register_event_type('on_cube_connected')
-        self.register_event_type('on_cube_disconnected')
-        self.register_event_type('on_state_updated')
         super().__init__()
         self.device = deviceinfo.device
+        self.name = deviceinfo.name
+        self.protocol = deviceinfo.protocol
         self.gatt = None
         self.connected = False  # Set to true when BLE conn. becomes active
-        self.ready = False  # Set to true when comm channels are initiated
-        self.cube_init_phase = 0
-
-    def connect(self):
-        app_context = get_app_context()
+        self.pending = None  # Future of the GATT operation in progress
 
-        self.disconnect()
-
-        # Store pycallback in self to make sure it does not get
-        # garbage-collected while it's in use by Java.
-        self.pycallback = BluetoothCubeScanner.gattCallback(
-            self.on_gatt_connection_state_change,
-            self.on_gatt_services_discovered,
-            self.on_gatt_descriptor_write,
-            self.on_gatt_characteristic_changed
-        )
-        bg = autoclass('org/cielak/bluetoothcube/BluetoothGattImplem')()
-        bg.setCallback(self.pycallback)
-
-        self.gatt = self.device.connectGatt(app_context, False, bg)
-        self.connected = False
-
-        self.dispatch('on_cube_connecting',
-                      f"Connecting to {self.device.getName()}...", 20)
-
-    def disconnect(self):
+    async def connect(self):
+        self.pending = self.loop.create_future()
         if self.gatt:
-            print("Disconnecting.")
-            self.gatt.close()
-            self.gatt = None
-            self.connected = False
-
-    def on_gatt_connection_state_change(self, gatt, status, newstate):
-        print(f"Gatt state changed: {newstate}")
-        if newstate == GATT_STATE_CONNECTED:
-            print("Connected!")
-            self.connected = True
-            self.dispatch('on_cube_connecting',
-                          "Initializing cube...", 55)
-            self.gatt.discoverServices()
-        if newstate == GATT_STATE_DISCONNECTED:
-            print("Disconnected.")
-            self.disconnect()
-            if self.connected:  # There was an active connection
-                self.dispatch('on_cube_disconnected')
-            else:
-                self.dispatch('on_cube_connecting_failed',
-                              "Connection failed.")
-
-    def on_gatt_services_discovered(self, gatt, status):
-        print(f"Service discovery: {status}")
-        if status == GATT_SUCCESS:
-            self.dispatch('on_cube_connecting',
-                          "Establishing communications...", 85)
-            self.enable_notifications()
-
-    def on_gatt_descriptor_write(self, gatt, descriptor, status):
-        print("Desc write!")
-
-    def on_gatt_characteristic_changed(self, gatt, characteristic):
-        value = characteristic.getValue()
-        if characteristic.equals(self.state_response_characteristic):
-            if value[18] == 0xa7:
-                bla=""
-                key = [176, 81, 104, 224, 86, 137, 237, 119, 38, 26, 193, 161, 210, 126, 150, 81, 93, 13, 236, 249, 89, 235, 88, 24, 113, 81, 214, 131, 130, 199, 2, 169, 39, 165, 171, 41]
-                k = value[19]
-                k1 = k >> 4 & 0xf;
-                k2 = k & 0xf;
-                for i in range(0,len(value)-2):
-                    move = (value[i] + key[i + k1] + key[i + k2]) & 0xff;
-                    bla+="{0:02x}".format(move)
-                value=bytes.fromhex(bla)
-            self.dispatch('on_state_updated', value)
+            # The connection was lost. Reconnecting the existing client is
+            # faster than creating a new one, and keeps Android's cache of the
+            # cube's services.
+            if not self.gatt.connect():
+                raise TransportError("Reconnecting failed.")
         else:
-            print(f"Characteristic {characteristic.getUuid()} changed to {value}")
-
-    def enable_notifications(self):
+            app_context = get_app_context()
+
+            # Store pycallback in self to make sure it does not get
+            # garbage-collected while it's in use by Java.
+            self.pycallback = BluetoothCubeScanner.gattCallback(
+                self.on_gatt_connection_state_change,
+                self.on_gatt_services_discovered,
+                self.on_gatt_descriptor_write,
+                self.on_gatt_characteristic_changed
+            )
+            bg = autoclass('org/cielak/bluetoothcube/BluetoothGattImplem')()
+            bg.setCallback(self.pycallback)
+
+            self.gatt = self.device.connectGatt(app_context, False, bg)
+        await self.pending
+
+        self.pending = self.loop.create_future()
+        self.gatt.discoverServices()
+        await self.pending
+
+    async def subscribe(self):
         # BluetoothGattService
         self.cube_state_service = self.gatt.getService(
-            UUID.fromString(CUBE_STATE_SERVICE))
+            UUID.fromString(self.protocol.service))
         if not self.cube_state_service:
-            print("Cube status service not found")
-            self.disconnect()
-            self.dispatch('on_cube_connecting_failed',
-                          "Status service not found.")
-            return
+            raise TransportError("Status service not found.")
 
         # BluetoothGattService
         self.cube_info_service = self.gatt.getService(
-            UUID.fromString(CUBE_INFO_SERVICE))
+            UUID.fromString(self.protocol.info_service))
         if not self.cube_info_service:
-            print("Cube info service not found")
-            self.disconnect()
-            self.dispatch('on_cube_connecting_failed',
-                          "Info service not found.")
-            return
+            raise TransportError("Info service not found.")
 
         # BluetoothGattCharacteristic
         self.state_response_characteristic = \
             self.cube_state_service.getCharacteristic(
-                UUID.fromString(CUBE_STATE_RESPONSE))
+                UUID.fromString(self.protocol.state_characteristic))
         self.info_request_characteristic = \
             self.cube_info_service.getCharacteristic(
-                UUID.fromString(CUBE_INFO_REQUEST))
+                UUID.fromString(self.protocol.info_request))
         self.info_response_characteristic = \
             self.cube_info_service.getCharacteristic(
-                UUID.fromString(CUBE_INFO_RESPONSE))
+                UUID.fromString(self.protocol.info_response))
         if not self.state_response_characteristic \
-           or not self.info_response_characteristic \
+           or not self.info_request_characteristic \
            or not self.info_response_characteristic:
-            print("Cube characteristics not found")
-            self.disconnect()
-            self.dispatch('on_cube_connecting_failed',
-                          "Characteristics not found.")
-            return
+            raise TransportError("Characteristics not found.")
 
         # Enable notifications on cube state characteristic.
         # When we enable notifications, the onCharacteristicChanged
         # callback will get triggered on characteristic change.
         if not self.gatt.setCharacteristicNotification(
                 self.state_response_characteristic, True):
-            print("Could not enable notifications")
-            self.disconnect()
-            self.dispatch('on_cube_connecting_failed',
-                          "Failed to enable state notifications.")
-            return
+            raise TransportError("Failed to enable state notifications.")
 
         if not self.gatt.setCharacteristicNotification(
                 self.info_response_characteristic, True):
-            print("Could not enable info response notifications")
-            self.disconnect()
-            self.dispatch('on_cube_connecting_failed',
-                          "Failed to enable info notifications.")
-            return
-
-        # Enable notifications on these particular descriptor.
-        state = self.state_response_characteristic.getDescriptor(
-            UUID.fromString(CLIENT_CHARACTERISTIC_UUID))
-        state.setValue(BluetoothGattDescriptor.ENABLE_NOTIFICATION_VALUE)
-        self.gatt.writeDescriptor(state)
-        info = self.info_response_characteristic.getDescriptor(
-            UUID.fromString(CLIENT_CHARACTERISTIC_UUID))
-        info.setValue(BluetoothGattDescriptor.ENABLE_NOTIFICATION_VALUE)
-        self.gatt.writeDescriptor(info)
-
-        self.ready = True
-        self.dispatch('on_cube_connected')
-
-    def send_command(self, command):
-        # TODO: At the moment this method only supports single-byte commands.
-        buffer = [0] * 17
-        buffer[0] = command
-        self.info_request_characteristic.setValue(bytes(buffer))
+            raise TransportError("Failed to enable info notifications.")
+
+        # Enable notifications on these particular descriptors, one write
+        # at a time.
+        for characteristic in (self.state_response_characteristic,
+                               self.info_response_characteristic):
+            descriptor = characteristic.getDescriptor(
+                UUID.fromString(CLIENT_CHARACTERISTIC_UUID))
+            descriptor.setValue(
+                BluetoothGattDescriptor.ENABLE_NOTIFICATION_VALUE)
+            self.pending = self.loop.create_future()
+            # onDescriptorWrite only follows a write that was started.
+            if not self.gatt.writeDescriptor(descriptor):
+                raise TransportError("Failed to enable notifications.")
+            await self.pending
+
+    async def write(self, data):
+        self.info_request_characteristic.setValue(data)
         self.gatt.writeCharacteristic(self.info_request_characteristic)
 
-    def reset_cube(self):
-        self.send_command(CUBE_INFO_REQUEST_COMMANDS['RESET_SOLVED'])
+    async def disconnect(self):
+        if self.gatt:
+            print("Disconnecting.")
+            self.gatt.close()
+            self.gatt = None
+            self.connected = False
+            self.closed()
 
-    def on_cube_connecting(self, *args):
-        pass
+    async def reset_cube(self):
+        await self.send_command(self.protocol.commands['RESET_SOLVED'])
 
-    def on_cube_connecting_failed(self, *args):
-        pass
+    # GATT callbacks below are called from a Java thread, and handled in the
+    # event loop.
 
-    def on_cube_connected(self, *args):
-        pass
+    def on_gatt_connection_state_change(self, gatt, status, newstate):
+        self.loop.call_soon_threadsafe(self.connection_state_changed, newstate)
 
-    def on_cube_disconnected(self, *args):
-        pass
+    def connection_state_changed(self, newstate):
+        print(f"Gatt state changed: {newstate}")
+        if newstate == GATT_STATE_CONNECTED:
+            print("Connected!")
+            self.connected = True
+            settle(self.pending)
+        if newstate == GATT_STATE_DISCONNECTED:
+            print("Disconnected.")
+            settle(self.pending, TransportError("Connection failed."))
+            if self.connected:
+                # The client is kept for reconnecting, see connect().
+                self.connected = False
+                self.closed()
 
-    def on_state_updated(self, *args):
-        pass
+    def on_gatt_services_discovered(self, gatt, status):
+        print(f"Service discovery: {status}")
+        self.loop.call_soon_threadsafe(
+            settle, self.pending, None if status == GATT_SUCCESS else
+            TransportError("Service discovery failed."))
+
+    def on_gatt_descriptor_write(self, gatt, status):
+        self.loop.call_soon_threadsafe(
+            settle, self.pending, None if status == GATT_SUCCESS else
+            TransportError("Failed to enable notifications."))
+
+    def on_gatt_characteristic_changed(self, gatt, characteristic):
+        # Moment the notification arrived, before any UI latency.
+        timestamp = time.perf_counter_ns()
+        value = characteristic.getValue()
+        if characteristic.equals(self.state_response_characteristic):
+            self.frame_received(value, timestamp)
+        else:
+            print(f"Characteristic {characteristic.getUuid()} changed to "
+                  f"{value}")
@@ -1,12 +1 @@
-CUBE_STATE_SERVICE = "0000aadb-0000-1000-8000-00805f9b34fb"
-CUBE_STATE_RESPONSE = "0000aadc-0000-1000-8000-00805f9b34fb"
-
-CUBE_INFO_SERVICE = "0000aaaa-0000-1000-8000-00805f9b34fb"
-CUBE_INFO_RESPONSE = "0000aaab-0000-1000-8000-00805f9b34fb"
-CUBE_INFO_REQUEST = "0000aaac-0000-1000-8000-00805f9b34fb"
-
 CLIENT_CHARACTERISTIC_UUID = "00002902-0000-1000-8000-00805f9b34fb"
-
-CUBE_INFO_REQUEST_COMMANDS = {
-    'RESET_SOLVED': 0xA1
-}
@@ -0,0 +1,60 @@
+import time
+
+from collections import OrderedDict
+
+from typing import Optional
+
+
+class DeviceEntry:
+    def __init__(self, name: Optional[str]):
+        self.name = name
+        # protocols.Protocol of the device, if it advertised itself as a cube.
+        self.protocol = None
+        self.last_seen = time.monotonic()
+        # Whether the scanner dispatched it as a cube during the current scan.
+        self.reported = False
+
+
+# Devices seen while scanning, by address, with their name. In a busy room
+# most of them are not cubes, so the table is bounded: the least recently
+# seen devices are dropped past MAX_SIZE, and devices not seen for EXPIRY
+# seconds are forgotten (and looked up again if they come back).
+#
+# Not thread-safe: callers that use it from several threads are responsible
+# for locking (the Linux scanner holds its devices_lock).
+class DeviceTable:
+    MAX_SIZE = 256
+    EXPIRY = 60
+
+    def __init__(self):
+        self.entries: OrderedDict = OrderedDict()
+
+    # Returns the entry of a device seen recently, marking it as seen now.
+    def get(self, address: str) -> Optional[DeviceEntry]:
+        entry = self.entries.get(address)
+        if entry is None:
+            return None
+        now = time.monotonic()
+        if now - entry.last_seen > self.EXPIRY:
+            del self.entries[address]
+            return None
+        entry.last_seen = now
+        self.entries.move_to_end(address)
+        return entry
+
+    def add(self, address: str, name: Optional[str]) -> DeviceEntry:
+        entry = self.entries[address] = DeviceEntry(name)
+        self.entries.move_to_end(address)
+        while len(self.entries) > self.MAX_SIZE:
+            self.entries.popitem(last=False)
+        return entry
+
+    # Makes cubes found by a previous scan be reported again. Names stay
+    # cached.
+    def clear_reported(self):
+        for entry in list(self.entries.values()):
+            entry.reported = False
+
+    def __len__(self):
+        return len(self.entries)
+
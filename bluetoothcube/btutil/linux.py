@@ -1,22 +1,24 @@
 import kivy
+import dbus
 import gatt
-from threading import Thread
+import time
+from threading import Lock, Thread
 
-from kivy.clock import Clock
-from kivy.app import App
+from kivy.clock import mainthread
 
-from bluetoothcube.btutil.const import (
-    CUBE_STATE_SERVICE, CUBE_STATE_RESPONSE,
-    CUBE_INFO_SERVICE, CUBE_INFO_REQUEST, CUBE_INFO_RESPONSE,
-    CUBE_INFO_REQUEST_COMMANDS)
-from ldb import ERR_OBJECT_CLASS_MODS_PROHIBITED
+from bluetoothcube import protocols
+from bluetoothcube.btutil.devicetable import DeviceTable
+from bluetoothcube.transport import CubeTransport, TransportError, settle
+
+from typing import Dict
 
 
 class DeviceInfo:
-    def __init__(self, address, name, manager):
+    def __init__(self, address, name, manager, protocol):
         self.address = address
         self.name = name
         self.manager = manager
+        self.protocol = protocol
 
 
 def sigint_handler(sig, frame):
@@ -27,25 +29,35 @@ def sigint_handler(sig, frame):
     kivy.base.stopTouchApp()
 
 
-# Searches for a bluetooth cube.
+# Searches for a bluetooth cube. The adapter only reports devices advertising
+# the cube state service, and devices are recognized from the properties BlueZ
+# signals carry, so only devices not seen recently cost a D-Bus call (for
+# their name).
 class BluetoothCubeScanner(kivy.event.EventDispatcher, gatt.DeviceManager):
     def __init__(self):
         self.register_event_type('on_cube_found')
         self.register_event_type('on_paired_cube_found')
         super().__init__(adapter_name='hci0')
         self._main_loop = None
-        self.devices_found = set()
+        # Known devices are checked from the Kivy thread, new ones from the
+        # GLib thread.
+        self.devices_lock = Lock()
+        self.devices_found = DeviceTable()
 
         self.prepare_run()
 
     def prepare_run(self):
         """
         Similar to gatt.DeviceManager.run, a custom implementation that does
-        not block, but schedules the gobject main_look within kivy's main loop.
+        not block, but runs the gobject main loop in a thread of its own.
+        D-Bus callbacks run there as soon as messages arrive, and hand their
+        results over to kivy's main loop.
         """
         if self._main_loop:
             return  # Already prepared.
 
+        # The gatt module already enabled dbus thread support
+        # (dbus.mainloop.glib.threads_init()) when it was imported.
         import dbus
         from gi.repository import GObject
 
@@ -62,50 +74,84 @@ class BluetoothCubeScanner(kivy.event.EventDispatcher, gatt.DeviceManager):
             path_keyword='path')
 
         self._main_loop = GObject.MainLoop()
-        self._main_loop_context = self._main_loop.get_context()
 
         # The GObject loop would eat up our keyboard interrupts, so we rebind
         # SIGINT to the default handler.
         import signal
         signal.signal(signal.SIGINT, sigint_handler)
 
-        # schedule the iteration each frame
-        self._main_loop_schedule = Clock.schedule_interval(
-            self._gobject_iteration, 0)
-
-    def _gobject_iteration(self, td):
-        loop = 0
-        while self._main_loop_context.pending() and loop < 10:
-            self._main_loop_context.iteration(False)
-            loop += 1
+        self._main_loop_thread = Thread(
+            target=self._main_loop.run, name="GLib main loop", daemon=True)
+        self._main_loop_thread.start()
 
     def scan(self):
-        self.devices_found = set()
+        with self.devices_lock:
+            self.devices_found.clear_reported()
 
-        # Check for already known devices.
-        for device in self.devices():
-            self.device_discovered(device)
+        # Check for already known devices, all in one D-Bus call.
+        for path, interfaces in self._object_manager.GetManagedObjects(
+                ).items():
+            properties = interfaces.get('org.bluez.Device1')
+            if properties is not None:
+                self.device_seen(path, properties)
 
         # Await new devices.
-        self.start_discovery()
+        self.start_discovery(service_uuids=protocols.advertised_services())
 
     def stop_scan(self):
         self.stop_discovery()
 
-    def device_discovered(self, device):
-        if device.mac_address in self.devices_found:
+    # Signal handlers of gatt.DeviceManager, called from the GLib thread.
+    # Unlike gatt's, they use the properties the signals carry.
+    def _interfaces_added(self, path, interfaces):
+        properties = interfaces.get('org.bluez.Device1')
+        if properties is not None:
+            self.device_seen(path, properties)
+
+    def _properties_changed(self, interface, changed, invalidated, path):
+        self.device_seen(path, changed)
+
+    # `properties` holds some or all of the org.bluez.Device1 properties.
+    def device_seen(self, path, properties):
+        address = self._mac_address(path)
+        if not address:
             return
-        self.devices_found.add(device.mac_address)
-
-        name = device.alias()
-        print(f"Device found: {name}")
-        # TODO: Refactor this condition into a shared file
-        if name and (name.startswith("Gi")):
-            di = DeviceInfo(device.mac_address, name, self)
-            if device.is_connected():
-                self.dispatch('on_paired_cube_found', di)
-            else:
-                self.dispatch('on_cube_found', di)
+
+        name = properties.get('Alias', properties.get('Name'))
+        with self.devices_lock:
+            entry = self.devices_found.get(address)
+            if entry is None:
+                if name is None:
+                    # Property changes (RSSI mostly) of a device not seen
+                    # before only carry what changed.
+                    device = (self._devices.get(address) or
+                              self.make_device(address))
+                    name = device.alias()
+                entry = self.devices_found.add(
+                    address, str(name) if name else None)
+            elif name is not None:
+                entry.name = str(name)
+            if not entry.protocol:
+                entry.protocol = protocols.match(
+                    entry.name, properties.get('UUIDs', ()))
+            if entry.reported or not entry.protocol:
+                return
+            entry.reported = True
+
+        connected = properties.get('Connected')
+        if connected is None:
+            device = self._devices.get(address) or self.make_device(address)
+            connected = device.is_connected()
+        print(f"Device found: {entry.name}")
+        self.cube_found(DeviceInfo(address, entry.name, self, entry.protocol),
+                        bool(connected))
+
+    @mainthread
+    def cube_found(self, deviceinfo, connected):
+        if connected:
+            self.dispatch('on_paired_cube_found', deviceinfo)
+        else:
+            self.dispatch('on_cube_found', deviceinfo)
 
     def on_cube_found(self, deviceinfo):
         pass
@@ -114,81 +160,86 @@ class BluetoothCubeScanner(kivy.event.EventDispatcher, gatt.DeviceManager):
         pass
 
 
-class BluetoothCubeConnection(gatt.Device, kivy.event.EventDispatcher):
-    def __init__(self, deviceinfo):
-        self.register_event_type('on_cube_connecting')
-        self.register_event_type('on_cube_connecting_failed')
-        self.register_event_type('on_cube_connected')
-        self.register_event_type('on_cube_disconnected')
-        self.register_event_type('on_state_updated')
+# D-Bus object paths of the characteristics of cubes connected before, by
+# address and characteristic UUID. BlueZ keeps them across connections, so
+# reconnecting can skip walking services and characteristics.
+characteristic_paths: Dict[str, Dict[str, str]] = {}
 
-        kivy.event.EventDispatcher.__init__(self)
-        gatt.Device.__init__(self, deviceinfo.address, deviceinfo.manager)
 
-    def connect(self):
-        # Again, we customize the connection procedure to make it more
-        # UI-friendly by splitting into parts.
-        self.dispatch('on_cube_connecting',
-                      f"Connecting to {self.alias()}...", 20)
+# Stands in for the gatt.Service of characteristics created from cached paths,
+# which only use it to reach the bus and the device.
+class CachedService:
+    def __init__(self, device):
+        self.device = device
+        self._bus = device._bus
+        self._object_manager = device._object_manager
+
 
+# Transport to a cube through BlueZ. Blocking D-Bus calls run in the event
+# loop's default executor; gatt callbacks arrive in the GLib thread and are
+# handed over to the event loop.
+class BluetoothCubeConnection(gatt.Device, CubeTransport):
+    def __init__(self, deviceinfo):
+        CubeTransport.__init__(self)
+        gatt.Device.__init__(self, deviceinfo.address, deviceinfo.manager)
+        self.name = deviceinfo.name
+        self.protocol = deviceinfo.protocol
+        self.resolved = None
+        self.notifying = None
+        self.cached_characteristics = []
+
+    async def connect(self):
+        self.resolved = self.loop.create_future()
+        self._connect_retry_attempt = 0
         self._connect_signals()
-        device = self  # Used by nested local class
-        if not self.is_connected():
-            class AsyncConnector(Thread):
-                def run(self):
-                    device._object.Connect()
-            # Request connection in a separate thread no to block UI.
-            AsyncConnector().start()
+        # Connect() blocks until the link is up. gatt reports errors with
+        # connect_failed(), and resolved services with services_resolved().
+        await self.loop.run_in_executor(None, self._connect)
+        await self.resolved
+
+    async def subscribe(self):
+        paths = characteristic_paths.get(self.mac_address)
+        if paths:
+            # D-Bus calls to set up the characteristics and their signals.
+            await self.loop.run_in_executor(
+                None, self.use_cached_characteristics, paths)
         else:
-            self.connect_succeeded()
-
-    def disconnect(self):
-        device = self
-        if self.is_connected():
-            class AsyncDisconnector(Thread):
-                def run(self):
-                    device._object.Disconnect()
-            # Request connection in a separate thread no to block UI.
-            AsyncDisconnector().start()
-
-    # Called when connection is successful.
-    def connect_succeeded(self):
-        super().connect_succeeded()
-        self.dispatch('on_cube_connecting',
-                      "Initializing cube...", 55)
-
-        # Maybe services were already resolved?
-        if not self.services and self.is_services_resolved():
-            self.services_resolved()
-
-    def disconnect_succeeded(self):
-        super().disconnect_succeeded()
-        print("Disconnected.")
-        self.dispatch('on_cube_disconnected')
+            self.find_characteristics()
+            characteristic_paths[self.mac_address] = {
+                ch.uuid: ch._path for ch in (
+                    self.state_response_characteristic,
+                    self.info_request_characteristic,
+                    self.info_response_characteristic)}
 
-    # Called when services get resolved.
-    def services_resolved(self):
-        super().services_resolved()
-        self.dispatch('on_cube_connecting',
-                      "Establishing communications...", 85)
-        self.enable_notifications()
-
-    def enable_notifications(self):
+        # Enable notifications
+        self.notifying = self.loop.create_future()
+        try:
+            await self.loop.run_in_executor(
+                None, self.enable_notifications,
+                self.state_response_characteristic)
+            await self.loop.run_in_executor(
+                None, self.enable_notifications,
+                self.info_response_characteristic)
+            await self.notifying
+        except TransportError:
+            # Maybe the cached paths are outdated. Next time, walk the
+            # services again.
+            characteristic_paths.pop(self.mac_address, None)
+            raise
+
+    def find_characteristics(self):
         # Find services
         self.cube_state_service = None
         self.cube_info_service = None
 
         for service in self.services:
-            if service.uuid == CUBE_STATE_SERVICE:
+            if service.uuid == self.protocol.service:
                 self.cube_state_service = service
-            if service.uuid == CUBE_INFO_SERVICE:
+            if service.uuid == self.protocol.info_service:
                 self.cube_info_service = service
 
         if not self.cube_state_service or not self.cube_info_service:
-            self.disconnect()
-            self.dispatch('on_cube_connecting_failed',
-                          "A cube service was not found.")
-            return
+            raise TransportError("A cube service was not found.")
 
         # Find characteristics
         self.state_response_characteristic = None
@@ -196,77 +247,109 @@ class BluetoothCubeConnection(gatt.Device, kivy.event.EventDispatcher):
         self.info_response_characteristic = None
 
         for ch in self.cube_state_service.characteristics:
-            if ch.uuid == CUBE_STATE_RESPONSE:
+            if ch.uuid == self.protocol.state_characteristic:
                 self.state_response_characteristic = ch
         for ch in self.cube_info_service.characteristics:
-            if ch.uuid == CUBE_INFO_REQUEST:
+            if ch.uuid == self.protocol.info_request:
                 self.info_request_characteristic = ch
-            if ch.uuid == CUBE_INFO_RESPONSE:
+            if ch.uuid == self.protocol.info_response:
                 self.info_response_characteristic = ch
 
         if not self.state_response_characteristic or \
            not self.info_request_characteristic or \
            not self.info_response_characteristic:
-            self.disconnect()
-            self.dispatch('on_cube_connecting_failed',
-                          "A characteristic is not available.")
-            return
+            raise TransportError("A characteristic is not available.")
+
+    def use_cached_characteristics(self, paths):
+        service = CachedService(self)
+        self.cached_characteristics = [
+            gatt.Characteristic(service, paths[uuid], uuid)
+            for uuid in (self.protocol.state_characteristic,
+                         self.protocol.info_request,
+                         self.protocol.info_response)]
+        for ch in self.cached_characteristics:
+            ch._connect_signals()
+        (self.state_response_characteristic,
+         self.info_request_characteristic,
+         self.info_response_characteristic) = self.cached_characteristics
+
+    # Like gatt.Characteristic.enable_notifications(), except that a
+    # characteristic already notifying (e.g. left so by a previous connection)
+    # counts as a success: gatt ignores that error without any callback.
+    def enable_notifications(self, characteristic):
+        def failed(error):
+            if error.get_dbus_name() == 'org.bluez.Error.Failed' and \
+               error.get_dbus_message() == "Already notifying":
+                characteristic._enable_notifications_succeeded()
+            else:
+                characteristic._enable_notifications_failed(error)
+
+        try:
+            characteristic._object.StartNotify(
+                reply_handler=characteristic._enable_notifications_succeeded,
+                error_handler=failed,
+                dbus_interface='org.bluez.GattCharacteristic1')
+        except dbus.exceptions.DBusException as e:
+            raise TransportError(f"Failed to enable notifications: {e}")
+
+    async def write(self, data):
+        await self.loop.run_in_executor(
+            None, self.info_request_characteristic.write_value, data)
+
+    async def disconnect(self):
+        try:
+            if await self.loop.run_in_executor(None, self.is_connected):
+                await self.loop.run_in_executor(
+                    None, self._object.Disconnect)
+        except dbus.exceptions.DBusException as e:
+            raise TransportError(f"Failed to disconnect: {e}")
+        finally:
+            # Whatever happened, no more frames will be delivered.
+            self.closed()
+
+    async def reset_cube(self):
+        await self.send_command(self.protocol.commands['RESET_SOLVED'])
+
+    # Hands a result over to a future of the event loop.
+    def settle_threadsafe(self, future, error=None):
+        self.loop.call_soon_threadsafe(settle, future, error)
+
+    # gatt callbacks below are called from the GLib thread, or from the
+    # executor while connecting.
+
+    def connect_failed(self, error):
+        super().connect_failed(error)
+        self.settle_threadsafe(self.resolved, TransportError(str(error)))
 
-        # Enable notifications
-        self.state_response_characteristic.enable_notifications()
-        self.info_response_characteristic.enable_notifications()
+    def disconnect_succeeded(self):
+        super().disconnect_succeeded()
+        for ch in self.cached_characteristics:
+            ch._disconnect_signals()
+        self.cached_characteristics = []
+        self.settle_threadsafe(
+            self.resolved, TransportError("Connection lost."))
+        self.closed()
 
-        self.dispatch('on_cube_connected')
+    def services_resolved(self):
+        # Walking the services takes D-Bus round trips for every service,
+        # which are not needed when characteristic paths are known.
+        if self.mac_address not in characteristic_paths:
+            super().services_resolved()
+        self.settle_threadsafe(self.resolved)
+
+    def characteristic_enable_notifications_succeeded(self, characteristic):
+        if characteristic.uuid == self.protocol.state_characteristic:
+            self.settle_threadsafe(self.notifying)
+
+    def characteristic_enable_notifications_failed(self, characteristic,
+                                                   error):
+        if characteristic.uuid == self.protocol.state_characteristic:
+            self.settle_threadsafe(self.notifying, TransportError(
+                "Failed to enable state notifications."))
 
-    # Called when characteristic values change.
     def characteristic_value_updated(self, characteristic, value):
-        if characteristic.uuid == CUBE_STATE_RESPONSE:
-            # Dispatch the event from the main event loop, instead of dbus
-            # handler to ensure proper error handling.
-            if value[18] == 0xa7:
-                bla=""
-                key = [176, 81, 104, 224, 86, 137, 237, 119, 38, 26, 193, 161, 210, 126, 150, 81, 93, 13, 236, 249, 89, 235, 88, 24, 113, 81, 214, 131, 130, 199, 2, 169, 39, 165, 171, 41]
-                k = value[19]
-                k1 = k >> 4 & 0xf;
-                k2 = k & 0xf;
-                for i in range(0,len(value)-2):
-                    move = (value[i] + key[i + k1] + key[i + k2]) & 0xff;
-                    bla+="{0:02x}".format(move)
-                value=bytes.fromhex(bla)
-
-            Clock.schedule_once(
-                lambda td: self.dispatch('on_state_updated', value))
+        if characteristic.uuid == self.protocol.state_characteristic:
+            # Moment the notification arrived, before any UI latency.
+            self.frame_received(value, time.perf_counter_ns())
         else:
             print(f"Characteristic {characteristic.uuid} changed to {value}")
-
-    def send_command(self, command):
-        # TODO: At the moment this method only supports single-byte commands.
-        buffer = [0] * 17
-        buffer[0] = command
-        self.info_request_characteristic.write_value(bytes(buffer))
-
-    def reset_cube(self):
-        self.send_command(CUBE_INFO_REQUEST_COMMANDS['RESET_SOLVED'])
-
-    # The usual way of using a gatt.Device is to subclass it and override some
-    # methods. However, since this class is an EventDispatcher so that widgets
-    # can bind to it even before connection is made, we cannot enable the
-    # connection in class' constructor. So we have to hook to the Device using
-    # another way.
-    def _install_callbacks(self):
-        pass
-
-    def on_cube_connecting(self, *args):
-        pass
-
-    def on_cube_connecting_failed(self, *args):
-        pass
-
-    def on_cube_connected(self, *args):
-        pass
-
-    def on_cube_disconnected(self, *args):
-        pass
-
-    def on_state_updated(self, *args):
-        pass
@@ -1,7 +1,14 @@
+import sys
 import json
+import argparse
 import datetime
+import tempfile
+import tracemalloc
 
-from bluetoothcube.utils import datetime_from_isoformat
+from time import perf_counter
+
+from bluetoothcube.utils import (
+    datetime_from_isoformat, datetime_to_epoch, datetime_from_epoch)
 
 
 # Function for upgrading time metadata format between releases.
@@ -18,11 +25,21 @@ def correct_meta(meta):
 
 
 class Time:
-    def __init__(self, time, meta=None):
+    # Histories can hold a lot of times, so keep instances small: no __dict__,
+    # the timestamp as a POSIX timestamp (naive UTC) instead of a datetime,
+    # and metadata kept as the raw JSON string until it is first accessed.
+    __slots__ = ('time', 'dnf', 'p2', 'epoch', '_meta', '_raw_meta')
+
+    def __init__(self, time, meta=None, ts=None, epoch=None, raw_meta=None):
         self.dnf = False
         self.p2 = False
-        self.meta = meta
-        self.ts = datetime.datetime.utcnow()
+        self._meta = meta
+        self._raw_meta = raw_meta
+        if epoch is not None:
+            self.epoch = epoch
+        else:
+            self.epoch = datetime_to_epoch(
+                ts if ts else datetime.datetime.utcnow())
         if isinstance(time, float):
             self.time = time
         elif time == 'DNF':
@@ -30,8 +47,8 @@ class Time:
         elif isinstance(time, str):
             # Parse from string.
             ts, time, rest = time.split('|', 2)
-            meta = json.loads(rest)
-            self.ts = datetime_from_isoformat(ts)
+            self._raw_meta = rest
+            self.epoch = datetime_to_epoch(datetime_from_isoformat(ts))
             if time == 'DNF':
                 self.time = None
             else:
@@ -39,16 +56,40 @@ class Time:
                     self.p2 = True
                     time = time[:-1]
                 self.time = float(time)
-
-            # TODO: Mark file versions and only use this procedure when loading
-            # an old file version.
-            self.meta = correct_meta(meta)
         else:
             print(f"ERROR: Invalid time {str(time)}")
 
         if self.time is None:
             self.dnf = True
 
+    @property
+    def ts(self) -> datetime.datetime:
+        return datetime_from_epoch(self.epoch)
+
+    @ts.setter
+    def ts(self, ts: datetime.datetime):
+        self.epoch = datetime_to_epoch(ts)
+
+    @property
+    def meta(self):
+        if self._raw_meta is not None:
+            # TODO: Mark file versions and only use this procedure when loading
+            # an old file version.
+            self._meta = correct_meta(json.loads(self._raw_meta))
+            self._raw_meta = None
+        return self._meta
+
+    @meta.setter
+    def meta(self, meta):
+        self._meta = meta
+        self._raw_meta = None
+
+    # Metadata serialized to JSON, without decoding it if it was never used.
+    def save_meta(self) -> str:
+        if self._raw_meta is not None:
+            return self._raw_meta
+        return json.dumps(self._meta)
+
     def is_dnf(self) -> bool:
         return self.dnf
 
@@ -70,6 +111,24 @@ class Time:
         else:
             self.time -= 2
 
+    def get_state(self) -> str:
+        if self.dnf:
+            return 'DNF'
+        return '+2' if self.p2 else 'OK'
+
+    # Penalty state serialization used by the time journal. Unlike str(), this
+    # keeps the measured time of DNF solves, and it restores the exact state
+    # regardless of what penalties were applied before.
+    def save_penalty(self) -> str:
+        time = 'DNF' if self.time is None else repr(self.time)
+        return f"{time}|{self.get_state()}"
+
+    def load_penalty(self, penalty: str):
+        time, state = penalty.split('|')
+        self.time = None if time == 'DNF' else float(time)
+        self.p2 = state == '+2'
+        self.dnf = state == 'DNF' or self.time is None
+
     def __eq__(self, other):
         if self.dnf:
             return other.dnf
@@ -96,4 +155,44 @@ class Time:
 
     def save(self) -> str:
         return (self.ts.isoformat() + "|" + str(self) + "|" +
-                json.dumps(self.meta))
+                self.save_meta())
+
+
+# Measures parsing times.txt lines into Time objects (best of `repeat`), and
+# the memory they take once parsed, as measured by tracemalloc.
+def benchmark(count: int, repeat: int):
+    from bluetoothcube.timestore import write_synthetic_history
+
+    with tempfile.NamedTemporaryFile('r', suffix='.txt') as f:
+        write_synthetic_history(f.name, count)
+        lines = [line.strip() for line in f]
+
+    best = None
+    for _ in range(repeat):
+        start = perf_counter()
+        times = [Time(line) for line in lines]
+        elapsed = perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    del times
+
+    tracemalloc.start()
+    times = [Time(line) for line in lines]
+    size, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    assert len(times) == count
+
+    print(f"{count} times parsed in {best:.3f} s, "
+          f"{size / count:.0f} B per time")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Benchmark parsing and storing times.")
+    parser.add_argument('--count', type=int, default=100000)
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args(argv)
+    benchmark(args.count, args.repeat)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,307 @@
+import colorsys
+import math
+
+from kivy.app import App
+from kivy.clock import Clock
+from kivy.uix.widget import Widget
+from kivy.graphics import (
+    Callback, ClearBuffers, ClearColor, Fbo, Mesh, PopMatrix, PushMatrix,
+    Rectangle, Rotate)
+from kivy.graphics.opengl import glDisable, glEnable, GL_DEPTH_TEST
+from kivy.graphics.transformation import Matrix
+
+from bluetoothcube.cubedisplay import STICKER_HSV
+from bluetoothcube.latency import traced
+
+from typing import List, Optional, Tuple
+
+# 3D view of the cube, which animates every turn reported by the cube.
+#
+# Cubies sit at integer coordinates from -1 to 1: x to the right, y up, z to
+# the front. Each cubie is a mesh built once, drawn with a rotation of its
+# own, so turning a face only changes the angle of the rotations of its nine
+# cubies. Sticker colors show the state at the start of the turn in progress,
+# and are updated when it ends.
+
+Vector3 = Tuple[int, int, int]
+
+# Outward normal, then right and down directions of each face as seen from
+# outside, with the up face (or front face, for U and D) the usual way up.
+# Facelets of a face are numbered row by row from the top, as in FaceCube.
+FACE_AXES = {
+    'U': ((0, 1, 0), (1, 0, 0), (0, 0, 1)),
+    'R': ((1, 0, 0), (0, 0, -1), (0, -1, 0)),
+    'F': ((0, 0, 1), (1, 0, 0), (0, -1, 0)),
+    'D': ((0, -1, 0), (1, 0, 0), (0, 0, -1)),
+    'L': ((-1, 0, 0), (0, 0, 1), (0, -1, 0)),
+    'B': ((0, 0, -1), (-1, 0, 0), (0, -1, 0)),
+}
+FACES = "URFDLB"
+
+# Half sizes of a cubie body and of its stickers, and how far stickers stand
+# out of the cube center.
+BODY_SIZE = 0.48
+STICKER_SIZE = 0.42
+STICKER_OFFSET = 0.49
+
+BODY_COLOR = (0.08, 0.08, 0.08)
+STICKER_RGB = [colorsys.hsv_to_rgb(*hsv) for hsv in STICKER_HSV]
+
+VERTEX_FORMAT = [(b'v_pos', 3, 'float'), (b'v_color', 3, 'float')]
+VERTEX_SIZE = 6
+
+SHADER_VS = '''
+#ifdef GL_ES
+    precision highp float;
+#endif
+attribute vec3 v_pos;
+attribute vec3 v_color;
+uniform mat4 modelview_mat;
+uniform mat4 projection_mat;
+varying vec3 frag_color;
+
+void main(void) {
+    frag_color = v_color;
+    gl_Position = projection_mat * modelview_mat * vec4(v_pos, 1.0);
+}
+'''
+
+SHADER_FS = '''
+#ifdef GL_ES
+    precision highp float;
+#endif
+varying vec3 frag_color;
+
+void main(void) {
+    gl_FragColor = vec4(frag_color, 1.0);
+}
+'''
+
+
+def add(*vectors) -> Tuple[float, ...]:
+    return tuple(sum(c) for c in zip(*vectors))
+
+
+def scale(v, k: float) -> Tuple[float, ...]:
+    return tuple(c * k for c in v)
+
+
+def dot(a, b) -> float:
+    return sum(x * y for x, y in zip(a, b))
+
+
+# Vertices of a square facing `normal`, `offset` away from `center`.
+def square(center, axes, offset: float, size: float, color) -> List[float]:
+    normal, right, down = axes
+    middle = add(center, scale(normal, offset))
+    vertices: List[float] = []
+    for r, d in ((-1, -1), (1, -1), (1, 1), (-1, 1)):
+        vertices += add(middle, scale(right, r * size), scale(down, d * size))
+        vertices += color
+    return vertices
+
+
+class Cubie:
+    def __init__(self, position: Vector3):
+        self.position = position
+        # (facelet index, index of its first vertex) of each sticker.
+        self.stickers: List[Tuple[int, int]] = []
+
+        self.vertices: List[float] = []
+        for face in FACES:
+            self.vertices += square(position, FACE_AXES[face], BODY_SIZE,
+                                    BODY_SIZE, BODY_COLOR)
+        for f, face in enumerate(FACES):
+            normal, right, down = FACE_AXES[face]
+            if dot(position, normal) != 1:
+                continue
+            # Row and column of the facelet on its face.
+            row = round(dot(position, down)) + 1
+            col = round(dot(position, right)) + 1
+            self.stickers.append(
+                (f * 9 + row * 3 + col, len(self.vertices) // VERTEX_SIZE))
+            self.vertices += square(position, FACE_AXES[face],
+                                    STICKER_OFFSET, STICKER_SIZE, BODY_COLOR)
+        indices: List[int] = []
+        for q in range(0, len(self.vertices) // VERTEX_SIZE, 4):
+            indices += (q, q + 1, q + 2, q, q + 2, q + 3)
+
+        self.rotate = Rotate(angle=0, axis=(0, 0, 1))
+        self.mesh = Mesh(vertices=self.vertices, indices=indices,
+                         fmt=VERTEX_FORMAT, mode='triangles')
+
+    def in_layer(self, face: str) -> bool:
+        return dot(self.position, FACE_AXES[face][0]) == 1
+
+    # Updates the sticker colors of `facelets` (FaceCube.f) that changed
+    # since `shown`.
+    def set_colors(self, facelets: List[int], shown: List[int]):
+        changed = False
+        for facelet, vertex in self.stickers:
+            if facelets[facelet] == shown[facelet]:
+                continue
+            changed = True
+            color = STICKER_RGB[facelets[facelet]]
+            for v in range(vertex, vertex + 4):
+                i = v * VERTEX_SIZE + 3
+                self.vertices[i:i + 3] = color
+        if changed:
+            self.mesh.vertices = self.vertices
+
+
+# A face turn being animated, angles in degrees around the face normal.
+class Turn:
+    def __init__(self, face: str, target: float):
+        self.face = face
+        self.angle = 0.0
+        self.target = target
+        # Cube state once the turn is done.
+        self.after = None
+
+
+class Cube3DDisplay(Widget):
+    # Seconds a quarter turn takes.
+    TURN_DURATION = 0.12
+
+    # Distance from the camera to the cube center, and view angles.
+    VIEW_DISTANCE = 9
+    VIEW_PITCH = 30
+    VIEW_YAW = -35
+
+    def __init__(self, **kwargs):
+        self.fbo = Fbo(size=(1, 1), with_depthbuffer=True,
+                       vs=SHADER_VS, fs=SHADER_FS)
+        super().__init__(**kwargs)
+
+        self.cubies = [Cubie((x, y, z))
+                       for x in (-1, 0, 1) for y in (-1, 0, 1)
+                       for z in (-1, 0, 1) if (x, y, z) != (0, 0, 0)]
+        # Cubies turning with each face.
+        self.layers = {face: [c for c in self.cubies if c.in_layer(face)]
+                       for face in FACES}
+        with self.fbo:
+            ClearColor(0, 0, 0, 0)
+            ClearBuffers(clear_depth=True)
+            Callback(lambda instr: glEnable(GL_DEPTH_TEST))
+            for cubie in self.cubies:
+                PushMatrix()
+                self.fbo.add(cubie.rotate)
+                self.fbo.add(cubie.mesh)
+                PopMatrix()
+            Callback(lambda instr: glDisable(GL_DEPTH_TEST))
+        self.fbo['modelview_mat'] = (
+            Matrix().rotate(math.radians(self.VIEW_YAW), 0, 1, 0)
+            .rotate(math.radians(self.VIEW_PITCH), 1, 0, 0)
+            .translate(0, 0, -self.VIEW_DISTANCE))
+
+        with self.canvas:
+            self.rect = Rectangle(texture=self.fbo.texture)
+        self.bind(pos=self.update_rect, size=self.update_rect)
+        self.update_rect()
+
+        # Facelets the stickers show, -1 before the first state.
+        self.shown_facelets = [-1] * 54
+        self.turn: Optional[Turn] = None
+        # (face, angle, state after the move) of moves not animated yet.
+        self.pending: List[tuple] = []
+        self.process_moves_trigger = Clock.create_trigger(
+            lambda td: self.process_moves())
+        self.animation = None
+
+        cube = App.get_running_app().cube
+        self.latest_state = cube.cube_state
+        self.show(cube.cube_state)
+        cube.bind(on_move_raw=self.on_move_raw,
+                  on_display_state_changed=traced(
+                      'Cube3DDisplay', self.on_cube_state_changed))
+
+    def update_rect(self, *args):
+        size = (max(1, int(self.width)), max(1, int(self.height)))
+        self.fbo.size = size
+        aspect = size[0] / size[1]
+        # Fits the cube (5.2 across its diagonal) at VIEW_DISTANCE.
+        fov = 0.3 / min(1, aspect)
+        self.fbo['projection_mat'] = Matrix().view_clip(
+            -fov * aspect, fov * aspect, -fov, fov, 1, 100, 1)
+        self.rect.texture = self.fbo.texture
+        self.rect.pos = self.pos
+        self.rect.size = size
+
+    def show(self, state):
+        facelets = state.toFaceCube().f
+        for cubie in self.cubies:
+            cubie.set_colors(facelets, self.shown_facelets)
+        self.shown_facelets = list(facelets)
+
+    def on_cube_state_changed(self, cube, state):
+        self.latest_state = state
+        # States that do not come with a move (e.g. a reset). During a turn,
+        # they are shown once it ends.
+        if self.turn is None and not self.pending:
+            self.show(state)
+
+    def on_move_raw(self, cube, move):
+        turns = move.count if move.dir == "" else -move.count
+        # Clockwise, as seen from the face, is negative around its normal.
+        self.pending.append((move.face, -90 * turns, cube.cube_state))
+        self.process_moves_trigger()
+
+    # Runs once per frame with the moves received since the previous one.
+    # Only the last move is animated, and the view jumps to the state before
+    # it: turning faster than the animation never makes the view lag behind.
+    # Turns of the same face in a row make up a single animated turn.
+    def process_moves(self):
+        pending, self.pending = self.pending, []
+        if not pending:
+            return
+        face, angle, after = pending[-1]
+        first = len(pending) - 1
+        while first > 0 and pending[first - 1][0] == face:
+            first -= 1
+            angle += pending[first][1]
+
+        turn = self.turn
+        if turn and first == 0 and turn.face == face and \
+           abs(turn.target + angle - turn.angle) <= 180:
+            turn.target += angle
+            turn.after = after
+            return
+
+        # The view must not show the new moves yet.
+        self.finish_turn(turn.after if turn else None)
+        if first > 0:
+            self.show(pending[first - 1][2])
+        self.turn = Turn(face, angle)
+        self.turn.after = after
+        for cubie in self.layers[face]:
+            cubie.rotate.axis = FACE_AXES[face][0]
+        if self.animation is None:
+            self.animation = Clock.schedule_interval(self.animate, 0)
+
+    def animate(self, dt):
+        turn = self.turn
+        if turn is None:
+            self.animation.cancel()
+            self.animation = None
+            return
+        step = 90 / self.TURN_DURATION * dt
+        if abs(turn.target - turn.angle) <= step:
+            self.finish_turn()
+            return
+        turn.angle += math.copysign(step, turn.target - turn.angle)
+        for cubie in self.layers[turn.face]:
+            cubie.rotate.angle = turn.angle
+
+    # Ends the turn in progress, showing `state`. By default, that is the
+    # latest state, which includes changes that came without a move during
+    # the turn, unless moves are pending: then it is ahead of the turn.
+    def finish_turn(self, state=None):
+        turn = self.turn
+        if turn is None:
+            return
+        self.turn = None
+        for cubie in self.layers[turn.face]:
+            cubie.rotate.angle = 0
+        if state is None:
+            state = turn.after if self.pending else self.latest_state
+        self.show(state)
@@ -10,6 +10,10 @@ from kivy.graphics.context_instructions import Color
 
 from kociemba.pykociemba.facecube import FaceCube
 
+from bluetoothcube.latency import traced
+
+from typing import List
+
 
 STICKERS = {
     'green': [0.33, 0.6, 0.5],
@@ -28,74 +32,77 @@ STICKER_COLOR = {
 }
 
 
+# Color of every facelet value, as HSV.
+STICKER_HSV = [STICKERS[STICKER_COLOR[i]] for i in range(6)]
+
+# Position of each face in the unfolded cube, in face sizes, in facelet
+# order (URFDLB).
+FACE_POSITIONS = [(1, 2), (2, 1), (1, 1), (1, 0), (0, 1), (3, 1)]
+
+# Position of each facelet of a face, in sticker sizes, top row first.
+STICKER_POSITIONS = [(0, 2), (1, 2), (2, 2),
+                     (0, 1), (1, 1), (2, 1),
+                     (0, 0), (1, 0), (2, 0)]
+
+
+# Unfolded view of the cube. Its instructions are built once, and kept for
+# every sticker: layout changes move the rectangles, and state changes only
+# recolor the stickers that changed (at most 20 per move).
 class CubeDisplay(Widget):
     def __init__(self, **kwargs):
         super().__init__(**kwargs)
 
         self.face_state = FaceCube()
-        self.update_canvas()
+        # Facelets the sticker colors show.
+        self.shown_facelets: List[int] = list(self.face_state.f)
+        self.sticker_colors: List[Color] = []
+        self.sticker_rects: List[Rectangle] = []
+        with self.canvas:
+            for facelet in self.shown_facelets:
+                self.sticker_colors.append(Color(hsv=STICKER_HSV[facelet]))
+                self.sticker_rects.append(Rectangle())
+        self.update_rect()
 
         self.bind(pos=self.update_rect,
                   size=self.update_rect)
 
-        self.update_canvas_trigger = Clock.create_trigger(
-            lambda td: self.update_canvas())
+        self.update_canvas_trigger = Clock.create_trigger(traced(
+            'CubeDisplay canvas', lambda td: self.update_canvas()))
 
         App.get_running_app().cube.bind(
-            on_state_changed=self.on_cube_state_changed)
+            on_display_state_changed=traced(
+                'CubeDisplay', self.on_cube_state_changed))
 
     def update_rect(self, *args):
-        self.update_canvas()
+        pos = Vector(self.pos[:2])
+        if self.width * 3 > self.height * 4:
+            # Fill to height
+            area_size = Vector(4*self.height/3, self.height)
+            origin = pos + Vector((self.width - area_size[0])/2, 0)
+        else:
+            # Fill to width
+            area_size = Vector(self.width, 3*self.width/4)
+            origin = pos + Vector(0, (self.height - area_size[1])/2)
+
+        sticker_v = area_size / Vector(12, 9)
+        face_v = area_size / Vector(4, 3)
+        size = tuple(sticker_v)
+
+        rects = iter(self.sticker_rects)
+        for face in FACE_POSITIONS:
+            o = origin + face_v * face
+            for sticker in STICKER_POSITIONS:
+                rect = next(rects)
+                rect.pos = tuple(o + sticker_v * sticker)
+                rect.size = size
 
     def update_canvas(self):
-        self.canvas.clear()
-
-        # TODO: Maybe it's possible to recompute all coordinates without
-        # recreating the canvas. It may be a very complex task, though.
-
-        with self.canvas:
-            pos = Vector(self.pos[:2])
-            if self.width * 3 > self.height * 4:
-                # Fill to height
-                area_size = Vector(4*self.height/3, self.height)
-                origin = pos + Vector((self.width - area_size[0])/2, 0)
-            else:
-                # Fill to width
-                area_size = Vector(self.width, 3*self.width/4)
-                origin = pos + Vector(0, (self.height - area_size[1])/2)
-
-            sticker_v = area_size / Vector(12, 9)
-            face_v = area_size / Vector(4, 3)
-
-            def face(x, y):
-                return origin + face_v * (x, y)
-
-            def draw_face(o, n):
-                Color(hsv=STICKERS[STICKER_COLOR[self.face_state.f[n + 0]]])
-                Rectangle(pos=o+(sticker_v*(0, 2)), size=sticker_v)
-                Color(hsv=STICKERS[STICKER_COLOR[self.face_state.f[n + 1]]])
-                Rectangle(pos=o+(sticker_v*(1, 2)), size=sticker_v)
-                Color(hsv=STICKERS[STICKER_COLOR[self.face_state.f[n + 2]]])
-                Rectangle(pos=o+(sticker_v*(2, 2)), size=sticker_v)
-                Color(hsv=STICKERS[STICKER_COLOR[self.face_state.f[n + 3]]])
-                Rectangle(pos=o+(sticker_v*(0, 1)), size=sticker_v)
-                Color(hsv=STICKERS[STICKER_COLOR[self.face_state.f[n + 4]]])
-                Rectangle(pos=o+(sticker_v*(1, 1)), size=sticker_v)
-                Color(hsv=STICKERS[STICKER_COLOR[self.face_state.f[n + 5]]])
-                Rectangle(pos=o+(sticker_v*(2, 1)), size=sticker_v)
-                Color(hsv=STICKERS[STICKER_COLOR[self.face_state.f[n + 6]]])
-                Rectangle(pos=o+(sticker_v*(0, 0)), size=sticker_v)
-                Color(hsv=STICKERS[STICKER_COLOR[self.face_state.f[n + 7]]])
-                Rectangle(pos=o+(sticker_v*(1, 0)), size=sticker_v)
-                Color(hsv=STICKERS[STICKER_COLOR[self.face_state.f[n + 8]]])
-                Rectangle(pos=o+(sticker_v*(2, 0)), size=sticker_v)
-
-            draw_face(face(1, 2), 0 * 9)  # U
-            draw_face(face(2, 1), 1 * 9)  # R
-            draw_face(face(1, 1), 2 * 9)  # F
-            draw_face(face(1, 0), 3 * 9)  # D
-            draw_face(face(0, 1), 4 * 9)  # L
-            draw_face(face(3, 1), 5 * 9)  # B
+        facelets = self.face_state.f
+        shown = self.shown_facelets
+        for i, facelet in enumerate(facelets):
+            if facelet != shown[i]:
+                self.sticker_colors[i].hsv = STICKER_HSV[facelet]
+                shown[i] = facelet
 
     def on_cube_state_changed(self, cube, newstate):
         self.face_state = newstate.toFaceCube()
@@ -1,8 +1,9 @@
 import kociemba.pykociemba as kociemba
 from kociemba.pykociemba.cubiecube import CubieCube as KCubieCube
+from kociemba.pykociemba.cubiecube import moveCube
 from kociemba.pykociemba.facecube import FaceCube as KFaceCube
 
-from typing import List
+from typing import Dict, List
 
 # CPP permutation transforms corners from giiker coords to kociemba
 # coords. ICPP is the inverse permutation
@@ -48,6 +49,12 @@ EOK = ['UR', 'UF', 'UL', 'UB',
 MOVES_GIIKER_TO_KOCIEMBA = [None, 5, 3, 4, 0, 1, 2]
 
 
+# Move codes are what protocols report moves as: the face in kociemba order
+# (URFDLB) and the number of clockwise quarter turns (1, 2 or 3).
+def move_code(face: int, turns: int) -> int:
+    return face << 2 | turns
+
+
 # Extend CubieCube implementation with our custom mechanisms.
 class CubieCube(KCubieCube):
     def __init__(self, **kwargs):
@@ -123,6 +130,44 @@ class CubieCube(KCubieCube):
             # Use standard constructor
             super().__init__(**kwargs)
 
+    # Inverse of the giiker_state constructor argument: the 16 bytes of
+    # pieces and orientations of a Giiker state frame.
+    def to_giiker_state(self) -> bytes:
+        gcp = [0] * 8
+        gco = [0] * 8
+        gep = [0] * 12
+        geo = [0] * 12
+
+        for slot in range(0, 8):
+            cubie = self.cp[slot]
+            gcp[CPP[slot]] = CPP[cubie]
+
+            # Go from w/y sticker back to g/b sticker, then find the giiker
+            # orientation of that sticker. Giiker reports 3 for 0.
+            gb_index = (self.co[slot] - CT[cubie]) % 3
+            gb_direction = COK[slot][gb_index]
+            gco[CPP[slot]] = COG[slot].index(gb_direction) or 3
+
+        for slot in range(0, 12):
+            cubie = self.ep[slot]
+            gep[EPP[slot]] = EPP[cubie]
+
+            bgwy_index = (self.eo[slot] - ET[cubie]) % 2
+            bgwy_direction = EOK[slot][bgwy_index]
+            geo[EPP[slot]] = EOG[slot].index(bgwy_direction)
+
+        nibbles = ([p + 1 for p in gcp] + gco + [p + 1 for p in gep])
+        state = [nibbles[i] << 4 | nibbles[i + 1]
+                 for i in range(0, len(nibbles), 2)]
+        flips = sum(bit << (11 - i) for i, bit in enumerate(geo))
+        return bytes(state + [flips >> 4, (flips & 0xF) << 4])
+
+    # A copy of this state with a move applied.
+    def moved(self, code: int) -> 'CubieCube':
+        result = CubieCube(cp=self.cp, co=self.co, ep=self.ep, eo=self.eo)
+        result.multiply(MOVE_CUBES[code])
+        return result
+
     def __eq__(self, other):
         return (self.cp == other.cp and self.co == other.co and
                 self.ep == other.ep and self.eo == other.eo)
@@ -145,6 +190,19 @@ class CubieCube(KCubieCube):
         return FaceCube(facecube.f)
 
 
+def turned(move: KCubieCube, turns: int) -> CubieCube:
+    result = CubieCube()
+    for _ in range(turns):
+        result.multiply(move)
+    return result
+
+
+# Cube of every move code.
+MOVE_CUBES: Dict[int, CubieCube] = {
+    move_code(face, turns): turned(move, turns)
+    for face, move in enumerate(moveCube) for turns in (1, 2, 3)}
+
+
 class FaceCube(KFaceCube):
     SOLVED_PATTERN = "U"*9 + "L"*9 + "F"*9 + "R"*9 + "B"*9 + "D"*9
 
@@ -0,0 +1,187 @@
+import os
+import sys
+import time
+import asyncio
+import argparse
+
+# Command line arguments are for the replayer, not for Kivy.
+if __name__ == '__main__':
+    os.environ.setdefault('KIVY_NO_ARGS', '1')
+
+from bluetoothcube.transport import CubeTransport
+
+from typing import Iterator, Optional, Tuple
+
+# Recording and replay of the raw frames received from a cube.
+#
+# A frame log is append-only: MAGIC, then records of
+#   varint  microseconds since the previous record
+#   varint  frame length
+#   bytes   raw frame
+# varints being unsigned LEB128. A record of length 0 starts a segment (a
+# recording session); its time field holds the wall clock time instead, in
+# microseconds since the epoch. A Giiker frame takes 23-25 bytes.
+
+MAGIC = b'BCFL\x01'
+
+# Records are written in batches, at least this often.
+FLUSH_SIZE = 4096
+FLUSH_INTERVAL = 1000000  # microseconds
+
+
+def encode_varint(buffer: bytearray, n: int):
+    while n >= 0x80:
+        buffer.append(n & 0x7f | 0x80)
+        n >>= 7
+    buffer.append(n)
+
+
+def decode_varint(data: bytes, pos: int) -> Tuple[int, int]:
+    n = shift = 0
+    while True:
+        b = data[pos]
+        pos += 1
+        n |= (b & 0x7f) << shift
+        if b < 0x80:
+            return n, pos
+        shift += 7
+
+
+# Appends the frames a transport receives (see CubeTransport.recorder) to a
+# frame log. Runs on the event loop.
+class FrameRecorder:
+    def __init__(self, path: str):
+        self.path = path
+        self.buffer = bytearray()
+        if not os.path.exists(path) or os.path.getsize(path) == 0:
+            self.buffer += MAGIC
+        encode_varint(self.buffer, time.time_ns() // 1000)
+        encode_varint(self.buffer, 0)
+        # Microsecond timestamps (time.perf_counter_ns() // 1000).
+        self.last = self.last_flush = time.perf_counter_ns() // 1000
+        self.count = 0
+
+    def record(self, value: bytes, timestamp: int):
+        t = timestamp // 1000
+        encode_varint(self.buffer, max(0, t - self.last))
+        encode_varint(self.buffer, len(value))
+        self.buffer += value
+        self.last = max(self.last, t)
+        self.count += 1
+        if (len(self.buffer) >= FLUSH_SIZE or
+                t - self.last_flush >= FLUSH_INTERVAL):
+            self.flush()
+
+    def flush(self):
+        self.last_flush = self.last
+        if not self.buffer:
+            return
+        with open(self.path, 'ab') as f:
+            f.write(self.buffer)
+        self.buffer = bytearray()
+
+
+# Yields (segment start as epoch microseconds, microseconds since the segment
+# start, frame) for all frames of a log.
+def read_log(path: str) -> Iterator[Tuple[int, int, bytes]]:
+    with open(path, 'rb') as f:
+        data = f.read()
+    if not data.startswith(MAGIC):
+        raise ValueError(f"{path} is not a frame log")
+    pos = len(MAGIC)
+    segment = offset = 0
+    while pos < len(data):
+        try:
+            t, pos = decode_varint(data, pos)
+            length, pos = decode_varint(data, pos)
+        except IndexError:
+            # Truncated by a crash while writing.
+            return
+        if length == 0:
+            segment, offset = t, 0
+            continue
+        offset += t
+        frame = data[pos:pos + length]
+        pos += length
+        if len(frame) < length:
+            return
+        yield segment, offset, frame
+
+
+# Transport that plays a frame log back through the same path as frames of a
+# real cube. Segments are played one after another. `speed` scales the pace,
+# 0 plays as fast as the consumer allows.
+#
+# Frames keep their original spacing in timestamps whatever the speed, so
+# solve and stage times come out as recorded.
+class ReplayConnection(CubeTransport):
+    def __init__(self, path: str, speed: float = 1.0,
+                 disconnect_when_done=False):
+        super().__init__()
+        self.name = os.path.basename(path)
+        self.path = path
+        self.speed = speed
+        self.disconnect_when_done = disconnect_when_done
+        self.player: Optional[asyncio.Task] = None
+        self.sent = 0
+
+    async def connect(self):
+        pass
+
+    async def subscribe(self):
+        self.player = self.loop.create_task(self.play())
+
+    async def write(self, data):
+        pass
+
+    async def disconnect(self):
+        if self.player:
+            self.player.cancel()
+            self.player = None
+        self.closed()
+
+    async def reset_cube(self):
+        pass
+
+    async def play(self):
+        start = self.loop.time()
+        base = time.perf_counter_ns()
+        # Microseconds since the start of the log, segments being played
+        # back to back.
+        elapsed = 0
+        last_segment = None
+        for segment, offset, frame in read_log(self.path):
+            if segment != last_segment:
+                last_segment = segment
+                segment_start = elapsed
+            elapsed = segment_start + offset
+            if self.speed:
+                delay = start + elapsed / 1e6 / self.speed - self.loop.time()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+            await self.deliver(frame, base + elapsed * 1000)
+            self.sent += 1
+        if self.disconnect_when_done:
+            self.finished = True
+            await self.disconnect()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Replay a frame log through state processing.")
+    parser.add_argument('log')
+    parser.add_argument('--speed', type=float, default=0,
+                        help="1 for real time, 0 (default) for as fast as "
+                        "possible")
+    args = parser.parse_args(argv)
+
+    from bluetoothcube.virtualcube import process_headless
+    # Timestamps follow the recording, so latencies only make sense in real
+    # time.
+    process_headless(ReplayConnection(args.log, args.speed,
+                                      disconnect_when_done=True),
+                     report_latency=args.speed == 1)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,91 @@
+import os
+import timeit
+
+# Decoding of Giiker cube state frames, shared by the Linux and Android
+# connections.
+#
+# Newer cubes encrypt state frames. Those are marked by ENCRYPTED_MARKER in
+# byte 18, and byte 19 holds two key offsets (one per nibble). Each of the
+# first 18 bytes is then shifted by the sum of two key bytes that depend on
+# its position and on these offsets.
+
+ENCRYPTED_MARKER = 0xa7
+
+# Bytes of a frame that hold the cube state.
+STATE_LENGTH = 18
+
+KEY = [176, 81, 104, 224, 86, 137, 237, 119, 38, 26, 193, 161, 210, 126, 150,
+       81, 93, 13, 236, 249, 89, 235, 88, 24, 113, 81, 214, 131, 130, 199, 2,
+       169, 39, 165, 171, 41]
+
+# Byte-wise addition on integers holding STATE_LENGTH bytes: adding the low 7
+# bits of every byte cannot carry into the next byte, the top bits are then
+# added without carry with a XOR.
+LOW_BITS = int.from_bytes(b'\x7f' * STATE_LENGTH, 'big')
+HIGH_BITS = int.from_bytes(b'\x80' * STATE_LENGTH, 'big')
+
+
+def key_offsets(k: int) -> bytes:
+    k1, k2 = k >> 4 & 0xf, k & 0xf
+    return bytes((KEY[i + k1] + KEY[i + k2]) & 0xff
+                 for i in range(STATE_LENGTH))
+
+
+# Offsets for every value of byte 19 (16x16 pairs of key offsets), packed into
+# integers with the low bits already separated.
+OFFSETS = [int.from_bytes(key_offsets(k), 'big') for k in range(256)]
+OFFSETS_LOW = [offsets & LOW_BITS for offsets in OFFSETS]
+OFFSETS_HIGH = [offsets & HIGH_BITS for offsets in OFFSETS]
+
+
+def is_encrypted(frame) -> bool:
+    return len(frame) > 19 and frame[18] == ENCRYPTED_MARKER
+
+
+# Returns the STATE_LENGTH bytes of cube state of an encrypted frame.
+def decrypt(frame) -> bytes:
+    k = frame[19]
+    state = int.from_bytes(frame[:STATE_LENGTH], 'big')
+    return (((state & LOW_BITS) + OFFSETS_LOW[k]) ^
+            ((state ^ OFFSETS_HIGH[k]) & HIGH_BITS)).to_bytes(
+                STATE_LENGTH, 'big')
+
+
+# Inverse of decrypt(): returns the encrypted frame of STATE_LENGTH bytes of
+# cube state, with key offsets `k`. Byte-wise subtraction: setting the top bit
+# of every byte beforehand keeps borrows from crossing bytes.
+def encrypt(state, k: int) -> bytes:
+    state = int.from_bytes(state[:STATE_LENGTH], 'big')
+    return (((state | HIGH_BITS) - OFFSETS_LOW[k]) ^
+            ((state ^ OFFSETS_HIGH[k] ^ HIGH_BITS) & HIGH_BITS)).to_bytes(
+                STATE_LENGTH, 'big') + bytes([ENCRYPTED_MARKER, k])
+
+
+# Byte by byte implementation that decrypt() replaced, kept for reference and
+# benchmarking.
+def decrypt_reference(frame) -> bytes:
+    result = ""
+    k = frame[19]
+    k1 = k >> 4 & 0xf
+    k2 = k & 0xf
+    for i in range(0, len(frame) - 2):
+        move = (frame[i] + KEY[i + k1] + KEY[i + k2]) & 0xff
+        result += "{0:02x}".format(move)
+    return bytes.fromhex(result)
+
+
+def benchmark(count=100000):
+    frames = [os.urandom(STATE_LENGTH) + bytes([ENCRYPTED_MARKER, k])
+              for k in range(256)]
+    for frame in frames:
+        assert decrypt(frame) == decrypt_reference(frame)
+        assert encrypt(decrypt(frame), frame[19]) == frame
+
+    frame = frames[0x3c]
+    for f in (decrypt_reference, decrypt):
+        seconds = min(timeit.repeat(lambda: f(frame), number=count, repeat=5))
+        print(f"{f.__name__}: {seconds / count * 1e6:.2f} us per frame")
+
+
+if __name__ == '__main__':
+    benchmark()
@@ -0,0 +1,159 @@
+import json
+import math
+import time
+
+from typing import Callable, Dict, List
+
+# Opt-in tracing of where time goes between a cube state notification and the
+# frame that shows it. Stages:
+#  - queue: from the notification arrival to the state queue drain in the
+#    Kivy thread.
+#  - decode: building the CubieCube from the Giiker state.
+#  - Timer, Analyzer, CubeDisplay, CubeStateDisplay: each state listener
+#    (see traced()). "CubeDisplay canvas" is the canvas update it triggers.
+#  - total: from the notification arrival to the end of the frame drawn after
+#    the state was processed (window on_flip).
+# Each stage aggregates into a histogram. When disabled, tracing costs a flag
+# check per stage (and a time.perf_counter_ns() call for decode).
+
+STAGE_ORDER = ['queue', 'decode', 'Timer', 'Analyzer', 'CubeDisplay',
+               'CubeDisplay canvas', 'CubeStateDisplay', 'total']
+
+
+# Histogram of durations in nanoseconds, with logarithmic buckets:
+# SUB_BUCKETS per power of two, so percentiles are within 2^(1/16) (4.4%).
+class Histogram:
+    SUB_BUCKETS = 16
+
+    def __init__(self):
+        self.counts: Dict[int, int] = {}
+        self.count = 0
+        self.total = 0
+        self.max = 0
+
+    def record(self, ns: int):
+        bucket = int(math.log2(ns) * self.SUB_BUCKETS) if ns > 1 else 0
+        self.counts[bucket] = self.counts.get(bucket, 0) + 1
+        self.count += 1
+        self.total += ns
+        if ns > self.max:
+            self.max = ns
+
+    # Upper bound of a bucket, in nanoseconds.
+    def bucket_limit(self, bucket: int) -> float:
+        return 2 ** ((bucket + 1) / self.SUB_BUCKETS)
+
+    # Value in nanoseconds below which `p` percent of the durations are.
+    def percentile(self, p: float) -> float:
+        if not self.count:
+            return 0
+        rank = p / 100 * self.count
+        seen = 0
+        for bucket in sorted(self.counts):
+            seen += self.counts[bucket]
+            if seen >= rank:
+                return min(self.bucket_limit(bucket), self.max)
+        return self.max
+
+    def summary(self) -> Dict:
+        return {
+            'count': self.count,
+            'mean_ms': self.total / self.count / 1e6 if self.count else 0,
+            'p50_ms': self.percentile(50) / 1e6,
+            'p95_ms': self.percentile(95) / 1e6,
+            'p99_ms': self.percentile(99) / 1e6,
+            'max_ms': self.max / 1e6,
+        }
+
+
+class LatencyTracer:
+    def __init__(self):
+        self.enabled = False
+        self.histograms: Dict[str, Histogram] = {}
+        # Arrival timestamps of states processed since the last frame.
+        self.pending: List[int] = []
+        self.window = None
+
+    # Starts tracing. With a window, the total latency up to the end of the
+    # frame is traced too.
+    def enable(self, window=None):
+        self.enabled = True
+        if window and not self.window:
+            self.window = window
+            window.bind(on_flip=self.on_flip)
+
+    def disable(self):
+        self.enabled = False
+        self.pending = []
+
+    def reset(self):
+        self.histograms = {}
+        self.pending = []
+
+    def record(self, stage: str, ns: int):
+        if not self.enabled:
+            return
+        histogram = self.histograms.get(stage)
+        if histogram is None:
+            histogram = self.histograms[stage] = Histogram()
+        histogram.record(ns)
+
+    # Called by the state queue with the (state, arrival timestamp) pairs it
+    # hands over to the Kivy thread.
+    def states_drained(self, states):
+        now = time.perf_counter_ns()
+        for _, timestamp in states:
+            self.record('queue', now - timestamp)
+        if self.window:
+            self.pending += [timestamp for _, timestamp in states]
+
+    def on_flip(self, window):
+        if not self.pending:
+            return
+        now = time.perf_counter_ns()
+        for timestamp in self.pending:
+            self.record('total', now - timestamp)
+        self.pending = []
+
+    def stages(self) -> List[str]:
+        known = [s for s in STAGE_ORDER if s in self.histograms]
+        return known + sorted(set(self.histograms) - set(STAGE_ORDER))
+
+    def summary_text(self) -> str:
+        lines = [f"{'stage':<19}{'count':>7}{'p50':>8}{'p95':>8}"
+                 f"{'p99':>8}{'max':>8} ms"]
+        for stage in self.stages():
+            s = self.histograms[stage].summary()
+            lines.append(f"{stage:<19}{s['count']:>7}{s['p50_ms']:>8.3f}"
+                         f"{s['p95_ms']:>8.3f}{s['p99_ms']:>8.3f}"
+                         f"{s['max_ms']:>8.2f}")
+        return '\n'.join(lines)
+
+    # Writes percentiles and histogram buckets (upper limit in nanoseconds:
+    # count) of every stage as JSON.
+    def dump(self, path: str):
+        result = {}
+        for stage in self.stages():
+            histogram = self.histograms[stage]
+            result[stage] = histogram.summary()
+            result[stage]['buckets'] = {
+                round(histogram.bucket_limit(b)): histogram.counts[b]
+                for b in sorted(histogram.counts)}
+        with open(path, 'w') as f:
+            json.dump(result, f, indent=1)
+
+
+tracer = LatencyTracer()
+
+
+# Wraps a listener so that its run time is traced as `stage`.
+def traced(stage: str, callback: Callable) -> Callable:
+    def wrapper(*args):
+        if not tracer.enabled:
+            return callback(*args)
+        start = time.perf_counter_ns()
+        try:
+            return callback(*args)
+        finally:
+            tracer.record(stage, time.perf_counter_ns() - start)
+    return wrapper
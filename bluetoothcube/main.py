@@ -1,5 +1,7 @@
 import os
 import kivy
+import datetime
+import concurrent.futures
 
 from kivy.app import App
 from kivy.clock import Clock
@@ -13,9 +15,15 @@ from bluetoothcube.btutil import (
     BluetoothCubeScanner, BluetoothCubeConnection)
 
 from bluetoothcube.bluetoothcube import BluetoothCube, ScrambleDetector, ScrambleGenerator
-from bluetoothcube.ui import CubeButton, BluetoothCubeRoot, MethodButton
+from bluetoothcube.ui import (
+    CubeButton, BluetoothCubeRoot, MethodButton, SessionButton,
+    LatencyOverlay, RacerPanel)
 from bluetoothcube.timer import Timer
-from bluetoothcube.timehistory import TimeHistory
+from bluetoothcube.transport import TransportBridge
+from bluetoothcube.framelog import FrameRecorder
+from bluetoothcube.latency import tracer
+from bluetoothcube.race import Race
+from bluetoothcube.timehistory import TimeHistory, summary_text
 from bluetoothcube.solveanalyzers import Analyzer
 
 
@@ -33,6 +41,9 @@ if kivy.platform == "linux":
 
 class BluetoothCubeApp(App):
     cubelist = kivy.properties.ObjectProperty(None)
+    # Whether cubes are being picked for a race, and how many are.
+    race_mode = kivy.properties.BooleanProperty(False)
+    race_selected = kivy.properties.NumericProperty(0)
 
     def __init__(self):
         super(BluetoothCubeApp, self).__init__()
@@ -61,6 +72,11 @@ class BluetoothCubeApp(App):
         self.show_cancel_button = None
         self.cube_buttons = []
 
+        # Cubes picked for a race, as (deviceinfo, button), and the race on
+        # the race screen.
+        self.race_picks = []
+        self.race = None
+
         self.timehistory = TimeHistory()
 
         self.timer = Timer(self.cube)
@@ -82,31 +98,81 @@ class BluetoothCubeApp(App):
         Clock.schedule_once(lambda td: self.start_scan(), 1)
 
         # When the app starts, load time history from file.
-        Clock.schedule_once(
-            lambda td:
-            self.timehistory.use_file(
-                os.path.join(self.user_data_dir, "times.txt")), 1)
+        Clock.schedule_once(lambda td: self.load_time_history(), 1)
 
         Clock.schedule_once(lambda td: self.create_method_list(), 1)
 
     def build(self):
+        if self.config.getboolean('debug', 'latency_tracing'):
+            tracer.enable(Window)
+            Clock.schedule_once(
+                lambda td: Window.add_widget(LatencyOverlay()))
         return BluetoothCubeRoot()
 
+    def get_application_config(self):
+        # The configuration is written whenever the session changes, so keep
+        # it with the user's data rather than next to the sources. On Android
+        # Kivy already does so.
+        return super().get_application_config(
+            os.path.join(self.user_data_dir, '%(appname)s.ini'))
+
+    def build_config(self, config):
+        # Time history backend: 'text' (times.txt) or 'sqlite' (times.db).
+        # Session selected when the app was last used.
+        config.setdefaults('timehistory', {'backend': 'text',
+                                           'session': 'main'})
+        # Whether raw frames received from the cube are saved to frame logs,
+        # one per day, in recordings/ (see framelog.py).
+        config.setdefaults('recording', {'enabled': '0'})
+        # Whether state processing latencies are traced and shown in an
+        # overlay (see latency.py). They are dumped to latency-*.json files on
+        # exit, or when the overlay is touched.
+        config.setdefaults('debug', {'latency_tracing': '0'})
+        # Cube view: '2d' (unfolded) or '3d' (animated turns).
+        config.setdefaults('display', {'cube_view': '2d'})
+
+    def load_time_history(self):
+        text_path = os.path.join(self.user_data_dir, "times.txt")
+        session = self.config.get('timehistory', 'session')
+        if self.config.get('timehistory', 'backend') == 'sqlite':
+            # Existing times.txt history is imported on first use, while the
+            # history loads in the background.
+            self.timehistory.use_file(
+                os.path.join(self.user_data_dir, "times.db"),
+                session=session, migrate_from=text_path)
+        else:
+            self.timehistory.use_file(text_path, session=session)
+
     def on_stop(self):
         # Save time history.
         self.timehistory.persist()
 
-        # Make sure to disassociate the cube when closing the app.
+        if tracer.enabled:
+            self.dump_latency()
+
+        # Make sure to disassociate the cubes when closing the app.
         # Otherwise other devices won't connect.
+        disconnections = []
         if self.cube_connection:
-            print("Terminating connection...")
-            self.cube_connection.disconnect()
+            disconnections.append(self.cube_connection.disconnect())
+        if self.race:
+            disconnections += self.race.disconnect()
+        if disconnections:
+            print("Terminating connections...")
+            try:
+                for future in concurrent.futures.as_completed(
+                        disconnections, TransportBridge.DISCONNECT_TIMEOUT):
+                    pass
+            except concurrent.futures.TimeoutError:
+                print("Disconnecting timed out.")
 
     def start_scan(self):
         print("Starting a scan...")
         for button in self.cube_buttons:
             self.root.cubelist.remove_widget(button)
         self.cube_buttons = []
+        self.race_picks = []
+        self.race_selected = 0
 
         self.cube_scanner.scan()
 
@@ -117,17 +183,79 @@ class BluetoothCubeApp(App):
         button.button.text = device.name
         self.cube_buttons.append(button)
         button.button.bind(
-            on_press=lambda b: self.on_cube_button_pressed(device))
+            on_press=lambda b: self.on_cube_button_pressed(device, b))
         self.root.cubelist.add_widget(button, index=len(self.cube_buttons))
 
     def on_paired_cube_found(self, scanner, deviceinfo):
         print("Found a PAIRED GiiKER Cube.")
 
+        if self.race_mode:
+            # It may be one of the cubes to race.
+            self.on_cube_found(scanner, deviceinfo)
+            return
+
         # Do not build UI, connect immediately.
         self.connect_to_cube(deviceinfo)
 
-    def on_cube_button_pressed(self, deviceinfo):
-        self.connect_to_cube(deviceinfo)
+    def on_cube_button_pressed(self, deviceinfo, button):
+        if self.race_mode:
+            self.toggle_race_pick(deviceinfo, button)
+        else:
+            self.connect_to_cube(deviceinfo)
+
+    # In race mode, pressing cube buttons picks cubes for a race instead of
+    # connecting to them. Scanning goes on, so that all cubes can be found.
+    def set_race_mode(self, enabled):
+        self.race_mode = enabled
+        for _, button in self.race_picks:
+            button.background_color = [1, 1, 1, 1]
+        self.race_picks = []
+        self.race_selected = 0
+
+    def toggle_race_pick(self, deviceinfo, button):
+        for pick in self.race_picks:
+            if pick[0] is deviceinfo:
+                self.race_picks.remove(pick)
+                button.background_color = [1, 1, 1, 1]
+                break
+        else:
+            if len(self.race_picks) >= Race.MAX_RACERS:
+                return
+            self.race_picks.append((deviceinfo, button))
+            button.background_color = [0, 0.8, 0, 1]
+        self.race_selected = len(self.race_picks)
+
+    def start_race(self):
+        if len(self.race_picks) < 2:
+            return
+        print(f"Starting a race with {len(self.race_picks)} cubes...")
+        self.cube_scanner.stop_scan()
+
+        # Frames are not recorded: frame logs hold the frames of one cube.
+        self.race = Race()
+        self.race.bind(on_race_finished=self.on_race_finished)
+        self.root.racerlist.clear_widgets()
+        for deviceinfo, _ in self.race_picks:
+            racer = self.race.add(
+                deviceinfo.name, BluetoothCubeConnection(deviceinfo))
+            self.root.racerlist.add_widget(RacerPanel(racer))
+        self.race.connect()
+
+        self.root.transition.direction = 'left'
+        self.root.current = 'race'
+
+    def on_race_finished(self, race, ranking):
+        print("Race finished: " + ", ".join(
+            f"{racer.name} {time}" for racer, time in ranking))
+
+    def leave_race(self):
+        if self.race:
+            self.race.disconnect()
+            self.race = None
+        self.root.racerlist.clear_widgets()
+        self.root.racemodebutton.state = 'normal'
+        self.goto_cube_selection()
+        self.start_scan()
 
     def connect_to_cube(self, deviceinfo):
         print("Connecting to a cube...")
@@ -145,18 +273,35 @@ class BluetoothCubeApp(App):
             lambda td:
             self.root.connecting_cancelbutton.show(), 10)
 
-        self.cube_connection = BluetoothCubeConnection(deviceinfo)
+        transport = BluetoothCubeConnection(deviceinfo)
+        if self.config.getboolean('recording', 'enabled'):
+            transport.recorder = FrameRecorder(self.get_recording_path())
+        self.cube_connection = TransportBridge(transport)
         self.cube_connection.bind(
             on_cube_connecting=self.on_cube_connecting,
             on_cube_connecting_failed=self.on_cube_connecting_failed,
             on_cube_connected=self.on_cube_ready,
+            on_cube_reconnecting=self.on_cube_reconnecting,
+            on_cube_reconnected=self.on_cube_reconnected,
             on_cube_disconnected=self.on_cube_disconnected
             )
 
-        # Calling this directly might freeze UI for a moment
-        Clock.schedule_once(lambda td: self.cube_connection.connect())
+        self.cube_connection.connect()
         Clock.schedule_once(lambda td: self.get_new_scramble())
 
+    def dump_latency(self):
+        path = os.path.join(
+            self.user_data_dir, datetime.datetime.now().strftime(
+                "latency-%Y-%m-%dT%H-%M-%S.json"))
+        tracer.dump(path)
+        print(f"Latency histograms written to {path}")
+
+    def get_recording_path(self):
+        directory = os.path.join(self.user_data_dir, "recordings")
+        os.makedirs(directory, exist_ok=True)
+        return os.path.join(
+            directory, f"{datetime.date.today().isoformat()}.bcfl")
+
     def continue_without_cube(self):
         self.cube.disable_connection()
         self.root.disconnectbutton.text = "Connect"
@@ -182,6 +327,16 @@ class BluetoothCubeApp(App):
         self.root.transition.direction = 'left'
         self.root.current = 'timer'
 
+    # The connection dropped, and is being restored without leaving the timer
+    # screen.
+    def on_cube_reconnecting(self, connection, attempt):
+        print(f"Reconnecting, attempt {attempt}...")
+        self.root.disconnectbutton.text = "Reconnecting..."
+
+    def on_cube_reconnected(self, connection):
+        print("Reconnected.")
+        self.root.disconnectbutton.text = "Disconnect"
+
     def on_cube_disconnected(self, connection):
         self.goto_cube_selection()
         self.start_scan()
@@ -237,6 +392,27 @@ class BluetoothCubeApp(App):
     def select_method(self):
         self.method_popup.open()
 
+    def select_session(self):
+        # Session list is built on demand, summaries are cheap to read.
+        popup = Factory.SessionSelectionPopup()
+        for name, summary in sorted(self.timehistory.list_sessions().items()):
+            button = SessionButton()
+            button.button.text = f"[b]{name}[/b]\n{summary_text(summary)}"
+            button.button.bind(
+                on_press=lambda b, name=name: self.switch_session(name))
+            popup.sessionlist.add_widget(button)
+        self.session_popup = popup
+        popup.open()
+
+    def switch_session(self, name):
+        name = name.strip()
+        if not name:
+            return
+        self.timehistory.switch_session(name)
+        self.config.set('timehistory', 'session', name)
+        self.config.write()
+        self.session_popup.dismiss()
+
     def get_new_scramble(self):
         self.scrambler.scramble()
         self.root.scramble.text = self.scrambler.to_String()
@@ -0,0 +1,112 @@
+from bluetoothcube.cubestate import (
+    CubieCube, MOVES_GIIKER_TO_KOCIEMBA, move_code)
+from bluetoothcube.giiker import decrypt, is_encrypted
+
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+# Cube protocols. A protocol declares how its cubes advertise themselves,
+# their GATT services and characteristics, and how to parse the frames they
+# notify. Scanners pick the protocol of a cube from its advertisement, and
+# its transport hands every frame to that protocol's parse(), so adding a
+# protocol does not change the path of the others.
+
+
+# What a frame reports: the move code of the last move (see
+# cubestate.move_code), None when it carries none, and the whole cube state,
+# in the protocol's own format (see Protocol.cube_state()), None for
+# protocols that only report moves. A plain tuple, as one is built per frame.
+Message = Tuple[Optional[int], Optional[Any]]
+
+
+class Protocol:
+    name = ""
+
+    # Advertisement: a cube matches with any of these service UUIDs, or a
+    # name with any of these prefixes. Scans are filtered by the services.
+    advertised_services: Sequence[str] = ()
+    name_prefixes: Sequence[str] = ()
+
+    # GATT service and characteristic notifying state frames, and service
+    # and characteristics of requests and their responses.
+    service = ""
+    state_characteristic = ""
+    info_service = ""
+    info_request = ""
+    info_response = ""
+
+    # Request commands, by name.
+    commands: Dict[str, int] = {}
+
+    def matches(self, name: Optional[str], uuids) -> bool:
+        if any(uuid in uuids for uuid in self.advertised_services):
+            return True
+        return bool(name) and name.startswith(tuple(self.name_prefixes))
+
+    # Parses a frame without copying it: slices of `frame` stay views of the
+    # notification buffer.
+    def parse(self, frame: memoryview) -> Message:
+        raise NotImplementedError()
+
+    # Cube state of a Message.state.
+    def cube_state(self, state) -> CubieCube:
+        raise NotImplementedError()
+
+
+# Giiker frames hold the cube state in their first 16 bytes, followed by the
+# last moves, most recent first, as face << 4 | direction. Newer cubes
+# encrypt them (see giiker.py).
+class GiikerProtocol(Protocol):
+    name = "Giiker"
+
+    advertised_services = ("0000aadb-0000-1000-8000-00805f9b34fb",)
+    name_prefixes = ("Gi",)
+
+    service = "0000aadb-0000-1000-8000-00805f9b34fb"
+    state_characteristic = "0000aadc-0000-1000-8000-00805f9b34fb"
+    info_service = "0000aaaa-0000-1000-8000-00805f9b34fb"
+    info_response = "0000aaab-0000-1000-8000-00805f9b34fb"
+    info_request = "0000aaac-0000-1000-8000-00805f9b34fb"
+
+    commands = {
+        'RESET_SOLVED': 0xA1
+    }
+
+    # Move codes by move byte. Directions other than 1 (clockwise) are
+    # counterclockwise turns.
+    MOVES = [
+        move_code(MOVES_GIIKER_TO_KOCIEMBA[b >> 4], 1 if b & 0xf == 1 else 3)
+        if 1 <= b >> 4 <= 6 else None
+        for b in range(256)]
+
+    def parse(self, frame: memoryview) -> Message:
+        if is_encrypted(frame):
+            frame = memoryview(decrypt(frame))
+        return self.MOVES[frame[16]], frame[:16]
+
+    def cube_state(self, state) -> CubieCube:
+        return CubieCube(giiker_state=state)
+
+
+PROTOCOLS: List[Protocol] = []
+
+
+def register(protocol: Protocol) -> Protocol:
+    PROTOCOLS.append(protocol)
+    return protocol
+
+
+# The protocol of an advertising device, None if it is not a cube.
+def match(name: Optional[str], uuids) -> Optional[Protocol]:
+    for protocol in PROTOCOLS:
+        if protocol.matches(name, uuids):
+            return protocol
+    return None
+
+
+# Service UUIDs to filter scans by.
+def advertised_services() -> List[str]:
+    return [uuid for protocol in PROTOCOLS
+            for uuid in protocol.advertised_services]
+
+
+GIIKER = register(GiikerProtocol())
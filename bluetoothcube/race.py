@@ -0,0 +1,182 @@
+import os
+import sys
+import time
+import argparse
+import concurrent.futures
+
+# Command line arguments are for the benchmark, not for Kivy.
+if __name__ == '__main__':
+    os.environ.setdefault('KIVY_NO_ARGS', '1')
+
+import kivy.event
+import kivy.properties
+
+from bluetoothcube.bluetoothcube import BluetoothCube
+from bluetoothcube.common import Time
+from bluetoothcube.solveanalyzers import Analyzer
+from bluetoothcube.timer import Timer
+from bluetoothcube.transport import CubeTransport, TransportBridge
+
+from typing import List, Optional, Tuple
+
+# Race mode: several cubes connected at once, each with its own state, timer
+# and analyzer. All connections share the transport event loop, and all
+# states are processed in the Kivy thread, at most once per frame per cube.
+# In the app, cubes are picked for a race on the cube selection screen, and
+# raced on the race screen (see BluetoothCubeApp.start_race()).
+
+
+# One cube of a race.
+class Racer(kivy.event.EventDispatcher):
+    connected = kivy.properties.BooleanProperty(False)
+    # Connection progress or problem, empty while connected.
+    status = kivy.properties.StringProperty("")
+    # Place in the finished race, 0 until then.
+    place = kivy.properties.NumericProperty(0)
+
+    def __init__(self, name: str, transport: CubeTransport):
+        self.register_event_type('on_finished')
+        super().__init__()
+        self.name = name
+        self.connection = TransportBridge(transport)
+        self.cube = BluetoothCube()
+        self.timer = Timer(self.cube)
+        self.analyzer = Analyzer(self.cube, self.timer)
+        self.timer.use_analyzer(self.analyzer)
+        self.result: Optional[Time] = None
+
+        self.connection.bind(
+            on_cube_connecting=lambda c, message, percent: setattr(
+                self, 'status', message),
+            on_cube_connecting_failed=lambda c, message: setattr(
+                self, 'status', message),
+            on_cube_connected=self.on_cube_connected,
+            on_cube_reconnecting=lambda c, attempt: setattr(
+                self, 'status', "Reconnecting..."),
+            on_cube_reconnected=lambda c: setattr(self, 'status', ""),
+            on_cube_disconnected=self.on_cube_disconnected)
+        self.timer.bind(on_new_time=self.on_new_time)
+
+    def on_cube_connected(self, connection):
+        self.cube.set_connection(connection)
+        self.connected = True
+        self.status = ""
+
+    def on_cube_disconnected(self, connection):
+        self.connected = False
+        self.status = "Disconnected."
+
+    def on_new_time(self, timer, time):
+        self.result = time
+        self.dispatch('on_finished', time)
+
+    def on_finished(self, *args):
+        pass
+
+
+class Race(kivy.event.EventDispatcher):
+    MAX_RACERS = 8
+
+    def __init__(self):
+        self.register_event_type('on_race_finished')
+        super().__init__()
+        self.racers: List[Racer] = []
+        self.running = False
+
+    def add(self, name: str, transport: CubeTransport) -> Racer:
+        if len(self.racers) >= self.MAX_RACERS:
+            raise ValueError(
+                f"A race takes at most {self.MAX_RACERS} cubes.")
+        racer = Racer(name, transport)
+        racer.bind(on_finished=self.on_racer_finished)
+        self.racers.append(racer)
+        return racer
+
+    def connect(self):
+        for racer in self.racers:
+            racer.connection.connect()
+
+    # Returns futures of the disconnections, see TransportBridge.disconnect().
+    def disconnect(self) -> List[concurrent.futures.Future]:
+        return [racer.connection.disconnect() for racer in self.racers]
+
+    # Primes every timer: each one starts on the first move of its cube.
+    def start(self):
+        for racer in self.racers:
+            racer.result = None
+            racer.place = 0
+            racer.timer.prime()
+        self.running = True
+
+    def on_racer_finished(self, racer, time):
+        if self.running and all(r.result for r in self.racers):
+            self.running = False
+            ranking = self.ranking()
+            for place, (r, _) in enumerate(ranking, 1):
+                r.place = place
+            self.dispatch('on_race_finished', ranking)
+
+    # Racers that finished, fastest first, with their times.
+    def ranking(self) -> List[Tuple[Racer, Time]]:
+        finished = [(r, r.result) for r in self.racers if r.result]
+        return sorted(finished, key=lambda rt: rt[1])
+
+    def on_race_finished(self, *args):
+        pass
+
+
+# Races simulated cubes playing random moves. Timers run the whole time, so
+# every state goes through the analyzer's pattern matching (the costliest
+# case). Reports dropped frames and the time spent processing states.
+def benchmark(cubes: int, tps: float, seconds: float):
+    from kivy.clock import Clock
+    from bluetoothcube.virtualcube import VirtualCubeConnection, random_moves
+
+    race = Race()
+    count = int(tps * seconds)
+    processing = []
+    for i in range(cubes):
+        moves = (m for _, m in zip(range(count), random_moves(seed=i)))
+        racer = race.add(f"Cube {i + 1}", VirtualCubeConnection(
+            moves, tps, disconnect_when_done=True, seed=i))
+
+        # Time spent on each batch of states, from the queue to the last
+        # listener.
+        def timed(states, process=racer.connection.process_states):
+            start = time.perf_counter_ns()
+            process(states)
+            processing.append((time.perf_counter_ns() - start, len(states)))
+        racer.connection.state_queue.consumer = timed
+
+    race.connect()
+    Clock.schedule_once(lambda td: race.start(), 0.5)
+    start = time.perf_counter()
+    while time.perf_counter() - start < 1 or any(
+            r.connected for r in race.racers):
+        Clock.tick()
+    wall = time.perf_counter() - start
+
+    states = sum(n for _, n in processing)
+    busy = sum(ns for ns, _ in processing) / 1e9
+    for racer in race.racers:
+        transport = racer.connection.transport
+        print(f"{racer.name}: {racer.connection.state_queue.state_count}"
+              f"/{transport.sent} states, {transport.dropped_frames} "
+              f"frames dropped, timer running: {racer.timer.running}")
+    print(f"{states} states in {wall:.1f} s, {busy / states * 1e6:.0f} us "
+          f"per state, Kivy thread {busy / wall:.1%} busy processing states")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Benchmark race mode with virtual cubes.")
+    parser.add_argument('--cubes', type=int, default=8)
+    parser.add_argument('--tps', type=float, default=10,
+                        help="quarter turns per second, per cube")
+    parser.add_argument('--seconds', type=float, default=10)
+    args = parser.parse_args(argv)
+    benchmark(args.cubes, args.tps, args.seconds)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -1,5 +1,6 @@
 import kivy
 
+from bluetoothcube.latency import traced
 from bluetoothcube.patterns import (
     CFOP_CROSS, CFOP_F2L, CFOP_OLL, CFOP_PLL, PETRUS_2X2X2, PETRUS_2X2X3, PETRUS_EO)
 
@@ -38,7 +39,8 @@ class Analyzer(kivy.event.EventDispatcher):
         self.method = 'CFOP'
         self.stages = STAGES[self.method]
 
-        self.cube.bind(on_state_changed=self.on_state_changed)
+        self.cube.bind(
+            on_state_changed=traced('Analyzer', self.on_state_changed))
         self.timer.bind(
             on_solve_started=self.on_solve_started,
             on_solve_ended=self.on_solve_ended)
@@ -68,23 +70,25 @@ class Analyzer(kivy.event.EventDispatcher):
         self.times = {}
         self.stage_start_time = 0
         # Maybe some stages are already complete?
-        self.detect_stage_changes()
+        self.detect_stage_changes(timer.start_time)
 
-    def on_state_changed(self, cube, newstate):
+    def on_state_changed(self, cube, newstate, timestamp):
         if not self.timer.running:
             # Do not track state changes whilst the timer is stopped. We're not
             # interested in these.
             return
-        self.detect_stage_changes()
+        self.detect_stage_changes(timestamp)
 
-    def detect_stage_changes(self):
+    # `timestamp` (time.perf_counter_ns()) is when the current cube state was
+    # reached, now if not given.
+    def detect_stage_changes(self, timestamp=None):
         # Advance to next state if target condition is met.
         stage_name, target_pattern = self.stages[self.current_stage]
         if not target_pattern:
             return
 
         if self.cube.cube_state.toFaceCube().matches_any(target_pattern):
-            current_time = self.timer.get_time()
+            current_time = self.timer.get_time(timestamp)
             stage_time = current_time - self.stage_start_time
             # print(f"{stage_name} completed in {stage_time:.02f}.")
 
@@ -94,7 +98,7 @@ class Analyzer(kivy.event.EventDispatcher):
             self.current_stage += 1
 
             # Retry - maybe we've advanced more than one stage in one turn?
-            self.detect_stage_changes()
+            self.detect_stage_changes(timestamp)
 
     def on_solve_ended(self, timer):
         stage_name, _ = self.stages[self.current_stage]
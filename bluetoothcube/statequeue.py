@@ -0,0 +1,67 @@
+from collections import deque
+
+from kivy.clock import Clock
+
+from bluetoothcube.latency import tracer
+from bluetoothcube.protocols import Message
+
+from typing import Callable, Dict, List, Tuple
+
+# A state notification: the parsed frame (protocols.Message) and its arrival
+# timestamp (time.perf_counter_ns()).
+State = Tuple[Message, int]
+
+
+# Hands cube state notifications from the bluetooth thread (D-Bus or JNI
+# callback) over to the Kivy thread. Producers only append to a deque and
+# fire a single reusable clock trigger, so there is no closure or clock event
+# per packet. The consumer gets every state that arrived since the previous
+# frame at once, in order.
+class StateQueue:
+    def __init__(self, consumer: Callable[[List[State]], None]):
+        self.consumer = consumer
+        # deque.append() and popleft() are thread-safe.
+        self.pending: deque = deque()
+        # Clock triggers can be fired from any thread, and fire only once per
+        # frame however many times they are called.
+        self.trigger = Clock.create_trigger(self.drain)
+        self.reset_counters()
+
+    def reset_counters(self):
+        # Deepest the queue got.
+        self.max_depth = 0
+        self.state_count = 0
+        self.batch_count = 0
+        # Number of batches (frames) by number of states processed.
+        self.batch_sizes: Dict[int, int] = {}
+
+    # Called from the bluetooth thread.
+    def put(self, message: Message, timestamp: int):
+        self.pending.append((message, timestamp))
+        depth = len(self.pending)
+        if depth > self.max_depth:
+            self.max_depth = depth
+        self.trigger()
+
+    # Called on the Kivy thread, once per frame.
+    def drain(self, *args):
+        batch = []
+        while self.pending:
+            batch.append(self.pending.popleft())
+        if not batch:
+            return
+        self.state_count += len(batch)
+        self.batch_count += 1
+        self.batch_sizes[len(batch)] = self.batch_sizes.get(len(batch), 0) + 1
+        if tracer.enabled:
+            tracer.states_drained(batch)
+        self.consumer(batch)
+
+    def depth(self) -> int:
+        return len(self.pending)
+
+    def counters_text(self) -> str:
+        sizes = ', '.join(f"{size}: {count}" for size, count
+                          in sorted(self.batch_sizes.items()))
+        return (f"{self.state_count} states in {self.batch_count} frames, "
+                f"max queue depth {self.max_depth}, batch sizes {{{sizes}}}")
@@ -0,0 +1,154 @@
+import datetime
+import numpy
+
+from array import array
+
+from bluetoothcube.common import Time
+from bluetoothcube.utils import datetime_to_epoch
+
+from typing import Iterable, List, Optional, Tuple, Union
+
+FLAG_P2 = 1
+FLAG_DNF = 2
+
+# One day in timestamp units (microseconds).
+DAY = 86400 * 1000000
+
+
+# Converts a Time.epoch value to timestamp units.
+def timestamp_from_epoch(epoch: float) -> int:
+    return round(epoch * 1000000)
+
+
+# Converts a (naive, UTC) datetime to timestamp units.
+def timestamp_from_datetime(dt: datetime.datetime) -> int:
+    return timestamp_from_epoch(datetime_to_epoch(dt))
+
+
+# Columnar storage for a list of times: solve times (NaN for DNFs without a
+# measured time), penalty flags and timestamps (microseconds since the epoch)
+# live in compact arrays, metadata in a side list of raw JSON strings. This
+# costs ~25 bytes per solve plus metadata, and allows statistics to be
+# computed with vectorized numpy operations.
+#
+# The class mimics a list of Time objects. Reading an item creates a Time
+# from the columns; since it is a copy, changes to it only take effect after
+# it is assigned back.
+class TimeColumns:
+    def __init__(self, times: Iterable[Time] = ()):
+        self.times = array('d')
+        self.flags = array('B')
+        self.timestamps = array('q')
+        self.meta: List[Optional[str]] = []
+        self.extend(times)
+
+    @staticmethod
+    def to_columns(time: Time):
+        flags = ((FLAG_P2 if time.is_p2() else 0) |
+                 (FLAG_DNF if time.is_dnf() else 0))
+        meta = time.save_meta()
+        return (numpy.nan if time.time is None else time.time, flags,
+                timestamp_from_epoch(time.epoch),
+                None if meta == 'null' else meta)
+
+    def get(self, i: int) -> Time:
+        t = self.times[i]
+        time = Time('DNF' if t != t else t, epoch=self.timestamps[i] / 1000000,
+                    raw_meta=self.meta[i])
+        flags = self.flags[i]
+        time.p2 = bool(flags & FLAG_P2)
+        time.dnf = bool(flags & FLAG_DNF) or time.time is None
+        return time
+
+    def append(self, time: Time):
+        t, flags, timestamp, meta = self.to_columns(time)
+        self.times.append(t)
+        self.flags.append(flags)
+        self.timestamps.append(timestamp)
+        self.meta.append(meta)
+
+    def insert(self, i: int, time: Time):
+        t, flags, timestamp, meta = self.to_columns(time)
+        self.times.insert(i, t)
+        self.flags.insert(i, flags)
+        self.timestamps.insert(i, timestamp)
+        self.meta.insert(i, meta)
+
+    def extend(self, times: Iterable[Time]):
+        for time in times:
+            self.append(time)
+
+    def copy(self) -> 'TimeColumns':
+        copy = TimeColumns()
+        copy.times = array('d', self.times)
+        copy.flags = array('B', self.flags)
+        copy.timestamps = array('q', self.timestamps)
+        copy.meta = list(self.meta)
+        return copy
+
+    # Timestamps as Time.epoch values.
+    def epochs(self) -> Iterable[float]:
+        return (t / 1000000 for t in self.timestamps)
+
+    # Index of the last time with the given timestamp, by linear search.
+    def index_of(self, timestamp: int) -> Optional[int]:
+        matches = numpy.flatnonzero(
+            numpy.frombuffer(self.timestamps, dtype=numpy.int64) == timestamp)
+        return int(matches[-1]) if len(matches) else None
+
+    def pop(self, i=-1) -> Time:
+        time = self.get(i)
+        del self[i]
+        return time
+
+    def __len__(self):
+        return len(self.times)
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self.get(i)
+
+    def __getitem__(self, key: Union[int, slice]):
+        if isinstance(key, slice):
+            return [self.get(i) for i in range(*key.indices(len(self)))]
+        return self.get(key)
+
+    def __setitem__(self, i: int, time: Time):
+        t, flags, timestamp, meta = self.to_columns(time)
+        self.times[i] = t
+        self.flags[i] = flags
+        self.timestamps[i] = timestamp
+        self.meta[i] = meta
+
+    def __delitem__(self, i: int):
+        del self.times[i]
+        del self.flags[i]
+        del self.timestamps[i]
+        del self.meta[i]
+
+    # Times with penalties applied as a numpy array, with DNFs as +inf so that
+    # they sort last. The result is a copy, it is safe to keep.
+    def penalized(self, start=None, stop=None) -> numpy.ndarray:
+        s = slice(start, stop)
+        # A numpy view on an array prevents resizing it, so make sure views
+        # do not outlive this call.
+        times = numpy.array(numpy.frombuffer(self.times)[s])
+        dnf = numpy.frombuffer(self.flags, dtype=numpy.uint8)[s] & FLAG_DNF
+        times[(dnf != 0) | numpy.isnan(times)] = numpy.inf
+        return times
+
+    # Day numbers (days since the epoch, UTC) of all times. The result is a
+    # copy, it is safe to keep.
+    def days(self) -> numpy.ndarray:
+        # The division makes a new array, so the view on timestamps does not
+        # outlive this call (see penalized()).
+        timestamps = numpy.frombuffer(self.timestamps, dtype=numpy.int64)
+        days = timestamps // DAY
+        del timestamps
+        return days
+
+    # Returns (count, dnf_count, sum of non-DNF times).
+    def aggregates(self) -> Tuple[int, int, float]:
+        times = self.penalized()
+        valid = times[numpy.isfinite(times)]
+        return len(times), len(times) - len(valid), float(valid.sum())
@@ -0,0 +1,311 @@
+import re
+import csv
+import sys
+import json
+import argparse
+
+from bluetoothcube.common import Time
+from bluetoothcube.timecolumns import timestamp_from_epoch
+from bluetoothcube.timestore import open_catalog, DEFAULT_SESSION
+from bluetoothcube.utils import (
+    datetime_from_isoformat, datetime_to_epoch)
+
+from typing import IO, Iterable, Iterator, List, Optional
+
+# Import and export of time histories. Every reader yields times one at a
+# time and every writer consumes an iterable, so converting a history never
+# requires holding all of it in memory.
+#
+# Supported formats:
+#  - native: Time.save() lines, as in times.txt.
+#  - csv: date, time (with penalties applied), penalty and metadata JSON.
+#  - cstimer: csTimer export (JSON). Stage times map to csTimer phases.
+
+FORMATS = ('native', 'csv', 'cstimer')
+
+CSV_FIELDS = ('date', 'time', 'penalty', 'meta')
+
+CSTIMER_DNF = -1
+CSTIMER_P2 = 2000
+
+
+def format_from_path(path: str) -> str:
+    if path.endswith('.json'):
+        return 'cstimer'
+    if path.endswith('.csv'):
+        return 'csv'
+    return 'native'
+
+
+def read_native(f: IO) -> Iterator[Time]:
+    for line in f:
+        line = line.strip()
+        if line:
+            yield Time(line)
+
+
+def write_native(f: IO, times: Iterable[Time]):
+    for time in times:
+        f.write(time.save() + "\n")
+
+
+def read_csv(f: IO) -> Iterator[Time]:
+    for row in csv.DictReader(f):
+        t = row['time'] or 'DNF'
+        time = Time('DNF' if t == 'DNF' else float(t),
+                    epoch=datetime_to_epoch(
+                        datetime_from_isoformat(row['date'])),
+                    raw_meta=row.get('meta') or None)
+        time.load_penalty(f"{t}|{row.get('penalty') or 'OK'}")
+        yield time
+
+
+def write_csv(f: IO, times: Iterable[Time]):
+    writer = csv.writer(f)
+    writer.writerow(CSV_FIELDS)
+    for time in times:
+        meta = time.save_meta()
+        writer.writerow((
+            time.ts.isoformat(),
+            '' if time.time is None else repr(time.time),
+            time.get_state(),
+            '' if meta == 'null' else meta))
+
+
+# csTimer stores a solve as [[penalty, time in ms, phase ends...], scramble,
+# comment, timestamp]. Phase ends are in milliseconds since the start, last
+# phase first, and exclude the end of the final phase (the total time).
+def time_from_cstimer(entry) -> Time:
+    (penalty, ms, *phase_ends), scramble, comment, timestamp = entry[:4]
+
+    meta = {}
+    # A DNF without a measured time has no phases. Phase ends past the total
+    # are clamped, as they would make the last phase negative.
+    if phase_ends and ms:
+        ends = [min(end, ms) for end in reversed(phase_ends)] + [ms]
+        meta['stage_times'] = [
+            (f"Phase {i + 1}", (end - start) / 1000)
+            for i, (start, end) in enumerate(zip([0] + ends, ends))]
+    if scramble:
+        meta['scramble'] = scramble
+    if comment:
+        meta['comment'] = comment
+
+    if penalty == CSTIMER_DNF:
+        time = Time(ms / 1000 if ms else 'DNF', meta or None,
+                    epoch=float(timestamp))
+        time.set_dnf(True)
+    else:
+        time = Time(ms / 1000, meta or None, epoch=float(timestamp))
+        time.set_p2(penalty == CSTIMER_P2)
+    return time
+
+
+def time_to_cstimer(time: Time) -> List:
+    if time.time is None:
+        ms = 0
+    else:
+        ms = round((time.time - 2 if time.p2 else time.time) * 1000)
+    penalty = (CSTIMER_DNF if time.is_dnf() else
+               CSTIMER_P2 if time.is_p2() else 0)
+
+    result = [penalty, ms]
+    meta = time.meta or {}
+    # Phases only make sense with a total time to split.
+    stage_times = (meta.get('stage_times') or []) if ms else []
+    ends, end = [], 0
+    for _, stage_time in stage_times[:-1]:
+        end += round(stage_time * 1000)
+        ends.append(min(end, ms))
+    result += reversed(ends)
+
+    return [result, meta.get('scramble', ''), meta.get('comment', ''),
+            round(time.epoch)]
+
+
+# Incremental reader for a JSON document, decoding one value at a time.
+class JsonStream:
+    CHUNK_SIZE = 65536
+
+    def __init__(self, f: IO):
+        self.f = f
+        self.buffer = ''
+        self.pos = 0
+        self.eof = False
+        self.decoder = json.JSONDecoder()
+
+    def fill(self) -> bool:
+        if self.eof:
+            return False
+        chunk = self.f.read(self.CHUNK_SIZE)
+        if not chunk:
+            self.eof = True
+            return False
+        self.buffer = self.buffer[self.pos:] + chunk
+        self.pos = 0
+        return True
+
+    # Returns the next non-whitespace character without consuming it, or ''
+    # at the end of the document.
+    def peek(self) -> str:
+        while True:
+            while (self.pos < len(self.buffer) and
+                   self.buffer[self.pos].isspace()):
+                self.pos += 1
+            if self.pos < len(self.buffer):
+                return self.buffer[self.pos]
+            if not self.fill():
+                return ''
+
+    # Consumes the next character, which must be one of `chars`.
+    def expect(self, chars: str) -> str:
+        c = self.peek()
+        if not c or c not in chars:
+            raise ValueError(f"Expected one of {chars!r}, got {c!r}")
+        self.pos += 1
+        return c
+
+    def value(self):
+        self.peek()
+        while True:
+            try:
+                value, end = self.decoder.raw_decode(self.buffer, self.pos)
+                # A number at the end of the buffer may continue in the next
+                # chunk.
+                if end < len(self.buffer) or self.eof:
+                    self.pos = end
+                    return value
+            except json.JSONDecodeError:
+                if self.eof:
+                    raise
+            self.fill()
+
+
+# Yields times from all sessions of a csTimer export.
+def read_cstimer(f: IO) -> Iterator[Time]:
+    stream = JsonStream(f)
+    stream.expect('{')
+    if stream.peek() == '}':
+        return
+    while True:
+        key = stream.value()
+        stream.expect(':')
+        if re.fullmatch(r'session\d+', key) and stream.peek() == '[':
+            stream.expect('[')
+            if stream.peek() == ']':
+                stream.expect(']')
+            else:
+                while True:
+                    yield time_from_cstimer(stream.value())
+                    if stream.expect(',]') == ']':
+                        break
+        else:
+            # Properties, skipped.
+            stream.value()
+        if stream.expect(',}') == '}':
+            return
+
+
+def write_cstimer(f: IO, times: Iterable[Time], name=DEFAULT_SESSION):
+    f.write('{"session1": [')
+    for i, time in enumerate(times):
+        if i:
+            f.write(',')
+        f.write(json.dumps(time_to_cstimer(time)))
+    properties = {'sessionData': json.dumps({'1': {'name': name, 'rank': 1}})}
+    f.write(f'], "properties": {json.dumps(properties)}}}')
+
+
+def read_times(f: IO, fmt: str) -> Iterator[Time]:
+    if fmt == 'cstimer':
+        return read_cstimer(f)
+    if fmt == 'csv':
+        return read_csv(f)
+    return read_native(f)
+
+
+def write_times(f: IO, times: Iterable[Time], fmt: str, name=DEFAULT_SESSION):
+    if fmt == 'cstimer':
+        write_cstimer(f, times, name)
+    elif fmt == 'csv':
+        write_csv(f, times)
+    else:
+        write_native(f, times)
+
+
+# Opens a file for reading or writing times, with the options the csv module
+# expects.
+def open_times_file(path: str, mode: str) -> IO:
+    return open(path, mode, newline='')
+
+
+def import_file(history: str, path: str, session=DEFAULT_SESSION,
+                fmt: Optional[str] = None) -> int:
+    catalog = open_catalog(history)
+    store = catalog.open_store(session)
+    # Times already in the session are skipped, so an import can be repeated.
+    known = {timestamp_from_epoch(time.epoch) for time in store.iter_times()}
+    count = 0
+
+    def new_times(times):
+        nonlocal count
+        for time in times:
+            timestamp = timestamp_from_epoch(time.epoch)
+            if timestamp not in known:
+                known.add(timestamp)
+                count += 1
+                yield time
+
+    with open_times_file(path, 'r') as f:
+        times = read_times(f, fmt or format_from_path(path))
+        store.append_many(new_times(times))
+    # The stored summary is outdated, it is rebuilt when the session is loaded.
+    catalog.save_summary(session, {})
+    store.close()
+    catalog.close()
+    return count
+
+
+def export_file(history: str, path: str, session=DEFAULT_SESSION,
+                fmt: Optional[str] = None) -> int:
+    catalog = open_catalog(history)
+    store = catalog.open_store(session)
+    count = 0
+
+    def counted(times):
+        nonlocal count
+        for time in times:
+            count += 1
+            yield time
+
+    with open_times_file(path, 'w') as f:
+        write_times(f, counted(store.iter_times()),
+                    fmt or format_from_path(path), session)
+    store.close()
+    catalog.close()
+    return count
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Import or export time history.")
+    parser.add_argument('command', choices=('import', 'export'))
+    parser.add_argument('history', help="times.txt or times.db file")
+    parser.add_argument('file', help="file to import from or export to")
+    parser.add_argument('--session', default=DEFAULT_SESSION)
+    parser.add_argument('--format', choices=FORMATS,
+                        help="default: guessed from the file extension")
+    args = parser.parse_args(argv)
+
+    if args.command == 'import':
+        count = import_file(args.history, args.file, args.session,
+                            args.format)
+        print(f"Imported {count} times.")
+    else:
+        count = export_file(args.history, args.file, args.session,
+                            args.format)
+        print(f"Exported {count} times.")
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -1,12 +1,125 @@
-import os
+import datetime
 import kivy
+import numpy
 
 from kivy.factory import Factory
 from kivy.clock import Clock
+from threading import Thread
 
 from bluetoothcube.common import Time
+from bluetoothcube.timecolumns import (
+    TimeColumns, timestamp_from_datetime, timestamp_from_epoch)
+from bluetoothcube.timeformats import (
+    read_times, write_times, format_from_path, open_times_file)
+from bluetoothcube.timestats import TimeStatistics, AVERAGES
+from bluetoothcube.timestore import (
+    open_catalog, make_change, apply_changes, restore_position, Change,
+    DEFAULT_SESSION, RECORD_ADD, RECORD_PENALTY, RECORD_DELETE, RECORD_RESTORE)
 
-from typing import Optional
+from typing import Dict, Iterable, List, Optional, Tuple
+
+
+# Averages are handled as floats (+inf for DNF averages) or None if there are
+# not enough times. Summaries store them as numbers, 'DNF' or None.
+def average_from_time(average: Optional[Time]) -> Optional[float]:
+    if average is None:
+        return None
+    return numpy.inf if average.is_dnf() else average.time
+
+
+def time_from_average(average: float) -> Optional[Time]:
+    if numpy.isnan(average):
+        return None
+    return Time('DNF') if numpy.isinf(average) else Time(float(average))
+
+
+def average_to_json(average: Optional[float]):
+    if average is None or numpy.isnan(average):
+        return None
+    if numpy.isinf(average):
+        return 'DNF'
+    return float(average)
+
+
+def average_from_json(average) -> Optional[float]:
+    if average is None:
+        return None
+    return numpy.inf if average == 'DNF' else float(average)
+
+
+def format_average(average) -> str:
+    average = average_from_json(average)
+    if average is None:
+        return "---"
+    if numpy.isinf(average):
+        return "DNF"
+    return f"{average:.02f}"
+
+
+# One-line description of a session summary, for session lists.
+def summary_text(summary: Dict) -> str:
+    count = summary.get('count', 0)
+    valid = count - summary.get('dnf_count', 0)
+    mean = summary['total'] / valid if valid > 0 else None
+    return (f"{count} solves, mean {format_average(mean)}, "
+            f"ao5 {format_average(summary.get('ao5'))}, "
+            f"ao100 {format_average(summary.get('ao100'))}")
+
+
+# Times of a single named session, with everything that is kept up to date
+# incrementally as they change.
+class Session:
+    def __init__(self, name, store, summary):
+        self.name = name
+        self.store = store
+        self.data = TimeColumns()
+        # Detailed statistics, only valid when not loading.
+        self.stats = TimeStatistics()
+
+        # True while the full history is being loaded in the background.
+        # During that time `data` only holds the most recent times.
+        self.loading = False
+        # Changes made while the history is loading, replayed onto the full
+        # history once it is available.
+        self.pending_changes = []
+
+        # Edits that can be undone or redone, as (change, inverse change).
+        self.undo_stack: List[Tuple[Change, Change]] = []
+        self.redo_stack: List[Tuple[Change, Change]] = []
+
+        # Summary of the session: count, dnf_count, total (sum of non-DNF
+        # times), current and best averages. It is saved with the session
+        # after every change.
+        self.summary: Dict = dict(summary)
+        # The count/dnf_count/total aggregates are only known before the
+        # session is loaded if the store or the saved summary provides them.
+        self.aggregates_known = False
+        aggregates = store.load_aggregates() if store else None
+        if aggregates:
+            self.set_aggregates(*aggregates)
+        elif 'count' in self.summary:
+            self.aggregates_known = True
+
+    def set_aggregates(self, count, dnf_count, total):
+        self.aggregates_known = True
+        self.summary.update(
+            {'count': count, 'dnf_count': dnf_count, 'total': total})
+
+    # Adds (or with sign=-1, removes) a time to the session aggregates.
+    def count_time(self, time: Time, sign=1):
+        if not self.aggregates_known:
+            return
+        self.summary['count'] += sign
+        if time.is_dnf():
+            self.summary['dnf_count'] += sign
+        else:
+            self.summary['total'] += sign * time.time
+
+    def get_mean(self) -> Optional[Time]:
+        if not self.aggregates_known:
+            return None
+        valid = self.summary['count'] - self.summary['dnf_count']
+        return Time(self.summary['total'] / valid) if valid > 0 else None
 
 
 class TimeHistory(kivy.event.EventDispatcher):
@@ -17,30 +130,174 @@ class TimeHistory(kivy.event.EventDispatcher):
     ao100 = kivy.properties.ObjectProperty(
         None, allownone=True, force_dispatch=True)
 
+    # Statistics over the whole session. They are not known while the session
+    # is being loaded, unless they were precomputed.
+    solve_count = kivy.properties.NumericProperty(0)
+    mean = kivy.properties.ObjectProperty(
+        None, allownone=True, force_dispatch=True)
+
     recent_solves_text = kivy.properties.StringProperty(" ")
     last_time = kivy.properties.ObjectProperty(
         None, allownone=True, force_dispatch=True)
 
+    # True while the current session is being loaded in the background.
+    loading = kivy.properties.BooleanProperty(False)
+
+    # Name of the session new times are added to.
+    current_session = kivy.properties.StringProperty(DEFAULT_SESSION)
+
+    can_undo = kivy.properties.BooleanProperty(False)
+    can_redo = kivy.properties.BooleanProperty(False)
+
+    # Number of times loaded before the rest of a session, enough to compute
+    # all averages and the recent times list.
+    TAIL_LENGTH = 300
+
+    # Number of edits that can be undone, per session.
+    UNDO_LIMIT = 100
+
     def __init__(self):
         # This event can be used to clear time display.
         self.register_event_type('on_time_invalidated')
+        # Dispatched whenever `stats` change.
+        self.register_event_type('on_statistics_changed')
         super().__init__()
-        self.data = []
         self.filepath = None
+        self.catalog = None
+        # Sessions stay in memory once loaded, so switching back is cheap.
+        self.sessions: Dict[str, Session] = {}
+        # Times recorded before a file is used are not stored.
+        self.session = Session(DEFAULT_SESSION, None, {})
+
+    # Times, store and statistics of the current session.
+    @property
+    def data(self) -> TimeColumns:
+        return self.session.data
+
+    @property
+    def store(self):
+        return self.session.store
+
+    @property
+    def stats(self) -> TimeStatistics:
+        return self.session.stats
 
     def add_time(self, time: Time):
         self.data.append(time)
+        self.store_change(RECORD_ADD, time)
+        self.session.count_time(time)
+        if not self.loading:
+            self.stats.add(self.data)
+            self.dispatch('on_statistics_changed')
+        self.update_averages()
+        self.update_last_time()
+        self.update_recent_times()
+        self.update_summary()
+
+    # Adds many times at once. Unlike add_time(), statistics and averages are
+    # only updated at the end. Times with a timestamp that is already in the
+    # session are skipped. Returns the number of added times.
+    def add_times(self, times: Iterable[Time]) -> int:
+        if self.loading:
+            # Duplicates could not be detected.
+            print("Cannot add times while the history is loading.")
+            return 0
+
+        known = set(self.data.timestamps)
+        count = 0
+
+        def new_times():
+            nonlocal count
+            for time in times:
+                timestamp = timestamp_from_epoch(time.epoch)
+                if timestamp in known:
+                    continue
+                known.add(timestamp)
+                self.data.append(time)
+                self.session.count_time(time)
+                count += 1
+                yield time
+
+        if self.store:
+            self.store.append_many(new_times())
+        else:
+            for _ in new_times():
+                pass
+
+        self.update_statistics()
         self.update_averages()
         self.update_last_time()
         self.update_recent_times()
+        self.update_summary()
+        return count
+
+    def import_times(self, path, fmt=None) -> int:
+        with open_times_file(path, 'r') as f:
+            return self.add_times(read_times(f, fmt or format_from_path(path)))
+
+    def export_times(self, path, fmt=None):
+        with open_times_file(path, 'w') as f:
+            write_times(f, self.data, fmt or format_from_path(path),
+                        self.current_session)
 
     def get_last_time(self) -> Time:
         return self.data[-1]
 
     def update_averages(self):
-        self.ao5 = self.get_aon(5)
-        self.ao12 = self.get_aon(12)
-        self.ao100 = self.get_aon(100)
+        if self.loading:
+            self.ao5 = self.get_aon(5)
+            self.ao12 = self.get_aon(12)
+            self.ao100 = self.get_aon(100)
+        else:
+            # Statistics keep the averages up to date.
+            self.ao5 = time_from_average(self.stats.current_average(5))
+            self.ao12 = time_from_average(self.stats.current_average(12))
+            self.ao100 = time_from_average(self.stats.current_average(100))
+
+    def store_change(self, kind, time: Time):
+        if self.store:
+            if kind == RECORD_ADD:
+                self.store.append(time)
+            elif kind == RECORD_PENALTY:
+                self.store.update(time)
+            elif kind == RECORD_DELETE:
+                self.store.delete(time)
+            elif kind == RECORD_RESTORE:
+                self.store.restore(time)
+        if self.session.loading:
+            self.session.pending_changes.append(make_change(kind, time))
+
+    def update_statistics(self):
+        if self.loading:
+            return
+        self.stats.recompute(self.data)
+        self.dispatch('on_statistics_changed')
+
+    # Updates the current session summary, and saves it. Must be called after
+    # update_averages().
+    def update_summary(self):
+        session = self.session
+        if session.aggregates_known:
+            self.solve_count = session.summary['count']
+        else:
+            self.solve_count = len(self.data)
+        self.mean = session.get_mean()
+
+        averages = {5: self.ao5, 12: self.ao12, 100: self.ao100}
+        for n in AVERAGES:
+            current = average_from_time(averages[n])
+            if not self.loading:
+                best = self.stats.best_average(n)
+            else:
+                # Statistics are not available yet, only track improvements.
+                best = average_from_json(session.summary.get(f'best_ao{n}'))
+                if current is not None and (best is None or current < best):
+                    best = current
+            session.summary[f'ao{n}'] = average_to_json(current)
+            session.summary[f'best_ao{n}'] = average_to_json(best)
+
+        if self.catalog and session.store:
+            self.catalog.save_summary(session.name, session.summary)
 
     def update_last_time(self):
         if len(self.data) < 1:
@@ -61,33 +318,46 @@ class TimeHistory(kivy.event.EventDispatcher):
         # If there are not enough times recorded, the average is not valid
         if len(self.data) < N:
             return None
-        # Get N last times
-        t = self.data[-N:]
-        # Sort them for easier inspection
-        t.sort()
+        # Get N last times, sorted, DNFs last
+        t = numpy.sort(self.data.penalized(-N))
         # Discard best and worst results
         t = t[1:-1]
         # If any DNFs are still on the list, the average is a DNF
-        if t[-1].is_dnf():
+        if numpy.isinf(t[-1]):
             return Time('DNF')
         # Finally, compute the average
-        average = sum(x.time for x in t)/(N-2)
-        return Time(average)
+        return Time(float(t.mean()))
+
+    # Times recorded between two (UTC) datetimes, stop excluded. Date range
+    # queries are not available while loading.
+    def get_times_between(self, start: datetime.datetime,
+                          stop: datetime.datetime) -> Optional[List[Time]]:
+        if self.loading:
+            return None
+        indices = self.stats.indices_between(
+            self.data, timestamp_from_datetime(start),
+            timestamp_from_datetime(stop))
+        return [self.data[int(i)] for i in indices]
+
+    # Mean of non-DNF times recorded on days between two (UTC) dates, stop
+    # excluded.
+    def get_mean_between(self, start: datetime.date,
+                         stop: datetime.date) -> Optional[Time]:
+        if self.loading:
+            return None
+        count, dnf_count, total = self.stats.days_between(start, stop)
+        return Time(total / (count - dnf_count)) if count > dnf_count else None
 
     def mark_last_time(self, state):
         if len(self.data) < 1:
             return
         lt = self.data[-1]
-        if state == 'DNF':
-            lt.set_dnf(not lt.is_dnf())
-        elif state == '+2':
-            lt.set_p2(not lt.is_p2())
-        elif state == 'OK':
-            lt.set_p2(False)
-            lt.set_dnf(False)
-        self.update_averages()
-        self.update_last_time()
-        self.update_recent_times()
+        # The buttons toggle penalties.
+        if state == 'DNF' and lt.is_dnf():
+            state = 'OK'
+        elif state == '+2' and lt.is_p2():
+            state = 'OK'
+        self.mark_time(len(self.data) - 1, state)
 
     def delete_last_time(self, popup=False):
         if popup:
@@ -97,44 +367,212 @@ class TimeHistory(kivy.event.EventDispatcher):
         else:
             if len(self.data) < 1:
                 return
-            del self.data[-1]
-            self.update_averages()
-            self.update_last_time()
-            self.update_recent_times()
+            self.delete_time(len(self.data) - 1)
+
+    # Sets the penalty state ('OK', '+2' or 'DNF') of any time.
+    def mark_time(self, index, state):
+        time = self.data[index]
+        if time.time is None:
+            # DNF without a measured time, nothing to change.
+            return
+        if state == 'DNF':
+            time.set_dnf(True)
+        elif state == '+2':
+            time.set_dnf(False)
+            time.set_p2(True)
+        elif state == 'OK':
+            time.set_p2(False)
+            time.set_dnf(False)
+        self.edit(make_change(RECORD_PENALTY, time))
+
+    def delete_time(self, index):
+        self.edit(make_change(RECORD_DELETE, self.data[index]))
+
+    # Applies an edit (a penalty, deletion or restore change) and makes it
+    # undoable.
+    def edit(self, change: Change):
+        inverse = self.apply_edit(change)
+        if inverse is None:
+            return
+        self.session.undo_stack.append((change, inverse))
+        del self.session.undo_stack[:-self.UNDO_LIMIT]
+        self.session.redo_stack = []
+        self.on_edited(change)
+
+    def undo(self):
+        if not self.session.undo_stack:
+            return
+        change, inverse = self.session.undo_stack.pop()
+        self.apply_edit(inverse)
+        self.session.redo_stack.append((change, inverse))
+        self.on_edited(inverse)
+
+    def redo(self):
+        if not self.session.redo_stack:
+            return
+        change, inverse = self.session.redo_stack.pop()
+        self.apply_edit(change)
+        self.session.undo_stack.append((change, inverse))
+        self.on_edited(change)
+
+    # Applies a change to data, the store and statistics. Returns the change
+    # that reverts it, or None if the time it refers to does not exist.
+    def apply_edit(self, change: Change) -> Optional[Change]:
+        kind, key, value = change
+        timestamp = timestamp_from_epoch(key)
+
+        if kind == RECORD_RESTORE:
+            index = restore_position(self.data, key)
+            self.data.insert(index, value)
+            self.store_change(kind, value)
+            self.session.count_time(value)
+            if not self.loading:
+                self.stats.insert(self.data, index)
+            return make_change(RECORD_DELETE, value)
+
+        if self.loading:
+            index = self.data.index_of(timestamp)
+        else:
+            index = self.stats.find(self.data, timestamp)
+        if index is None:
+            return None
+        old = self.data[index]
+
+        if kind == RECORD_PENALTY:
+            time = self.data[index]
+            time.load_penalty(value)
+            # Times read from data are copies, store the change.
+            self.data[index] = time
+            self.store_change(kind, time)
+            self.session.count_time(old, -1)
+            self.session.count_time(time)
+            if not self.loading:
+                self.stats.replace(self.data, index, old)
+            return make_change(RECORD_PENALTY, old)
+
+        if kind == RECORD_DELETE:
+            del self.data[index]
+            self.store_change(kind, old)
+            self.session.count_time(old, -1)
+            if not self.loading:
+                self.stats.remove(self.data, index, old)
+            return make_change(RECORD_RESTORE, old)
+
+        return None
+
+    def on_edited(self, change: Change):
+        if not self.loading:
+            self.dispatch('on_statistics_changed')
+        self.update_averages()
+        self.update_last_time()
+        self.update_recent_times()
+        self.update_summary()
+        self.update_undo()
+        if change[0] == RECORD_DELETE:
             self.dispatch('on_time_invalidated')
 
-    def use_file(self, filepath):
-        # Load data from file.
-        self.data = []
+    def update_undo(self):
+        self.can_undo = bool(self.session.undo_stack)
+        self.can_redo = bool(self.session.redo_stack)
+
+    def use_file(self, filepath, session=DEFAULT_SESSION, **kwargs):
+        # Load data from file. Additional arguments are passed to the session
+        # catalog.
         self.filepath = filepath
-        try:
-            with open(filepath, 'r') as f:
-                for line in f:
-                    line = line.strip()
-                    self.data.append(Time(line))
-        except Exception as e:
-            # TODO: Backup the previous file, if it exists. Otherwise we'll
-            # overwrite it with empty data on the next persist().
-            print(f"Failed to load times from {filepath}: {str(e)}")
+        self.catalog = open_catalog(filepath, **kwargs)
+        self.sessions = {}
+        self.switch_session(session)
+
+        # Every change is journaled right away, the main files only need to
+        # be rewritten from time to time.
+        Clock.schedule_interval(lambda td: self.compact(), 60*5)
+
+    # Returns summaries of all sessions, by name. This does not load any
+    # times.
+    def list_sessions(self) -> Dict[str, Dict]:
+        if not self.catalog:
+            return {}
+        return self.catalog.summaries()
+
+    # Makes `name` the current session, creating it if necessary. Sessions
+    # that were used before are already in memory.
+    def switch_session(self, name):
+        name = name.strip()
+        if not name or not self.catalog:
+            return
+        if name not in self.sessions:
+            self.sessions[name] = self.open_session(name)
+
+        self.session = self.sessions[name]
+        self.current_session = name
+        self.loading = self.session.loading
 
         self.update_averages()
         self.update_last_time()
         self.update_recent_times()
+        self.update_summary()
+        self.update_undo()
+        self.dispatch('on_statistics_changed')
 
-        # Auto-save every 5 minutes.
-        Clock.schedule_interval(lambda td: self.persist(), 60*5)
+    def open_session(self, name) -> Session:
+        session = Session(name, self.catalog.open_store(name),
+                          self.catalog.summaries().get(name, {}))
 
-    def persist(self):
-        if not self.filepath:
+        # Show the most recent times right away, and load the rest in the
+        # background.
+        session.data = session.store.load_tail(self.TAIL_LENGTH)
+        session.loading = True
+        Thread(target=self.load_full_history, args=(session,),
+               daemon=True).start()
+        return session
+
+    # Runs in a background thread.
+    def load_full_history(self, session):
+        data = session.store.load()
+        Clock.schedule_once(
+            lambda td: self.on_full_history_loaded(session, data))
+
+    def on_full_history_loaded(self, session, data):
+        apply_changes(data, session.pending_changes)
+        session.pending_changes = []
+        session.data = data
+        session.loading = False
+
+        session.set_aggregates(*data.aggregates())
+        session.stats.recompute(data)
+
+        # Fold changes recovered from the journal into the main file.
+        self.compact_session(session)
+
+        if session is self.session:
+            self.loading = False
+            self.dispatch('on_statistics_changed')
+            self.update_averages()
+            self.update_last_time()
+            self.update_recent_times()
+            self.update_summary()
+
+    def compact(self):
+        for session in self.sessions.values():
+            self.compact_session(session)
+
+    def compact_session(self, session):
+        # While loading, data is incomplete and must not be written out.
+        if session.loading:
             return
+        if session.store and session.store.journal_length:
+            session.store.compact(session.data)
 
-        print(f"Persisting time history to {self.filepath}")
-        try:
-            with open(self.filepath, 'w') as f:
-                for time in self.data:
-                    f.write(time.save() + "\n")
-        except Exception as e:
-            print(f"Failed to save times to {self.filepath}: {str(e)}")
+    def persist(self):
+        for session in self.sessions.values():
+            if session.store.journal_length and not session.loading:
+                session.store.compact(session.data, wait=True)
+            session.store.close()
+        if self.catalog:
+            self.catalog.close()
 
     def on_time_invalidated(self, *args):
         pass
+
+    def on_statistics_changed(self, *args):
+        pass
@@ -1,7 +1,10 @@
 import kivy
 import time
 
+from kivy.clock import Clock
+
 from bluetoothcube.common import Time
+from bluetoothcube.latency import traced
 
 
 class Timer(kivy.event.EventDispatcher):
@@ -13,8 +16,10 @@ class Timer(kivy.event.EventDispatcher):
         self.register_event_type('on_solve_started')
         self.register_event_type('on_solve_ended')
         self.register_event_type('on_new_time')
+        self.register_event_type('on_tick')
         super().__init__()
 
+        # Timestamps from time.perf_counter_ns(), which is monotonic.
         self.start_time = None
         self.end_time = None
         self.measured_time = 0
@@ -23,8 +28,12 @@ class Timer(kivy.event.EventDispatcher):
 
         self.analyzer = None
 
+        # Dispatches on_tick once per frame while running, for the widgets
+        # showing the running time. A single tick keeps them in step.
+        self.tick_event = None
+
         self.cube.bind(
-            on_state_changed=self.on_cube_state_changed,
+            on_state_changed=traced('Timer', self.on_cube_state_changed),
             solved=self.on_cube_solved_changed)
 
     def use_analyzer(self, analyzer):
@@ -40,27 +49,36 @@ class Timer(kivy.event.EventDispatcher):
             return
         self.primed = False
 
-    def start(self):
+    # Timestamps are time.perf_counter_ns() values of the events that started
+    # or stopped the timer, now if not given.
+    def start(self, timestamp=None):
         if self.running:
             return
         self.unprime()
-        self.start_time = time.time()
+        self.start_time = timestamp or time.perf_counter_ns()
         self.measured_time = 0
         self.running = True
+        self.tick_event = Clock.schedule_interval(
+            lambda dt: self.dispatch('on_tick'), 0)
 
         # TODO: This event should probably originate in some other class.
         self.dispatch('on_solve_started')
 
-    def get_time(self) -> float:
+    # Time elapsed at `timestamp` (now by default) since the start.
+    def get_time(self, timestamp=None) -> float:
         if not self.running:
             return self.measured_time
-        return time.time() - self.start_time
+        return ((timestamp or time.perf_counter_ns()) - self.start_time) / 1e9
 
-    def stop(self):
+    def stop(self, timestamp=None):
         if not self.running:
             return
-        self.measured_time = time.time() - self.start_time
+        self.end_time = timestamp or time.perf_counter_ns()
+        self.measured_time = (self.end_time - self.start_time) / 1e9
         self.running = False
+        if self.tick_event:
+            self.tick_event.cancel()
+            self.tick_event = None
 
         self.dispatch('on_solve_ended')
 
@@ -71,14 +89,14 @@ class Timer(kivy.event.EventDispatcher):
 
         self.dispatch('on_new_time', new_time)
 
-    def on_cube_state_changed(self, cube, newstate):
+    def on_cube_state_changed(self, cube, newstate, timestamp):
         if self.primed:
-            self.start()
+            self.start(timestamp)
 
     def on_cube_solved_changed(self, cube, solved):
         if solved:
             if self.running:
-                self.stop()
+                self.stop(cube.state_timestamp)
 
     def on_solve_started(self):
         pass
@@ -88,3 +106,6 @@ class Timer(kivy.event.EventDispatcher):
 
     def on_new_time(self, time):
         pass
+
+    def on_tick(self):
+        pass
@@ -0,0 +1,340 @@
+import datetime
+import numpy
+
+from array import array
+from bisect import bisect_left, bisect_right
+from numpy.lib.stride_tricks import sliding_window_view
+
+from bluetoothcube.common import Time
+from bluetoothcube.timecolumns import TimeColumns, DAY, timestamp_from_epoch
+
+from typing import Dict, Iterable, List, Optional, Tuple
+
+# Rolling averages tracked by TimeStatistics.
+AVERAGES = (5, 12, 100)
+
+# Rolling averages are computed on this many windows at a time, to bound
+# the size of temporary arrays.
+ROLLING_CHUNK = 4096
+
+
+# Computes the average of N (best and worst result discarded) ending at every
+# index of `times`, which should be TimeColumns.penalized() output. The result
+# is NaN where there are not enough times, and +inf for DNF averages.
+def rolling_averages(times: numpy.ndarray, n: int) -> numpy.ndarray:
+    result = numpy.full(len(times), numpy.nan)
+    if len(times) < n:
+        return result
+    windows = sliding_window_view(times, n)
+    for start in range(0, len(windows), ROLLING_CHUNK):
+        w = numpy.sort(windows[start:start + ROLLING_CHUNK], axis=1)
+        # Any DNF left after trimming makes the mean infinite.
+        result[n - 1 + start:n - 1 + start + len(w)] = w[:, 1:-1].mean(axis=1)
+    return result
+
+
+# Average of the last n times of `times`, as in rolling_averages().
+def last_average(times: numpy.ndarray, n: int) -> float:
+    if len(times) < n:
+        return numpy.nan
+    return numpy.sort(times[-n:])[1:-1].mean()
+
+
+# A single time as in TimeColumns.penalized().
+def penalized_time(time: Time) -> float:
+    return numpy.inf if time.is_dnf() or time.time is None else time.time
+
+
+def date_from_day(day: int) -> datetime.date:
+    return datetime.date(1970, 1, 1) + datetime.timedelta(days=day)
+
+
+def day_from_date(date: datetime.date) -> int:
+    return (date - datetime.date(1970, 1, 1)).days
+
+
+# Statistics over a whole time history. They are computed in one vectorized
+# pass by recompute(), then kept up to date by add() as new times come in.
+#
+# Per-time series live in growable arrays, so that add() costs O(log N) plus
+# the average windows: added and removed times are merged into the sorted
+# times when a statistic needs them, and best values are kept as times come
+# in.
+class TimeStatistics:
+    def __init__(self, averages: Iterable[int] = AVERAGES):
+        self.averages = tuple(averages)
+        self.clear()
+
+    def clear(self):
+        self.count = 0
+        self.dnf_count = 0
+        # Non-DNF times, sorted, and those added to or removed from them
+        # since they were last sorted. Use sorted_times() to get all of them.
+        self.sorted = numpy.empty(0)
+        self.unsorted = array('d')
+        self.removed = array('d')
+        self.sum = 0.0
+        # Best non-DNF time, None if there is none or it is not known yet.
+        self.best_time: Optional[float] = None
+        # Average of N for each index, see rolling_averages().
+        self.rolling: Dict[int, array] = {n: array('d') for n in self.averages}
+        # Best average of N, as in best_average(), for those known.
+        self.best_averages: Dict[int, Optional[float]] = {}
+        # Day number (since the epoch) -> [count, dnf_count, sum of non-DNF]
+        self.days: Dict[int, List] = {}
+        # Indices of times sorted by timestamp, and the sorted timestamps.
+        # Both are None while the times themselves are in timestamp order,
+        # which is the usual case since times are appended as they are
+        # recorded. Timestamps can then be searched directly.
+        self.order: Optional[array] = None
+        self.sorted_timestamps: Optional[array] = None
+
+    def recompute(self, data: TimeColumns):
+        times = data.penalized()
+        finite = numpy.isfinite(times)
+        valid = times[finite]
+
+        self.count = len(times)
+        self.dnf_count = self.count - len(valid)
+        self.sorted = numpy.sort(valid)
+        self.unsorted = array('d')
+        self.removed = array('d')
+        self.sum = float(valid.sum())
+        self.best_time = float(self.sorted[0]) if len(valid) else None
+        self.rolling = {
+            n: array('d', rolling_averages(times, n).tobytes())
+            for n in self.averages}
+        self.best_averages = {}
+
+        days, inverse = numpy.unique(data.days(), return_inverse=True)
+        counts = numpy.bincount(inverse, minlength=len(days))
+        dnfs = numpy.bincount(inverse, weights=~finite, minlength=len(days))
+        sums = numpy.bincount(inverse, weights=numpy.where(finite, times, 0),
+                              minlength=len(days))
+        self.days = {
+            int(d): [int(c), int(x), float(s)]
+            for d, c, x, s in zip(days, counts, dnfs, sums)}
+
+        self.index_timestamps(data)
+
+    def index_timestamps(self, data: TimeColumns):
+        timestamps = numpy.frombuffer(data.timestamps, dtype=numpy.int64)
+        if numpy.all(timestamps[1:] >= timestamps[:-1]):
+            self.order = None
+            self.sorted_timestamps = None
+        else:
+            order = numpy.argsort(timestamps, kind='stable')
+            self.order = array('q', order.astype(numpy.int64).tobytes())
+            self.sorted_timestamps = array(
+                'q', timestamps[order].tobytes())
+
+    # Non-DNF times, sorted.
+    def sorted_times(self) -> numpy.ndarray:
+        if self.unsorted:
+            added = numpy.sort(numpy.array(self.unsorted))
+            self.sorted = numpy.insert(
+                self.sorted, numpy.searchsorted(self.sorted, added), added)
+            self.unsorted = array('d')
+        if self.removed:
+            removed = numpy.sort(numpy.array(self.removed))
+            # Equal times are removed from consecutive positions.
+            rank = (numpy.arange(len(removed)) -
+                    numpy.searchsorted(removed, removed))
+            self.sorted = numpy.delete(
+                self.sorted, numpy.searchsorted(self.sorted, removed) + rank)
+            self.removed = array('d')
+        return self.sorted
+
+    # Accounts for a time (penalized, see TimeColumns.penalized()) recorded
+    # on `day` being added, or with sign=-1, removed.
+    def count_time(self, t: float, day: int, sign=1):
+        bucket = self.days.setdefault(day, [0, 0, 0.0])
+        self.count += sign
+        bucket[0] += sign
+        if numpy.isfinite(t):
+            if sign > 0:
+                self.unsorted.append(t)
+                if self.best_time is not None and t < self.best_time:
+                    self.best_time = t
+            else:
+                self.removed.append(t)
+                if t == self.best_time:
+                    self.best_time = None
+            self.sum += sign * t
+            bucket[2] += sign * t
+        else:
+            self.dnf_count += sign
+            bucket[1] += sign
+        if not bucket[0]:
+            del self.days[day]
+
+    # Updates statistics after a time was appended to data.
+    def add(self, data: TimeColumns):
+        times = data.penalized(-max(self.averages))
+        timestamp = data.timestamps[-1]
+        self.count_time(float(times[-1]), timestamp // DAY)
+
+        for n in self.averages:
+            average = float(last_average(times, n))
+            self.rolling[n].append(average)
+            if n in self.best_averages and not numpy.isnan(average):
+                best = self.best_averages[n]
+                if best is None or average < best:
+                    self.best_averages[n] = average
+
+        if self.order is not None:
+            i = bisect_right(self.sorted_timestamps, timestamp)
+            self.sorted_timestamps.insert(i, timestamp)
+            self.order.insert(i, len(data) - 1)
+        elif len(data) > 1 and timestamp < data.timestamps[-2]:
+            # Out of order, e.g. after a clock change.
+            self.index_timestamps(data)
+
+    # The following keep statistics up to date after a change to data at
+    # index i. Only averages whose windows contain i are recomputed, so the
+    # cost depends on the window sizes, not on the history size.
+
+    # After the penalty of data[i] changed, `old` being its previous value.
+    def replace(self, data: TimeColumns, i: int, old: Time):
+        day = data.timestamps[i] // DAY
+        self.count_time(penalized_time(old), day, -1)
+        self.count_time(float(data.penalized(i, i + 1)[0]), day)
+        self.patch_rolling(data, i, i + 1)
+
+    # After `old` was deleted from data at index i.
+    def remove(self, data: TimeColumns, i: int, old: Time):
+        self.count_time(penalized_time(old),
+                        timestamp_from_epoch(old.epoch) // DAY, -1)
+        for n in self.averages:
+            self.patch_best_average(
+                n, self.rolling[n][i:i + 1], numpy.empty(0))
+            # Shifts the rest of the array, as deleting from data does.
+            del self.rolling[n][i]
+        self.patch_rolling(data, i, i)
+        if self.order is not None:
+            self.index_timestamps(data)
+
+    # After a time was inserted into data at index i.
+    def insert(self, data: TimeColumns, i: int):
+        timestamp = data.timestamps[i]
+        self.count_time(float(data.penalized(i, i + 1)[0]), timestamp // DAY)
+        for n in self.averages:
+            self.rolling[n].insert(i, numpy.nan)
+        self.patch_rolling(data, i, i + 1)
+        last = len(data) - 1
+        in_order = ((i == 0 or data.timestamps[i - 1] <= timestamp) and
+                    (i == last or timestamp <= data.timestamps[i + 1]))
+        if self.order is not None or not in_order:
+            self.index_timestamps(data)
+
+    # Recomputes the rolling averages of all windows overlapping [start, stop).
+    def patch_rolling(self, data: TimeColumns, start: int, stop: int):
+        for n in self.averages:
+            lo = max(0, start - n + 1)
+            hi = min(len(data), stop + n - 1)
+            if hi <= start:
+                continue
+            averages = rolling_averages(data.penalized(lo, hi), n)[start - lo:]
+            self.patch_best_average(n, self.rolling[n][start:hi], averages)
+            self.rolling[n][start:hi] = array('d', averages.tobytes())
+
+    # Keeps the best average of N known across averages `old` being replaced
+    # by `new`. It is only found again, when next needed, if it was one of
+    # the old ones and none of the new ones is as good.
+    def patch_best_average(self, n, old: array, new: numpy.ndarray):
+        if n not in self.best_averages:
+            return
+        best = self.best_averages[n]
+        valid = new[~numpy.isnan(new)]
+        candidate = float(valid.min()) if len(valid) else None
+        if candidate is not None and (best is None or candidate <= best):
+            self.best_averages[n] = candidate
+        elif best is not None and best in old:
+            del self.best_averages[n]
+
+    # Index of the last time with the given timestamp.
+    def find(self, data: TimeColumns, timestamp: int) -> Optional[int]:
+        if self.order is None:
+            i = bisect_right(data.timestamps, timestamp) - 1
+            return i if i >= 0 and data.timestamps[i] == timestamp else None
+        i = bisect_right(self.sorted_timestamps, timestamp) - 1
+        if i >= 0 and self.sorted_timestamps[i] == timestamp:
+            return self.order[i]
+        return None
+
+    # Average of the last N times, NaN if there are not enough.
+    def current_average(self, n) -> float:
+        rolling = self.rolling[n]
+        return float(rolling[-1]) if len(rolling) else numpy.nan
+
+    # Indices of times with timestamps in [start, stop), in timestamp order.
+    def indices_between(self, data: TimeColumns,
+                        start: int, stop: int) -> numpy.ndarray:
+        if self.order is None:
+            lo = bisect_left(data.timestamps, start)
+            hi = max(lo, bisect_left(data.timestamps, stop, lo))
+            return numpy.arange(lo, hi)
+        lo = bisect_left(self.sorted_timestamps, start)
+        hi = max(lo, bisect_left(self.sorted_timestamps, stop, lo))
+        return numpy.array(self.order[lo:hi], dtype=numpy.int64)
+
+    # Returns (count, dnf_count, sum of non-DNF times) for days in
+    # [start, stop), from the day buckets.
+    def days_between(self, start: datetime.date,
+                     stop: datetime.date) -> Tuple[int, int, float]:
+        first, last = day_from_date(start), day_from_date(stop)
+        if last - first <= len(self.days):
+            buckets = (self.days.get(day) for day in range(first, last))
+        else:
+            buckets = (bucket for day, bucket in self.days.items()
+                       if first <= day < last)
+        count, dnf_count, total = 0, 0, 0.0
+        for bucket in buckets:
+            if bucket:
+                count += bucket[0]
+                dnf_count += bucket[1]
+                total += bucket[2]
+        return count, dnf_count, total
+
+    def mean(self) -> Optional[float]:
+        valid = self.count - self.dnf_count
+        return self.sum / valid if valid else None
+
+    def std(self) -> Optional[float]:
+        times = self.sorted_times()
+        return float(times.std()) if len(times) else None
+
+    def percentile(self, q) -> Optional[float]:
+        times = self.sorted_times()
+        if not len(times):
+            return None
+        return float(numpy.percentile(times, q))
+
+    def best(self) -> Optional[float]:
+        if self.best_time is None and self.count > self.dnf_count:
+            self.best_time = float(self.sorted_times()[0])
+        return self.best_time
+
+    # Number of non-DNF times below x.
+    def sub_x_count(self, x: float) -> int:
+        return int(numpy.searchsorted(self.sorted_times(), x))
+
+    def histogram(self, bins=20, range=None) -> Tuple[numpy.ndarray,
+                                                      numpy.ndarray]:
+        return numpy.histogram(self.sorted_times(), bins=bins, range=range)
+
+    # Best average of N so far, +inf if all of them were DNFs.
+    def best_average(self, n) -> Optional[float]:
+        if n not in self.best_averages:
+            # A numpy view on an array prevents resizing it, so make sure it
+            # does not outlive this call.
+            rolling = numpy.frombuffer(self.rolling[n])
+            valid = rolling[~numpy.isnan(rolling)]
+            self.best_averages[n] = float(valid.min()) if len(valid) else None
+        return self.best_averages[n]
+
+    # Mean of non-DNF times for each day with at least one.
+    def daily_means(self) -> Dict[datetime.date, float]:
+        return {date_from_day(day): total / (count - dnfs)
+                for day, (count, dnfs, total) in sorted(self.days.items())
+                if count > dnfs}
@@ -0,0 +1,831 @@
+import os
+import re
+import sys
+import json
+import random
+import sqlite3
+import argparse
+import tempfile
+import threading
+
+from bisect import bisect_right
+from contextlib import closing
+from itertools import islice
+from time import perf_counter
+
+from bluetoothcube.common import Time
+from bluetoothcube.timecolumns import TimeColumns, timestamp_from_epoch
+from bluetoothcube.utils import (
+    datetime_from_isoformat, datetime_to_epoch, datetime_from_epoch)
+
+from typing import (
+    Any, Callable, Dict, Iterable, Iterator, List, Optional, Tuple)
+
+
+DEFAULT_SESSION = 'main'
+
+# Journal record kinds.
+RECORD_ADD = 'A'
+RECORD_PENALTY = 'P'
+RECORD_DELETE = 'D'
+# Re-adds a deleted time at its place in timestamp order, to undo a deletion.
+RECORD_RESTORE = 'R'
+
+# A change is a (kind, key, value) tuple. Changes identify times by their
+# timestamp (key, Time.epoch). The value is the Time for RECORD_ADD and
+# RECORD_RESTORE, the Time.save_penalty() string for RECORD_PENALTY and None
+# for RECORD_DELETE.
+Change = Tuple[str, float, Any]
+
+
+def make_change(kind: str, time: Time) -> Change:
+    key = time.epoch
+    if kind in (RECORD_ADD, RECORD_RESTORE):
+        return (kind, key, time)
+    if kind == RECORD_PENALTY:
+        return (kind, key, time.save_penalty())
+    return (kind, key, None)
+
+
+def format_change(change: Change) -> str:
+    kind, key, value = change
+    if kind in (RECORD_ADD, RECORD_RESTORE):
+        return f"{kind}|{value.save()}"
+    ts = datetime_from_epoch(key).isoformat()
+    if kind == RECORD_PENALTY:
+        return f"{kind}|{ts}|{value}"
+    return f"{kind}|{ts}"
+
+
+def parse_record(record: str) -> Change:
+    kind, rest = record.split('|', 1)
+    if kind in (RECORD_ADD, RECORD_RESTORE):
+        time = Time(rest)
+        return (kind, time.epoch, time)
+    if kind == RECORD_PENALTY:
+        ts, penalty = rest.split('|', 1)
+        return (kind, parse_key(ts), penalty)
+    if kind == RECORD_DELETE:
+        return (kind, parse_key(rest), None)
+    raise ValueError(f"Unknown record kind {kind}")
+
+
+def parse_key(ts: str) -> float:
+    return datetime_to_epoch(datetime_from_isoformat(ts))
+
+
+# Applies changes to a list of times. Every change is idempotent, so replaying
+# a journal on top of a snapshot that already contains some of its changes is
+# harmless.
+def apply_changes(data: TimeColumns, changes: Iterable[Change]) -> None:
+    index: Optional[Dict[float, int]] = None
+    for kind, key, value in changes:
+        if index is None:
+            index = {t: i for i, t in enumerate(data.epochs())}
+        if kind == RECORD_ADD:
+            if key not in index:
+                data.append(value)
+                index[key] = len(data) - 1
+        elif kind == RECORD_RESTORE:
+            if key not in index:
+                data.insert(restore_position(data, key), value)
+                index = None
+        elif kind == RECORD_PENALTY:
+            if key in index:
+                time = data[index[key]]
+                time.load_penalty(value)
+                data[index[key]] = time
+        elif kind == RECORD_DELETE:
+            if key in index:
+                del data[index[key]]
+                # Positions have shifted, rebuild the index when needed.
+                index = None
+
+
+# Where a time with the given timestamp belongs, assuming data is in
+# timestamp order (times that are not are skipped over).
+def restore_position(data: TimeColumns, epoch: float) -> int:
+    return bisect_right(data.timestamps, timestamp_from_epoch(epoch))
+
+
+def apply_journal(data: TimeColumns, records: Iterable[str]) -> None:
+    apply_changes(data, parse_records(records))
+
+
+def parse_records(records: Iterable[str]) -> Iterator[Change]:
+    for record in records:
+        try:
+            yield parse_record(record)
+        except Exception as e:
+            print(f"Skipping invalid journal record {record!r}: {str(e)}")
+
+
+# Stores time history in a text file with one Time.save() line per solve, plus
+# an append-only journal of the changes made since that file was written.
+# Each change is a single small append that is flushed to disk immediately, so
+# the cost of saving does not depend on the history size and nothing is lost
+# if the app gets killed. The journal is periodically folded into the main
+# file by a background compaction.
+class TextTimeStore:
+    JOURNAL_SUFFIX = '.journal'
+    # Journal being folded by a running (or interrupted) compaction.
+    COMPACTING_SUFFIX = '.journal.old'
+    TMP_SUFFIX = '.tmp'
+    BACKUP_SUFFIX = '.bak'
+    # How much of the file load_tail() reads at once.
+    TAIL_BLOCK_SIZE = 16384
+
+    def __init__(self, filepath):
+        self.filepath = filepath
+        self.journal_path = filepath + self.JOURNAL_SUFFIX
+        self.compacting_path = filepath + self.COMPACTING_SUFFIX
+
+        self.journal = None
+        # Number of changes that are not yet folded into the main file.
+        self.journal_length = 0
+
+        self.compaction = None
+
+    def load(self) -> TimeColumns:
+        data = TimeColumns()
+        try:
+            with open(self.filepath, 'r') as f:
+                for line in f:
+                    line = line.strip()
+                    if line:
+                        data.append(Time(line))
+        except FileNotFoundError:
+            pass
+        except Exception as e:
+            print(f"Failed to load times from {self.filepath}: {str(e)}")
+            # Keep the original file around, compaction would otherwise
+            # replace it with whatever we managed to load.
+            backup_path = self.filepath + self.BACKUP_SUFFIX
+            print(f"Backing up {self.filepath} to {backup_path}")
+            os.replace(self.filepath, backup_path)
+
+        records = (self.read_journal(self.compacting_path) +
+                   self.read_journal(self.journal_path))
+        apply_journal(data, records)
+        self.journal_length = len(records)
+
+        return data
+
+    # Loads the last n times only, by reading the file backwards. Journaled
+    # changes are applied as far as they concern these times.
+    def load_tail(self, n) -> TimeColumns:
+        lines: List[bytes] = []
+        try:
+            with open(self.filepath, 'rb') as f:
+                pos = f.seek(0, os.SEEK_END)
+                buffer = b''
+                while pos > 0 and buffer.count(b'\n') <= n:
+                    size = min(self.TAIL_BLOCK_SIZE, pos)
+                    pos -= size
+                    f.seek(pos)
+                    buffer = f.read(size) + buffer
+            lines = buffer.split(b'\n')
+            if pos > 0:
+                # The first line is most likely incomplete.
+                lines = lines[1:]
+            lines = [line for line in lines if line.strip()][-n:]
+            data = TimeColumns(Time(line.decode().strip()) for line in lines)
+        except FileNotFoundError:
+            data = TimeColumns()
+        except Exception as e:
+            # load() will report and deal with a broken file.
+            print(f"Failed to load recent times from {self.filepath}: "
+                  f"{str(e)}")
+            data = TimeColumns()
+
+        apply_journal(data, self.read_journal(self.compacting_path) +
+                      self.read_journal(self.journal_path))
+        return data
+
+    # Aggregates are only known after loading the whole file, or if there is
+    # nothing to load.
+    def load_aggregates(self):
+        paths = (self.filepath, self.journal_path, self.compacting_path)
+        if not any(os.path.exists(path) for path in paths):
+            return (0, 0, 0.0)
+        return None
+
+    # Iterates over all times, one line at a time unless there are journaled
+    # changes, which can only be applied to a fully loaded history.
+    def iter_times(self) -> Iterator[Time]:
+        if (os.path.exists(self.journal_path) or
+                os.path.exists(self.compacting_path)):
+            yield from self.load()
+            return
+        try:
+            with open(self.filepath, 'r') as f:
+                for line in f:
+                    line = line.strip()
+                    if line:
+                        yield Time(line)
+        except FileNotFoundError:
+            pass
+
+    @staticmethod
+    def read_journal(path) -> List[str]:
+        try:
+            with open(path, 'r') as f:
+                # A crash may leave a truncated last line, apply_journal will
+                # skip it.
+                return [line.rstrip('\n') for line in f if line.strip()]
+        except FileNotFoundError:
+            return []
+
+    def append(self, time: Time):
+        self.write_record(format_change(make_change(RECORD_ADD, time)))
+
+    # Journals many times with a single sync.
+    def append_many(self, times: Iterable[Time]):
+        self.write_records(
+            format_change(make_change(RECORD_ADD, time)) for time in times)
+
+    def update(self, time: Time):
+        self.write_record(format_change(make_change(RECORD_PENALTY, time)))
+
+    def delete(self, time: Time):
+        self.write_record(format_change(make_change(RECORD_DELETE, time)))
+
+    def restore(self, time: Time):
+        self.write_record(format_change(make_change(RECORD_RESTORE, time)))
+
+    def write_record(self, record: str):
+        self.write_records([record])
+
+    def write_records(self, records: Iterable[str]):
+        try:
+            if not self.journal:
+                self.journal = open(self.journal_path, 'a')
+            for record in records:
+                self.journal.write(record + "\n")
+                self.journal_length += 1
+            self.journal.flush()
+            os.fsync(self.journal.fileno())
+        except Exception as e:
+            print(f"Failed to write to {self.journal_path}: {str(e)}")
+
+    # Writes a new snapshot of the data to the main file, in a background
+    # thread unless `wait` is set. Changes made while the compaction runs are
+    # journaled as usual.
+    def compact(self, data: TimeColumns, wait=False):
+        if self.compaction and self.compaction.is_alive():
+            if not wait:
+                return
+            self.compaction.join()
+
+        self.rotate_journal()
+        snapshot = data.copy()
+        self.compaction = threading.Thread(
+            target=self.write_snapshot, args=(snapshot,), daemon=True)
+        self.compaction.start()
+        if wait:
+            self.compaction.join()
+
+    def rotate_journal(self):
+        if self.journal:
+            self.journal.close()
+            self.journal = None
+        self.journal_length = 0
+
+        if not os.path.exists(self.journal_path):
+            return
+        if not os.path.exists(self.compacting_path):
+            os.replace(self.journal_path, self.compacting_path)
+            return
+
+        # A previous compaction did not finish. Its journal is still needed,
+        # so keep both.
+        with open(self.compacting_path, 'a') as old, \
+                open(self.journal_path, 'r') as new:
+            old.write(new.read())
+            old.flush()
+            os.fsync(old.fileno())
+        os.remove(self.journal_path)
+
+    def write_snapshot(self, snapshot: TimeColumns):
+        tmp_path = self.filepath + self.TMP_SUFFIX
+        print(f"Persisting time history to {self.filepath}")
+        try:
+            with open(tmp_path, 'w') as f:
+                for time in snapshot:
+                    f.write(time.save() + "\n")
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_path, self.filepath)
+            # The snapshot now contains every folded change.
+            if os.path.exists(self.compacting_path):
+                os.remove(self.compacting_path)
+        except Exception as e:
+            print(f"Failed to save times to {self.filepath}: {str(e)}")
+
+    def close(self):
+        if self.compaction:
+            self.compaction.join()
+        if self.journal:
+            self.journal.close()
+            self.journal = None
+
+
+# Penalty codes used by SqliteTimeStore.
+PENALTY_OK = 0
+PENALTY_P2 = 1
+PENALTY_DNF = 2
+
+PENALTY_CODES = {'OK': PENALTY_OK, '+2': PENALTY_P2, 'DNF': PENALTY_DNF}
+
+SQLITE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS times (
+    id INTEGER PRIMARY KEY,
+    ts REAL NOT NULL,
+    time REAL,
+    penalty INTEGER NOT NULL DEFAULT 0,
+    session TEXT NOT NULL
+);
+-- Index entries also hold the row id, so this one serves queries for the most
+-- recent times in a session.
+CREATE INDEX IF NOT EXISTS times_session ON times (session);
+CREATE INDEX IF NOT EXISTS times_session_ts ON times (session, ts);
+CREATE INDEX IF NOT EXISTS times_session_time ON times (session, time);
+CREATE INDEX IF NOT EXISTS times_penalty ON times (penalty);
+
+CREATE TABLE IF NOT EXISTS meta (
+    time_id INTEGER PRIMARY KEY,
+    data TEXT NOT NULL
+);
+
+-- Per-session aggregates, kept up to date by the triggers below so that they
+-- never require a scan of the times table. The summary column holds the rest
+-- of the session summary (averages) as JSON.
+CREATE TABLE IF NOT EXISTS sessions (
+    name TEXT PRIMARY KEY,
+    count INTEGER NOT NULL DEFAULT 0,
+    dnf_count INTEGER NOT NULL DEFAULT 0,
+    total REAL NOT NULL DEFAULT 0,
+    summary TEXT
+);
+
+CREATE TRIGGER IF NOT EXISTS times_insert AFTER INSERT ON times BEGIN
+    INSERT OR IGNORE INTO sessions (name) VALUES (NEW.session);
+    UPDATE sessions SET
+        count = count + 1,
+        dnf_count = dnf_count + (NEW.penalty = 2),
+        total = total + (CASE WHEN NEW.penalty = 2 THEN 0
+                         ELSE IFNULL(NEW.time, 0) END)
+    WHERE name = NEW.session;
+END;
+
+CREATE TRIGGER IF NOT EXISTS times_delete AFTER DELETE ON times BEGIN
+    UPDATE sessions SET
+        count = count - 1,
+        dnf_count = dnf_count - (OLD.penalty = 2),
+        total = total - (CASE WHEN OLD.penalty = 2 THEN 0
+                         ELSE IFNULL(OLD.time, 0) END)
+    WHERE name = OLD.session;
+    DELETE FROM meta WHERE time_id = OLD.id;
+END;
+
+CREATE TRIGGER IF NOT EXISTS times_update AFTER UPDATE ON times BEGIN
+    UPDATE sessions SET
+        dnf_count = dnf_count - (OLD.penalty = 2),
+        total = total - (CASE WHEN OLD.penalty = 2 THEN 0
+                         ELSE IFNULL(OLD.time, 0) END)
+    WHERE name = OLD.session;
+    UPDATE sessions SET
+        dnf_count = dnf_count + (NEW.penalty = 2),
+        total = total + (CASE WHEN NEW.penalty = 2 THEN 0
+                         ELSE IFNULL(NEW.time, 0) END)
+    WHERE name = NEW.session;
+END;
+"""
+
+
+def create_sqlite_schema(db):
+    db.executescript(SQLITE_SCHEMA)
+    # Databases created before session summaries were introduced.
+    columns = [row[1] for row in db.execute("PRAGMA table_info(sessions)")]
+    if 'summary' not in columns:
+        db.execute("ALTER TABLE sessions ADD COLUMN summary TEXT")
+
+
+# Stores time history in an SQLite database. Solves live in an indexed table,
+# metadata in a separate one, so that loading recent times or aggregates does
+# not need to decode anything else. Changes are committed as they happen; in
+# WAL mode each one is a small append to the write-ahead log.
+class SqliteTimeStore:
+    BATCH_SIZE = 1000
+
+    def __init__(self, filepath, session=DEFAULT_SESSION, migrate_from=None):
+        self.filepath = filepath
+        self.session = session
+        # SqliteTimeStore has no journal of its own to compact.
+        self.journal_length = 0
+
+        # Row ids of deleted times, by timestamp. Restored times get their
+        # old id back if it is still free, which keeps their position in the
+        # history.
+        self.deleted_ids: Dict[float, int] = {}
+
+        self.db = self.connect()
+        self.db.execute("PRAGMA journal_mode=WAL")
+        create_sqlite_schema(self.db)
+
+        # A times.txt file to import, which load() does before loading
+        # anything, in the background. Until it is done, changes are kept
+        # in `deferred` and written by compact(), so that the imported times
+        # come first.
+        self.migrate_from = None
+        self.migrated = threading.Event()
+        self.deferred: List[Tuple[Callable, Tuple]] = []
+        if migrate_from and self.is_empty() and os.path.exists(migrate_from):
+            self.migrate_from = migrate_from
+        else:
+            self.migrated.set()
+
+    def connect(self):
+        db = sqlite3.connect(self.filepath)
+        db.execute("PRAGMA synchronous=NORMAL")
+        return db
+
+    def is_empty(self) -> bool:
+        return self.db.execute(
+            "SELECT NOT EXISTS (SELECT 1 FROM times)").fetchone()[0]
+
+    # Runs the pending migration, if any. Called from the background thread
+    # that loads the history.
+    def finish_migration(self):
+        if self.migrated.is_set():
+            return
+        try:
+            self.migrate(self.migrate_from)
+        except Exception as e:
+            print(f"Failed to migrate times from {self.migrate_from}: "
+                  f"{str(e)}")
+        finally:
+            self.migrate_from = None
+            self.migrated.set()
+
+    # One-shot import of a times.txt file, with its own connection. Each
+    # batch is committed on its own, so that the app can still save session
+    # summaries meanwhile.
+    def migrate(self, filepath):
+        print(f"Migrating time history from {filepath} to {self.filepath}")
+        times = TextTimeStore(filepath).iter_times()
+        next_id = 1
+        with closing(self.connect()) as db:
+            while True:
+                batch = list(islice(times, self.BATCH_SIZE))
+                if not batch:
+                    break
+                with db:
+                    self.insert_batch(db, *self.make_rows(batch, next_id))
+                next_id += len(batch)
+
+    # Changes are kept for later while the migration runs, and after it
+    # until the earlier ones are written.
+    def deferring(self) -> bool:
+        return not self.migrated.is_set() or bool(self.deferred)
+
+    def defer(self, method, *args):
+        self.deferred.append((method, args))
+        self.journal_length = len(self.deferred)
+
+    @staticmethod
+    def time_to_row(time: Time):
+        return (time.epoch, time.time, PENALTY_CODES[time.get_state()])
+
+    @staticmethod
+    def time_from_row(ts, time, penalty, meta) -> Time:
+        t = Time('DNF' if time is None else time, epoch=ts, raw_meta=meta)
+        t.time = time
+        t.p2 = penalty == PENALTY_P2
+        t.dnf = penalty == PENALTY_DNF or time is None
+        return t
+
+    # The whole history is usually loaded in a background thread, which needs
+    # its own connection.
+    def load(self) -> TimeColumns:
+        self.finish_migration()
+        return TimeColumns(self.iter_times())
+
+    def iter_times(self) -> Iterator[Time]:
+        with closing(self.connect()) as db:
+            rows = db.execute(
+                "SELECT t.ts, t.time, t.penalty, m.data FROM times t "
+                "LEFT JOIN meta m ON m.time_id = t.id "
+                "WHERE t.session = ? ORDER BY t.id", (self.session,))
+            for row in rows:
+                yield self.time_from_row(*row)
+
+    def load_tail(self, n) -> TimeColumns:
+        rows = self.db.execute(
+            "SELECT t.ts, t.time, t.penalty, m.data FROM times t "
+            "LEFT JOIN meta m ON m.time_id = t.id "
+            "WHERE t.session = ? ORDER BY t.id DESC LIMIT ?",
+            (self.session, n)).fetchall()
+        return TimeColumns(self.time_from_row(*row) for row in reversed(rows))
+
+    # Returns (count, dnf_count, sum of non-DNF times) for the session.
+    def load_aggregates(self):
+        row = self.db.execute(
+            "SELECT count, dnf_count, total FROM sessions WHERE name = ?",
+            (self.session,)).fetchone()
+        return row if row else (0, 0, 0.0)
+
+    def append(self, time: Time):
+        self.append_many([time])
+
+    # Inserts times using one statement per table for each batch.
+    def append_many(self, times: Iterable[Time], next_id=None):
+        if self.deferring():
+            self.defer(self.append_many, list(times), next_id)
+            return
+        try:
+            with self.db:
+                if next_id is None:
+                    next_id = self.db.execute(
+                        "SELECT IFNULL(MAX(id), 0) + 1 FROM times"
+                    ).fetchone()[0]
+                times = iter(times)
+                while True:
+                    batch = list(islice(times, self.BATCH_SIZE))
+                    if not batch:
+                        break
+                    self.insert_batch(
+                        self.db, *self.make_rows(batch, next_id))
+                    next_id += len(batch)
+        except Exception as e:
+            print(f"Failed to save times to {self.filepath}: {str(e)}")
+
+    # Rows of the times and meta tables for times numbered from `next_id`.
+    def make_rows(self, times: List[Time], next_id):
+        rows, meta_rows = [], []
+        for time_id, time in enumerate(times, next_id):
+            rows.append((time_id,) + self.time_to_row(time) + (self.session,))
+            meta = time.save_meta()
+            if meta != 'null':
+                meta_rows.append((time_id, meta))
+        return rows, meta_rows
+
+    @staticmethod
+    def insert_batch(db, rows, meta_rows):
+        db.executemany(
+            "INSERT INTO times (id, ts, time, penalty, session) "
+            "VALUES (?, ?, ?, ?, ?)", rows)
+        db.executemany(
+            "INSERT INTO meta (time_id, data) VALUES (?, ?)", meta_rows)
+
+    # Times are looked up by timestamp, as in the text store journal.
+    def find_id(self, time: Time) -> Optional[int]:
+        row = self.db.execute(
+            "SELECT id FROM times WHERE session = ? AND ts = ? "
+            "ORDER BY id DESC LIMIT 1",
+            (self.session, time.epoch)).fetchone()
+        return row[0] if row else None
+
+    def update(self, time: Time):
+        if self.deferring():
+            self.defer(self.update, time)
+            return
+        try:
+            with self.db:
+                ts, t, penalty = self.time_to_row(time)
+                self.db.execute(
+                    "UPDATE times SET time = ?, penalty = ? WHERE id = ?",
+                    (t, penalty, self.find_id(time)))
+        except Exception as e:
+            print(f"Failed to update time in {self.filepath}: {str(e)}")
+
+    def delete(self, time: Time):
+        if self.deferring():
+            self.defer(self.delete, time)
+            return
+        try:
+            with self.db:
+                time_id = self.find_id(time)
+                self.db.execute("DELETE FROM times WHERE id = ?", (time_id,))
+                self.deleted_ids[time.epoch] = time_id
+        except Exception as e:
+            print(f"Failed to delete time from {self.filepath}: {str(e)}")
+
+    def restore(self, time: Time):
+        if self.deferring():
+            self.defer(self.restore, time)
+            return
+        time_id = self.deleted_ids.pop(time.epoch, None)
+        if time_id is not None and self.db.execute(
+                "SELECT EXISTS (SELECT 1 FROM times WHERE id = ?)",
+                (time_id,)).fetchone()[0]:
+            time_id = None
+        self.append_many([time], next_id=time_id)
+
+    # Writes the changes deferred during the migration, once it is done.
+    def compact(self, data: Optional[TimeColumns], wait=False):
+        if not self.migrated.is_set():
+            if not wait:
+                return
+            self.migrated.wait()
+        deferred, self.deferred = self.deferred, []
+        self.journal_length = 0
+        for method, args in deferred:
+            method(*args)
+
+    def close(self):
+        # Changes made during an unfinished migration would be lost.
+        if self.deferred:
+            self.compact(None, wait=True)
+        self.db.close()
+
+
+# Keeps track of sessions stored as text files. The default session lives in
+# the given file, other sessions in files next to it. A JSON index holds the
+# file name and summary of every session, so that sessions can be listed
+# without reading any times.
+class TextSessionCatalog:
+    INDEX_SUFFIX = '-sessions.json'
+
+    def __init__(self, filepath):
+        self.filepath = filepath
+        self.directory = os.path.dirname(filepath)
+        self.stem, self.extension = os.path.splitext(
+            os.path.basename(filepath))
+        self.index_path = os.path.join(
+            self.directory, self.stem + self.INDEX_SUFFIX)
+
+        self.sessions: Dict[str, Dict] = {}
+        try:
+            with open(self.index_path, 'r') as f:
+                self.sessions = json.load(f)['sessions']
+        except FileNotFoundError:
+            pass
+        except Exception as e:
+            print(f"Failed to load sessions from {self.index_path}: {str(e)}")
+
+        self.sessions.setdefault(DEFAULT_SESSION, {
+            'file': os.path.basename(filepath), 'summary': {}})
+
+    def summaries(self) -> Dict[str, Dict]:
+        return {name: session['summary']
+                for name, session in self.sessions.items()}
+
+    def session_file(self, name) -> str:
+        if name in self.sessions:
+            return self.sessions[name]['file']
+
+        slug = re.sub(r'[^a-z0-9]+', '-', name.lower()).strip('-')
+        taken = {session['file'] for session in self.sessions.values()}
+        file = f"{self.stem}-{slug}{self.extension}"
+        i = 2
+        while file in taken:
+            file = f"{self.stem}-{slug}-{i}{self.extension}"
+            i += 1
+        return file
+
+    def open_store(self, name) -> TextTimeStore:
+        file = self.session_file(name)
+        if name not in self.sessions:
+            self.sessions[name] = {'file': file, 'summary': {}}
+            self.write_index()
+        return TextTimeStore(os.path.join(self.directory, file))
+
+    def save_summary(self, name, summary):
+        self.sessions[name]['summary'] = summary
+        self.write_index()
+
+    def write_index(self):
+        tmp_path = self.index_path + TextTimeStore.TMP_SUFFIX
+        try:
+            with open(tmp_path, 'w') as f:
+                json.dump({'sessions': self.sessions}, f)
+            os.replace(tmp_path, self.index_path)
+        except Exception as e:
+            print(f"Failed to save sessions to {self.index_path}: {str(e)}")
+
+    def close(self):
+        pass
+
+
+# Keeps track of sessions stored in an SQLite database. Session summaries are
+# kept in the sessions table.
+class SqliteSessionCatalog:
+    def __init__(self, filepath, migrate_from=None):
+        self.filepath = filepath
+        self.migrate_from = migrate_from
+        self.db = sqlite3.connect(filepath)
+        create_sqlite_schema(self.db)
+
+    def summaries(self) -> Dict[str, Dict]:
+        result = {DEFAULT_SESSION: {}}
+        rows = self.db.execute(
+            "SELECT name, count, dnf_count, total, summary FROM sessions")
+        for name, count, dnf_count, total, summary in rows:
+            result[name] = json.loads(summary) if summary else {}
+            # The aggregates are always up to date in the table.
+            result[name].update(
+                {'count': count, 'dnf_count': dnf_count, 'total': total})
+        return result
+
+    def open_store(self, name) -> SqliteTimeStore:
+        with self.db:
+            self.db.execute(
+                "INSERT OR IGNORE INTO sessions (name) VALUES (?)", (name,))
+        return SqliteTimeStore(
+            self.filepath, session=name,
+            migrate_from=(self.migrate_from if name == DEFAULT_SESSION
+                          else None))
+
+    def save_summary(self, name, summary):
+        try:
+            with self.db:
+                self.db.execute(
+                    "UPDATE sessions SET summary = ? WHERE name = ?",
+                    (json.dumps(summary), name))
+        except Exception as e:
+            print(f"Failed to save session summary to {self.filepath}: "
+                  f"{str(e)}")
+
+    def close(self):
+        self.db.close()
+
+
+# Picks a session catalog implementation by file extension.
+def open_catalog(filepath, **kwargs):
+    if filepath.endswith('.db'):
+        return SqliteSessionCatalog(filepath, **kwargs)
+    return TextSessionCatalog(filepath)
+
+
+# Writes a times.txt file of `count` random solves, one every minute, with
+# stage times as the analyzer records them.
+def write_synthetic_history(filepath, count):
+    rng = random.Random(count)
+    epoch = datetime_to_epoch(datetime_from_isoformat('2020-01-01T00:00:00'))
+    stages = ('Cross', 'F2L', 'OLL', 'PLL')
+    with open(filepath, 'w') as f:
+        for i in range(count):
+            stage_times = [(name, round(rng.uniform(1, 6), 2))
+                           for name in stages]
+            t = Time(sum(s for _, s in stage_times),
+                     meta={'stage_times': stage_times}, epoch=epoch + 60 * i)
+            if rng.random() < 0.02:
+                t.set_dnf(True)
+            f.write(t.save() + "\n")
+
+
+# Measures, for histories of each size: loading the text store, migrating it
+# to SQLite, loading the SQLite store, and what the app reads before the rest
+# of the history (the last TAIL_LENGTH times and the aggregates).
+def benchmark(sizes: List[int], directory):
+    tail = 300
+    print("solves   text load   migrate   sqlite load   tail + aggregates")
+    for size in sizes:
+        text_path = os.path.join(directory, f"times-{size}.txt")
+        db_path = os.path.join(directory, f"times-{size}.db")
+        if os.path.exists(db_path):
+            os.remove(db_path)
+        write_synthetic_history(text_path, size)
+
+        start = perf_counter()
+        TextTimeStore(text_path).load()
+        text_load = perf_counter() - start
+
+        store = SqliteTimeStore(db_path, migrate_from=text_path)
+        start = perf_counter()
+        store.finish_migration()
+        migrate = perf_counter() - start
+
+        start = perf_counter()
+        data = store.load()
+        sqlite_load = perf_counter() - start
+        assert len(data) == size
+
+        start = perf_counter()
+        store.load_tail(tail)
+        store.load_aggregates()
+        startup = perf_counter() - start
+        store.close()
+
+        print(f"{size:<8} {text_load:7.2f} s {migrate:7.2f} s "
+              f"{sqlite_load:9.2f} s {startup * 1000:12.1f} ms")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Benchmark loading time histories of various sizes.")
+    parser.add_argument('--sizes', type=int, nargs='+',
+                        default=[10000, 100000, 1000000])
+    parser.add_argument('--dir', help="where to write the histories "
+                        "(a temporary directory by default)")
+    args = parser.parse_args(argv)
+    if args.dir:
+        benchmark(args.sizes, args.dir)
+    else:
+        with tempfile.TemporaryDirectory() as directory:
+            benchmark(args.sizes, directory)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
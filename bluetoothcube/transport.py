@@ -0,0 +1,329 @@
+import asyncio
+import concurrent.futures
+import threading
+import time
+
+import kivy.event
+from kivy.clock import Clock
+
+from bluetoothcube.protocols import GIIKER
+from bluetoothcube.statequeue import StateQueue
+
+from typing import AsyncIterator, Optional, Tuple
+
+# Transport layer of cube connections. A transport talks to one cube, through
+# coroutines run on a single asyncio event loop shared by all connections,
+# and yields the raw frames the cube sends. TransportBridge drives a
+# transport and turns it into a Kivy EventDispatcher, with the events the
+# rest of the app binds to.
+
+# A raw frame and its arrival timestamp (time.perf_counter_ns()).
+Frame = Tuple[bytes, int]
+
+_loop: Optional[asyncio.AbstractEventLoop] = None
+_loop_lock = threading.Lock()
+
+
+# The event loop all transports run on, started in a thread of its own on
+# first use.
+def get_event_loop() -> asyncio.AbstractEventLoop:
+    global _loop
+    with _loop_lock:
+        if _loop is None:
+            _loop = asyncio.new_event_loop()
+            threading.Thread(target=_loop.run_forever, name="asyncio loop",
+                             daemon=True).start()
+    return _loop
+
+
+# Raised by transports when a connection step fails. The message is shown to
+# the user.
+class TransportError(Exception):
+    pass
+
+
+def settle(future: Optional[asyncio.Future], error=None, result=None):
+    if future is None or future.done():
+        return
+    if error is not None:
+        future.set_exception(error)
+    else:
+        future.set_result(result)
+
+
+# Base class of transports. Implementations provide connect(), subscribe(),
+# write(), disconnect() and reset_cube(), and report frames and the end of
+# the connection with frame_received() and closed(), which may be called from
+# any thread. closed() must be called on disconnect() too.
+class CubeTransport:
+    # Frames received but not consumed yet. When the queue is full the oldest
+    # frame is dropped and counted: every frame holds the whole cube state, so
+    # the current state is never lost, only intermediate moves.
+    FRAME_QUEUE_SIZE = 1024
+
+    def __init__(self):
+        self.name = "cube"
+        # protocols.Protocol of the frames.
+        self.protocol = GIIKER
+        self.loop = get_event_loop()
+        self.frame_queue: asyncio.Queue = asyncio.Queue(self.FRAME_QUEUE_SIZE)
+        self.dropped_frames = 0
+        # Set by transports that end for good, e.g. at the end of a replay, so
+        # that the bridge does not try to reconnect.
+        self.finished = False
+        # Optional framelog.FrameRecorder, which gets every frame received,
+        # including dropped ones.
+        self.recorder = None
+
+    # Connects to the cube and discovers its services.
+    async def connect(self):
+        raise NotImplementedError()
+
+    # Enables notifications of the cube state.
+    async def subscribe(self):
+        raise NotImplementedError()
+
+    # Writes a request to the cube.
+    async def write(self, data: bytes):
+        raise NotImplementedError()
+
+    async def disconnect(self):
+        raise NotImplementedError()
+
+    async def send_command(self, command: int):
+        # TODO: At the moment this method only supports single-byte commands.
+        buffer = [0] * 17
+        buffer[0] = command
+        await self.write(bytes(buffer))
+
+    async def reset_cube(self):
+        raise NotImplementedError()
+
+    # Raw frames, until the connection is closed.
+    async def frames(self) -> AsyncIterator[Frame]:
+        while True:
+            frame = await self.frame_queue.get()
+            if frame is None:
+                return
+            yield frame
+
+    def frame_received(self, value: bytes, timestamp: Optional[int] = None):
+        if timestamp is None:
+            timestamp = time.perf_counter_ns()
+        self.loop.call_soon_threadsafe(
+            self.put_frame, (bytes(value), timestamp))
+
+    def closed(self):
+        self.loop.call_soon_threadsafe(self.put_frame, None)
+
+    # For producers running on the event loop: waits for room in the queue
+    # instead of dropping frames.
+    async def deliver(self, value: bytes, timestamp: int):
+        await self.frame_queue.put((value, timestamp))
+
+    def put_frame(self, frame: Optional[Frame]):
+        if self.recorder:
+            if frame is None:
+                self.recorder.flush()
+            else:
+                self.recorder.record(*frame)
+        if self.frame_queue.full():
+            self.frame_queue.get_nowait()
+            self.dropped_frames += 1
+        self.frame_queue.put_nowait(frame)
+
+
+# Yields devices found by a BluetoothCubeScanner until `timeout` seconds have
+# passed.
+async def scan(scanner, timeout: float) -> AsyncIterator:
+    loop = asyncio.get_running_loop()
+    found: asyncio.Queue = asyncio.Queue()
+
+    def on_found(scanner, deviceinfo):
+        loop.call_soon_threadsafe(found.put_nowait, deviceinfo)
+
+    scanner.fbind('on_cube_found', on_found)
+    scanner.fbind('on_paired_cube_found', on_found)
+    deadline = loop.time() + timeout
+    try:
+        await loop.run_in_executor(None, scanner.scan)
+        while True:
+            try:
+                yield await asyncio.wait_for(
+                    found.get(), deadline - loop.time())
+            except asyncio.TimeoutError:
+                return
+    finally:
+        scanner.funbind('on_cube_found', on_found)
+        scanner.funbind('on_paired_cube_found', on_found)
+        await loop.run_in_executor(None, scanner.stop_scan)
+
+
+# Runs a transport and dispatches its progress and the parsed frames
+# (protocols.Message) in the Kivy thread.
+class TransportBridge(kivy.event.EventDispatcher):
+    # Seconds allowed for each connection step.
+    CONNECT_TIMEOUT = 30
+    SUBSCRIBE_TIMEOUT = 10
+    DISCONNECT_TIMEOUT = 5
+
+    # States waiting for the Kivy thread beyond which the bridge stops
+    # consuming frames, leaving them to the transport's bounded queue.
+    MAX_PENDING_STATES = 256
+
+    # When an established connection drops, the bridge reconnects without
+    # reporting on_cube_disconnected: at once, then after delays doubling
+    # from RECONNECT_DELAY up to RECONNECT_MAX_DELAY seconds. It gives up
+    # after RECONNECT_ATTEMPTS attempts.
+    RECONNECT_ATTEMPTS = 8
+    RECONNECT_DELAY = 0.25
+    RECONNECT_MAX_DELAY = 4
+
+    def __init__(self, transport: CubeTransport, auto_reconnect=True):
+        self.register_event_type('on_cube_connecting')
+        self.register_event_type('on_cube_connecting_failed')
+        self.register_event_type('on_cube_connected')
+        self.register_event_type('on_cube_reconnecting')
+        self.register_event_type('on_cube_reconnected')
+        self.register_event_type('on_cube_disconnected')
+        self.register_event_type('on_state_updated')
+        self.register_event_type('on_states_processed')
+        super().__init__()
+
+        self.transport = transport
+        self.auto_reconnect = auto_reconnect
+        self.task: Optional[concurrent.futures.Future] = None
+        self.connected = False
+        self.reconnecting = False
+        self.closing = False
+        self.state_queue = StateQueue(self.process_states)
+
+    def run_coroutine(self, coroutine) -> concurrent.futures.Future:
+        return asyncio.run_coroutine_threadsafe(coroutine, self.transport.loop)
+
+    def connect(self):
+        self.task = self.run_coroutine(self.run())
+
+    # Returns a future, that callers which need the cube to be released (e.g.
+    # when the app is closing) can wait for.
+    def disconnect(self) -> concurrent.futures.Future:
+        return self.run_coroutine(self.close())
+
+    def reset_cube(self):
+        self.run_coroutine(self.transport.reset_cube())
+
+    # Dispatches an event in the Kivy thread.
+    def report(self, event, *args):
+        Clock.schedule_once(lambda td: self.dispatch(event, *args))
+
+    # Connects and subscribes, with a time-out for each step.
+    async def open(self):
+        transport = self.transport
+        # Frames and the end of a previous connection are stale.
+        while not transport.frame_queue.empty():
+            transport.frame_queue.get_nowait()
+        await asyncio.wait_for(transport.connect(), self.CONNECT_TIMEOUT)
+        if not self.reconnecting:
+            self.report('on_cube_connecting', "Initializing cube...", 55)
+        await asyncio.wait_for(transport.subscribe(), self.SUBSCRIBE_TIMEOUT)
+
+    async def run(self):
+        transport = self.transport
+        try:
+            self.report('on_cube_connecting',
+                        f"Connecting to {transport.name}...", 20)
+            await self.open()
+        except (TransportError, asyncio.TimeoutError) as e:
+            message = str(e) or "Connection timed out."
+            print(f"Connecting failed: {message}")
+            await self.disconnect_transport()
+            self.report('on_cube_connecting_failed', message)
+            return
+        self.connected = True
+        self.report('on_cube_connected')
+
+        queue = self.state_queue
+        while True:
+            parse = transport.protocol.parse
+            async for value, timestamp in transport.frames():
+                queue.put(parse(memoryview(value)), timestamp)
+                while queue.depth() > self.MAX_PENDING_STATES:
+                    await asyncio.sleep(0.005)
+
+            print("Disconnected.")
+            print(f"State notifications: {queue.counters_text()}, "
+                  f"{transport.dropped_frames} frames dropped")
+            if self.closing or transport.finished or \
+               not self.auto_reconnect or not await self.reconnect():
+                break
+        self.connected = False
+        self.report('on_cube_disconnected')
+
+    # The cube resends its whole state with every frame, so tracked state
+    # resyncs from the first frame after reconnecting.
+    async def reconnect(self) -> bool:
+        self.reconnecting = True
+        delay = 0
+        for attempt in range(1, self.RECONNECT_ATTEMPTS + 1):
+            await asyncio.sleep(delay)
+            delay = min(max(delay * 2, self.RECONNECT_DELAY),
+                        self.RECONNECT_MAX_DELAY)
+            self.report('on_cube_reconnecting', attempt)
+            try:
+                await self.open()
+            except (TransportError, asyncio.TimeoutError) as e:
+                print(f"Reconnecting failed: {e or 'timed out'}")
+                await self.disconnect_transport()
+                continue
+            self.reconnecting = False
+            self.report('on_cube_reconnected')
+            return True
+        self.reconnecting = False
+        return False
+
+    async def close(self):
+        self.closing = True
+        # Give up a connection attempt in progress. An established connection
+        # ends by itself once the transport is closed.
+        if self.task and (not self.connected or self.reconnecting):
+            self.task.cancel()
+        await self.disconnect_transport()
+
+    async def disconnect_transport(self):
+        try:
+            await asyncio.wait_for(self.transport.disconnect(),
+                                   self.DISCONNECT_TIMEOUT)
+        except (TransportError, asyncio.TimeoutError) as e:
+            print(f"Disconnecting failed: {e}")
+
+    # Called once per frame with all states received since the previous one.
+    # Every state is processed, then observers that only care about the
+    # latest state (such as displays) can update once.
+    def process_states(self, states):
+        for message, timestamp in states:
+            self.dispatch('on_state_updated', message, timestamp)
+        self.dispatch('on_states_processed')
+
+    def on_cube_connecting(self, *args):
+        pass
+
+    def on_cube_connecting_failed(self, *args):
+        pass
+
+    def on_cube_connected(self, *args):
+        pass
+
+    def on_cube_reconnecting(self, *args):
+        pass
+
+    def on_cube_reconnected(self, *args):
+        pass
+
+    def on_cube_disconnected(self, *args):
+        pass
+
+    def on_state_updated(self, *args):
+        pass
+
+    def on_states_processed(self, *args):
+        pass
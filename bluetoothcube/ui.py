@@ -6,10 +6,15 @@ from kivy.uix.button import Button
 from kivy.uix.screenmanager import ScreenManager
 from kivy.uix.anchorlayout import AnchorLayout
 from kivy.uix.boxlayout import BoxLayout
+from kivy.uix.gridlayout import GridLayout
 from kivy.clock import Clock
 from kivy.uix.scrollview import ScrollView
 
-from bluetoothcube.cubedisplay import CubeDisplay  # noqa: F401
+from bluetoothcube.cubedisplay import CubeDisplay
+from bluetoothcube.cube3d import Cube3DDisplay
+from bluetoothcube.latency import tracer, traced
+
+from typing import List, Optional
 
 
 class Hideable(kivy.event.EventDispatcher):
@@ -67,7 +72,6 @@ class TimeDisplay(Label):
 
     def __init__(self, **kwargs):
         super().__init__(**kwargs)
-        self.updateevent = None
 
         app = App.get_running_app()
 
@@ -75,21 +79,14 @@ class TimeDisplay(Label):
         self.timehistory = app.timehistory
 
         self.timer.bind(
-            running=self.on_timer_running_changed,
-            primed=lambda timer, primed: self.update_bg_color()
+            running=lambda timer, running: self.update_display(),
+            primed=lambda timer, primed: self.update_bg_color(),
+            on_tick=lambda timer: self.update_display()
         )
         self.timehistory.bind(
             last_time=lambda th, lt: self.update_display(),
             on_time_invalidated=lambda th: self.clear())
 
-    def on_timer_running_changed(self, timer, running):
-        if running:
-            self.updateevent = Clock.schedule_interval(
-                lambda dt: self.update_display(), 0.1)
-        else:
-            Clock.unschedule(self.updateevent)
-        self.update_display()
-
     def update_display(self):
         if self.timer.running:
             v = self.timer.get_time()
@@ -101,7 +98,12 @@ class TimeDisplay(Label):
                 v = 0
             precision = 2
 
-        self.text = f"{v:0.{precision}f}"
+        # Ticks come every frame, but the text only changes every tenth of a
+        # second: setting it only then spares re-rendering the label.
+        text = f"{v:0.{precision}f}"
+        if text == self.text:
+            return
+        self.text = text
 
         if v >= 100:
             self.time_text_ratio = 0.25
@@ -118,9 +120,15 @@ class TimeDisplay(Label):
         self.text = "0.0"
 
 
-# TODO: This widget is now a bare Label - we could make it richer by using a
-# Grid and utilizing partial updates.
-class AnalysisDisplay(Label):
+# A line of AnalysisDisplay.
+class AnalysisLine(Label):
+    pass
+
+
+# Shows the time of each stage of the solve in progress, or of the last one,
+# a line per stage. While solving, only the line of the current stage changes
+# between stages.
+class AnalysisDisplay(GridLayout):
     def __init__(self, **kwargs):
         super().__init__(**kwargs)
 
@@ -128,35 +136,48 @@ class AnalysisDisplay(Label):
         self.timer = App.get_running_app().timer
         self.timehistory = App.get_running_app().timehistory
 
+        self.lines: List[AnalysisLine] = []
+        # Name of the stage timed on the last line, while solving.
+        self.current_stage_name: Optional[str] = None
+
         self.analyzer.bind(
             current_stage=lambda a, cs: self.update_display())
         self.timer.bind(
-            on_solve_started=self.on_solve_started,
-            on_solve_ended=self.on_solve_ended,
-            running=lambda t, r: self.update_display())
+            running=lambda t, r: self.update_display(),
+            on_tick=lambda t: self.update_current_stage())
         self.timehistory.bind(
             last_time=lambda th, lt: self.update_display())
 
-        self.updateevent = None
         self.update_display()
 
-    def on_solve_started(self, timer):
-        self.updateevent = Clock.schedule_interval(
-            lambda dt: self.update_display(), 0.1)
-
-    def on_solve_ended(self, timer):
-        if self.updateevent:
-            Clock.unschedule(self.updateevent)
+    @staticmethod
+    def stage_line(stage_name: str, t: float, precision: int) -> str:
+        return f"[b]{stage_name}[/b]: {t:.0{precision}f}"
+
+    # Sets the text of every line, adding or removing lines as needed.
+    def set_lines(self, texts: List[str]):
+        while len(self.lines) < len(texts):
+            line = AnalysisLine()
+            self.lines.append(line)
+            self.add_widget(line)
+        while len(self.lines) > len(texts):
+            self.remove_widget(self.lines.pop())
+        for line, text in zip(self.lines, texts):
+            if line.text != text:
+                line.text = text
 
     def update_display(self):
-        text = f"Using {self.analyzer.method} analyzer.\n"
+        texts = [f"Using {self.analyzer.method} analyzer."]
+        self.current_stage_name = None
 
         if self.timer.running:
             stages = self.analyzer.get_stage_times()
+            if stages:
+                self.current_stage_name = stages[-1][0]
         else:
             lt = self.timehistory.last_time
             if lt and lt.meta and 'stage_times' in lt.meta:
-                text += "Last solve:\n"
+                texts.append("Last solve:")
                 stages = lt.meta['stage_times']
             else:
                 stages = []
@@ -164,9 +185,18 @@ class AnalysisDisplay(Label):
         for i, v in enumerate(stages):
             stage_name, t = v
             precision = 1 if i+1 == len(stages) else 2
-            text += f"[b]{stage_name}[/b]: {t:.0{precision}f}\n"
+            texts.append(self.stage_line(stage_name, t, precision))
 
-        self.text = text
+        self.set_lines(texts)
+
+    def update_current_stage(self):
+        if self.current_stage_name is None:
+            return
+        text = self.stage_line(self.current_stage_name,
+                               self.analyzer.get_current_stage_time(), 1)
+        line = self.lines[-1]
+        if line.text != text:
+            line.text = text
 
 
 # Created dynamically as cubes are discovered.
@@ -174,20 +204,100 @@ class CubeButton(AnchorLayout):
     button = kivy.properties.ObjectProperty(None)
 
 
+# One cube of a race (see race.py): its name, its connection status, running
+# time or result, and its place once the race is over.
+class RacerPanel(BoxLayout):
+    title = kivy.properties.StringProperty("")
+    time_text = kivy.properties.StringProperty("")
+    place_text = kivy.properties.StringProperty("")
+
+    def __init__(self, racer, **kwargs):
+        super().__init__(**kwargs)
+        self.racer = racer
+        self.title = racer.name
+
+        racer.bind(
+            status=lambda r, s: self.update_time(),
+            connected=lambda r, c: self.update_time(),
+            place=lambda r, p: self.update_place(),
+            on_finished=lambda r, time: self.update_time())
+        racer.timer.bind(
+            running=lambda t, r: self.update_time(),
+            primed=lambda t, p: self.update_time(),
+            on_tick=lambda t: self.update_time())
+        self.update_time()
+
+    def update_time(self):
+        racer = self.racer
+        if racer.timer.running:
+            text = f"{racer.timer.get_time():0.1f}"
+        elif racer.result:
+            text = str(racer.result)
+        elif racer.status or not racer.connected:
+            text = racer.status or "Connecting..."
+        elif racer.timer.primed:
+            text = "Ready"
+        else:
+            text = ""
+        # As in TimeDisplay, only set when the text changes.
+        if text != self.time_text:
+            self.time_text = text
+
+    def update_place(self):
+        self.place_text = f"#{self.racer.place}" if self.racer.place else ""
+
+
+# The unfolded CubeDisplay, or the animated Cube3DDisplay when cube_view is
+# '3d' in the [display] section of the configuration.
+class CubeView(BoxLayout):
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        if App.get_running_app().config.get('display', 'cube_view') == '3d':
+            self.add_widget(Cube3DDisplay())
+        else:
+            self.add_widget(CubeDisplay())
+
+
 class CubeStateDisplay(Label):
     def __init__(self, **kwargs):
         super().__init__(**kwargs)
         self.cube = App.get_running_app().cube
-        self.cube.bind(on_state_changed=self.on_cube_state_changed)
+        self.cube.bind(on_display_state_changed=traced(
+            'CubeStateDisplay', self.on_cube_state_changed))
 
     def on_cube_state_changed(self, cube, new_state):
         self.text = '\n'.join(new_state.get_representation_strings())
 
 
+# Debug overlay with the latency percentiles of each stage (see latency.py).
+# Touching it dumps the histograms to a file.
+class LatencyOverlay(Label):
+    REFRESH_INTERVAL = 1
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.refresh()
+        self.updateevent = Clock.schedule_interval(
+            lambda dt: self.refresh(), self.REFRESH_INTERVAL)
+
+    def refresh(self):
+        self.text = tracer.summary_text()
+
+    def on_touch_down(self, touch):
+        if not self.collide_point(*touch.pos):
+            return False
+        App.get_running_app().dump_latency()
+        return True
+
+
 class MethodButton(AnchorLayout):
     button = kivy.properties.ObjectProperty(None)
 
 
+class SessionButton(AnchorLayout):
+    button = kivy.properties.ObjectProperty(None)
+
+
 class HideableLabel(Label, Hideable):
     pass
 
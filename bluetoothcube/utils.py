@@ -136,3 +136,16 @@ def datetime_from_isoformat(string):
         return datetime.datetime.fromisoformat(string)
     else:
         return fromisoformat(string)
+
+
+EPOCH = datetime.datetime(1970, 1, 1)
+
+
+# Conversions between naive UTC datetimes (as used by Time.ts) and POSIX
+# timestamps.
+def datetime_to_epoch(dt):
+    return (dt - EPOCH) / timedelta(seconds=1)
+
+
+def datetime_from_epoch(ts):
+    return EPOCH + timedelta(seconds=ts)
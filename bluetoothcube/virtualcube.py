@@ -0,0 +1,229 @@
+import os
+import sys
+import time
+import random
+import asyncio
+import argparse
+
+# Command line arguments are for the load test, not for Kivy.
+if __name__ == '__main__':
+    os.environ.setdefault('KIVY_NO_ARGS', '1')
+
+from bluetoothcube.cubestate import (
+    CubieCube, MOVES_GIIKER_TO_KOCIEMBA, move_code)
+from bluetoothcube.giiker import encrypt
+from bluetoothcube.transport import CubeTransport
+
+from typing import Iterable, Iterator, List, Optional, Tuple
+
+# A simulated Giiker cube, to run the app and load-test the whole ingestion
+# pipeline without a physical cube. It produces the same 20-byte frames a
+# real cube sends, plain or encrypted, from a move script or random moves.
+
+# Faces in kociemba order, as in move codes.
+FACES = "URFDLB"
+
+# Giiker face IDs of kociemba faces, inverse of MOVES_GIIKER_TO_KOCIEMBA.
+GIIKER_FACES = [MOVES_GIIKER_TO_KOCIEMBA.index(i) for i in range(6)]
+
+# Giiker directions of a quarter turn.
+CLOCKWISE = 1
+COUNTERCLOCKWISE = 3
+
+# A quarter turn: face index in FACES and whether it is clockwise.
+QuarterTurn = Tuple[int, bool]
+
+
+# Parses moves in the usual notation, e.g. "R U R' U2". Half turns are two
+# quarter turns, as the cube reports them.
+def parse_moves(script: str) -> List[QuarterTurn]:
+    turns = []
+    for move in script.split():
+        face = FACES.index(move[0])
+        if move[1:] == "2":
+            turns += [(face, True)] * 2
+        elif move[1:] in ("", "'"):
+            turns.append((face, move[1:] == ""))
+        else:
+            raise ValueError(f"Invalid move: {move}")
+    return turns
+
+
+# Endless random quarter turns, never turning the same face twice in a row.
+def random_moves(seed=None) -> Iterator[QuarterTurn]:
+    rng = random.Random(seed)
+    face = None
+    while True:
+        face = rng.choice([f for f in range(6) if f != face])
+        yield face, rng.random() < 0.5
+
+
+class VirtualCube:
+    def __init__(self, encrypted=False, seed=None):
+        self.encrypted = encrypted
+        self.rng = random.Random(seed)
+        self.reset()
+
+    def reset(self):
+        self.cube_state = CubieCube()
+        # Last four moves, most recent first.
+        self.history = bytes(4)
+
+    def turn(self, face: int, clockwise: bool) -> bytes:
+        self.cube_state = self.cube_state.moved(
+            move_code(face, 1 if clockwise else 3))
+        move = GIIKER_FACES[face] << 4 | (
+            CLOCKWISE if clockwise else COUNTERCLOCKWISE)
+        self.history = bytes([move]) + self.history[:3]
+        return self.frame()
+
+    # The frame a cube in the current state sends.
+    def frame(self) -> bytes:
+        state = self.cube_state.to_giiker_state() + self.history
+        if self.encrypted:
+            # Encrypted frames have room for the last two moves only.
+            return encrypt(state, self.rng.randrange(256))
+        return state
+
+
+# Transport to a virtual cube, which plays `moves` at `tps` quarter turns per
+# second once subscribed. When behind schedule (at thousands of turns per
+# second), frames are sent in bursts to keep up the average rate.
+class VirtualCubeConnection(CubeTransport):
+    # Seconds a connection step takes, like a real cube.
+    STEP_DELAY = 0.1
+
+    def __init__(self, moves: Iterable[QuarterTurn], tps: float = 5,
+                 encrypted=False, disconnect_when_done=False, seed=None):
+        super().__init__()
+        self.name = "Virtual Giiker"
+        self.cube = VirtualCube(encrypted, seed)
+        self.moves = moves
+        self.tps = tps
+        self.disconnect_when_done = disconnect_when_done
+        self.player: Optional[asyncio.Task] = None
+        self.link_up = False
+        self.sent = 0
+
+    async def connect(self):
+        await asyncio.sleep(self.STEP_DELAY)
+
+    async def subscribe(self):
+        await asyncio.sleep(self.STEP_DELAY)
+        self.link_up = True
+        if not self.player:
+            self.player = self.loop.create_task(self.play())
+
+    async def write(self, data):
+        pass
+
+    async def disconnect(self):
+        if self.player:
+            self.player.cancel()
+            self.player = None
+        self.link_up = False
+        self.closed()
+
+    # Simulates a lost connection. The cube keeps being turned, but frames
+    # are lost until the transport is connected again.
+    def drop(self):
+        self.link_up = False
+        self.closed()
+
+    async def reset_cube(self):
+        self.cube.reset()
+
+    async def play(self):
+        interval = 1 / self.tps
+        next_time = self.loop.time()
+        for face, clockwise in self.moves:
+            frame = self.cube.turn(face, clockwise)
+            if self.link_up:
+                self.frame_received(frame)
+                self.sent += 1
+            next_time += interval
+            # Sleep even when behind, so the consumer gets to run.
+            await asyncio.sleep(max(0, next_time - self.loop.time()))
+        if self.disconnect_when_done:
+            self.finished = True
+            await self.disconnect()
+
+
+# Feeds the frames of a transport through the bridge, BluetoothCube, Timer,
+# Analyzer and ScrambleDetector, driving the Kivy clock by hand until the
+# transport disconnects, and reports the throughput. Returns the cube.
+def process_headless(transport: CubeTransport, report_latency=True):
+    from kivy.clock import Clock
+    from bluetoothcube.bluetoothcube import BluetoothCube, ScrambleDetector
+    from bluetoothcube.solveanalyzers import Analyzer
+    from bluetoothcube.timer import Timer
+    from bluetoothcube.transport import TransportBridge
+
+    cube = BluetoothCube()
+    timer = Timer(cube)
+    analyzer = Analyzer(cube, timer)
+    timer.use_analyzer(analyzer)
+    ScrambleDetector(cube)
+
+    bridge = TransportBridge(transport)
+    done = []
+    bridge.bind(on_cube_connected=lambda b: cube.set_connection(b),
+                on_cube_disconnected=lambda b: done.append(True))
+    latencies = []
+    cube.bind(on_state_changed=lambda c, s, timestamp: latencies.append(
+        time.perf_counter_ns() - timestamp))
+
+    bridge.connect()
+    start = time.perf_counter()
+    while not done:
+        Clock.tick()
+    seconds = time.perf_counter() - start
+
+    latencies.sort()
+    received = len(latencies)
+    print(f"{received} states in {seconds:.2f} s "
+          f"({received / seconds:.0f} per second), "
+          f"{transport.dropped_frames} frames dropped")
+    if report_latency and latencies:
+        print(f"Latency: median {latencies[received // 2] / 1e6:.2f} ms, "
+              f"max {latencies[-1] / 1e6:.2f} ms")
+    print(f"State notifications: {bridge.state_queue.counters_text()}")
+    return cube
+
+
+def load_test(count: int, tps: float, encrypted=False, seed=None,
+              record: Optional[str] = None, trace: Optional[str] = None):
+    from bluetoothcube.latency import tracer
+    if trace:
+        tracer.enable()
+    moves = (move for _, move in zip(range(count), random_moves(seed)))
+    transport = VirtualCubeConnection(
+        moves, tps, encrypted, disconnect_when_done=True, seed=seed)
+    if record:
+        from bluetoothcube.framelog import FrameRecorder
+        transport.recorder = FrameRecorder(record)
+    process_headless(transport)
+    if trace:
+        print(tracer.summary_text())
+        tracer.dump(trace)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Load-test state processing with a virtual cube.")
+    parser.add_argument('--moves', type=int, default=1000)
+    parser.add_argument('--tps', type=float, default=100,
+                        help="quarter turns per second")
+    parser.add_argument('--encrypted', action='store_true')
+    parser.add_argument('--seed', type=int)
+    parser.add_argument('--record', metavar='LOG',
+                        help="append the frames to a frame log")
+    parser.add_argument('--trace', metavar='FILE',
+                        help="trace stage latencies and dump them to FILE")
+    args = parser.parse_args(argv)
+    load_test(args.moves, args.tps, args.encrypted, args.seed, args.record,
+              args.trace)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -36,7 +36,7 @@ version = 0.1
 
 # (list) Application requirements
 # comma separated e.g. requirements = sqlite3,kivy
-requirements = python3,kivy,libffi,cffi,kociemba
+requirements = python3,kivy,libffi,cffi,kociemba,sqlite3,numpy
 
 # (str) Custom source folders for requirements
 # Sets custom source for any requirements with recipes
@@ -136,7 +136,7 @@ android.skip_update = False
 
 # (list) List of Java files to add to the android project (can be java or a
 # directory containing the files)
-android.add_src = bluetoothcube/btutil/BluetoothGattImplem.java
+android.add_src = bluetoothcube/btutil/BluetoothGattImplem.java,bluetoothcube/btutil/BluetoothScanImplem.java
 
 # (list) Android AAR archives to add (currently works only with sdl2_gradle
 # bootstrap)